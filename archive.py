@@ -0,0 +1,273 @@
+"""
+Archivio persistente delle analisi completate
+SQLite con payload compressi e indici su data, profilo di rischio,
+fascia di importo e ticker per interrogazioni storiche rapide
+"""
+import os
+import json
+import time
+import zlib
+import sqlite3
+import threading
+from datetime import datetime, timezone
+from typing import Optional
+
+from market_data import market_data_to_dict, positions_to_dicts
+
+
+ARCHIVE_PATH = os.getenv("ARCHIVE_PATH", "archive.db")
+ARCHIVE_ENABLED = os.getenv("ARCHIVE_ENABLED", "true").lower() == "true"
+
+# Fasce di importo: limite superiore (escluso) ed etichetta
+AMOUNT_BANDS = [
+    (5_000, "< €5k"),
+    (25_000, "€5k-25k"),
+    (100_000, "€25k-100k"),
+    (500_000, "€100k-500k"),
+    (float("inf"), "≥ €500k"),
+]
+
+
+def amount_band(amount: float) -> int:
+    """Indice della fascia di importo."""
+    for i, (upper, _) in enumerate(AMOUNT_BANDS):
+        if amount < upper:
+            return i
+    return len(AMOUNT_BANDS) - 1
+
+
+def amount_band_label(band: int) -> str:
+    return AMOUNT_BANDS[band][1]
+
+
+def recommended_positions(final_state: dict) -> list:
+    """(ticker, importo) delle posizioni raccomandate; un ticker solo citato nel testo non conta."""
+    return [(p["ticker"], p["amount"]) for p in positions_to_dicts(final_state.get("recommendations"))]
+
+
+class RecommendationArchive:
+    """Archivio SQLite delle analisi; thread-safe all'interno di un processo."""
+
+    def __init__(self, path: str = ARCHIVE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30.0, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS analyses (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                created_at REAL NOT NULL,
+                day TEXT NOT NULL,
+                risk_profile TEXT NOT NULL,
+                amount REAL NOT NULL,
+                amount_band INTEGER NOT NULL,
+                engine TEXT,
+                degraded INTEGER NOT NULL DEFAULT 0,
+                latency_ms REAL,
+                input_tokens INTEGER NOT NULL DEFAULT 0,
+                cached_input_tokens INTEGER NOT NULL DEFAULT 0,
+                output_tokens INTEGER NOT NULL DEFAULT 0,
+                payload BLOB NOT NULL
+            );
+            -- Indici coprenti per daily_counts: giorno e latenza senza leggere i payload
+            CREATE INDEX IF NOT EXISTS idx_analyses_created_day ON analyses(created_at, day, latency_ms);
+            CREATE INDEX IF NOT EXISTS idx_analyses_profile_day
+                ON analyses(risk_profile, created_at, day, latency_ms);
+            CREATE INDEX IF NOT EXISTS idx_analyses_band ON analyses(amount_band, created_at);
+
+            -- Tabella clusterizzata per ticker: le query per titolo leggono solo le righe pertinenti
+            CREATE TABLE IF NOT EXISTS analysis_tickers (
+                ticker TEXT NOT NULL,
+                risk_profile TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                analysis_id INTEGER NOT NULL,
+                amount REAL,
+                PRIMARY KEY (ticker, risk_profile, created_at, analysis_id)
+            ) WITHOUT ROWID;
+            -- Per top_tickers: gli indici secondari includono già la chiave primaria (ticker)
+            CREATE INDEX IF NOT EXISTS idx_tickers_created ON analysis_tickers(created_at);
+            CREATE INDEX IF NOT EXISTS idx_tickers_profile ON analysis_tickers(risk_profile, created_at);
+        """)
+
+    # ------------ Scrittura ------------
+
+    def _row(self, final_state: dict, latency_s: Optional[float], created_at: float) -> tuple:
+        from investment_agent import extract_final_answer
+
+        answer = extract_final_answer(final_state)
+        usage = final_state.get("token_usage") or {}
+        amount = float(final_state.get("investment_amount") or 0.0)
+        risk_profile = (final_state.get("risk_profile") or "").lower()
+        payload = {
+            "answer": answer,
+            "recommendations": positions_to_dicts(final_state.get("recommendations")),
+            "market_data": market_data_to_dict(final_state.get("market_data")),
+            "rationale": final_state.get("rationale", ""),
+            "degraded_reason": final_state.get("degraded_reason", ""),
+            "token_usage": usage,
+        }
+        row = (
+            created_at,
+            datetime.fromtimestamp(created_at, tz=timezone.utc).strftime("%Y-%m-%d"),
+            risk_profile,
+            amount,
+            amount_band(amount),
+            final_state.get("engine"),
+            int(bool(final_state.get("degraded"))),
+            latency_s * 1000 if latency_s is not None else None,
+            usage.get("input_tokens", 0),
+            usage.get("cached_input_tokens", 0),
+            usage.get("output_tokens", 0),
+            zlib.compress(json.dumps(payload, ensure_ascii=False, default=str).encode("utf-8"), 6),
+        )
+        return row, recommended_positions(final_state)
+
+    def record(self, final_state: dict, latency_s: Optional[float] = None) -> int:
+        """Archivia un'analisi completata e restituisce il suo id."""
+        return self.record_many([(final_state, latency_s)])[0]
+
+    def record_many(self, items: list) -> list:
+        """Archivia più analisi in un'unica transazione: [(final_state, latency_s), ...]."""
+        now = time.time()
+        prepared = [self._row(state, latency_s, now) for state, latency_s in items]
+        ids = []
+        with self._lock, self._conn:
+            self._conn.execute("BEGIN IMMEDIATE")
+            for row, positions in prepared:
+                cur = self._conn.execute(
+                    "INSERT INTO analyses (created_at, day, risk_profile, amount, amount_band, engine, "
+                    "degraded, latency_ms, input_tokens, cached_input_tokens, output_tokens, payload) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    row,
+                )
+                analysis_id = cur.lastrowid
+                self._conn.executemany(
+                    "INSERT OR IGNORE INTO analysis_tickers (ticker, risk_profile, created_at, analysis_id, amount) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    [(ticker, row[2], row[0], analysis_id, amount) for ticker, amount in positions],
+                )
+                ids.append(analysis_id)
+        return ids
+
+    # ------------ Lettura ------------
+
+    _SUMMARY_COLUMNS = (
+        "a.id, a.created_at, a.risk_profile, a.amount, a.amount_band, a.engine, a.degraded, "
+        "a.latency_ms, a.input_tokens, a.cached_input_tokens, a.output_tokens"
+    )
+
+    def _summaries(self, rows) -> list:
+        keys = ["id", "created_at", "risk_profile", "amount", "amount_band", "engine", "degraded",
+                "latency_ms", "input_tokens", "cached_input_tokens", "output_tokens"]
+        return [dict(zip(keys, row)) for row in rows]
+
+    def query(self, risk_profile: str = None, ticker: str = None, since: float = None,
+              until: float = None, band: int = None, limit: int = 100) -> list:
+        """Analisi più recenti che soddisfano i filtri (senza payload).
+
+        Esempio: tutte le sessioni aggressive che raccomandano NVDA nell'ultimo mese
+        `query(risk_profile="aggressive", ticker="NVDA", since=time.time() - 30 * 86400)`
+        """
+        where, params = [], []
+        if ticker:
+            source = "analysis_tickers t JOIN analyses a ON a.id = t.analysis_id"
+            where.append("t.ticker = ?")
+            params.append(ticker.upper())
+            if risk_profile:
+                where.append("t.risk_profile = ?")
+                params.append(risk_profile.lower())
+            time_column = "t.created_at"
+        else:
+            source = "analyses a"
+            if risk_profile:
+                where.append("a.risk_profile = ?")
+                params.append(risk_profile.lower())
+            time_column = "a.created_at"
+        if since is not None:
+            where.append(f"{time_column} >= ?")
+            params.append(since)
+        if until is not None:
+            where.append(f"{time_column} < ?")
+            params.append(until)
+        if band is not None:
+            where.append("a.amount_band = ?")
+            params.append(band)
+
+        sql = f"SELECT {self._SUMMARY_COLUMNS} FROM {source}"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += f" ORDER BY {time_column} DESC LIMIT ?"
+        params.append(limit)
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        return self._summaries(rows)
+
+    def get(self, analysis_id: int) -> Optional[dict]:
+        """Analisi completa con payload decompresso."""
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT {self._SUMMARY_COLUMNS}, a.payload FROM analyses a WHERE a.id = ?",
+                (analysis_id,),
+            ).fetchone()
+            if row is None:
+                return None
+            tickers = self._conn.execute(
+                "SELECT ticker, amount FROM analysis_tickers WHERE analysis_id = ?", (analysis_id,)
+            ).fetchall()
+        result = self._summaries([row[:-1]])[0]
+        result["payload"] = json.loads(zlib.decompress(row[-1]).decode("utf-8"))
+        result["tickers"] = [{"ticker": t, "amount": a} for t, a in tickers]
+        return result
+
+    def top_tickers(self, since: float = None, risk_profile: str = None, limit: int = 10) -> list:
+        """Ticker più raccomandati nel periodo: [(ticker, numero di analisi), ...]."""
+        where, params = [], []
+        if risk_profile:
+            where.append("risk_profile = ?")
+            params.append(risk_profile.lower())
+        if since is not None:
+            where.append("created_at >= ?")
+            params.append(since)
+        sql = "SELECT ticker, COUNT(*) AS n FROM analysis_tickers"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        # `+ticker` impedisce al planner di preferire la scansione della chiave primaria
+        # (già ordinata per ticker) agli indici per data sulle finestre recenti
+        sql += " GROUP BY +ticker ORDER BY n DESC LIMIT ?"
+        params.append(limit)
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def daily_counts(self, since: float = None, risk_profile: str = None) -> list:
+        """Numero di analisi e latenza media per giorno: [(giorno, n, latenza_ms), ...]."""
+        where, params = [], []
+        if risk_profile:
+            where.append("risk_profile = ?")
+            params.append(risk_profile.lower())
+        if since is not None:
+            where.append("created_at >= ?")
+            params.append(since)
+        sql = "SELECT day, COUNT(*), AVG(latency_ms) FROM analyses"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " GROUP BY day ORDER BY day"
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+_archive = None
+_archive_lock = threading.Lock()
+
+
+def get_archive() -> RecommendationArchive:
+    """Archivio condiviso dal processo, aperto al primo utilizzo."""
+    global _archive
+    with _archive_lock:
+        if _archive is None:
+            _archive = RecommendationArchive()
+        return _archive
@@ -0,0 +1,283 @@
+"""
+Cassette di registrazione/riproduzione delle sessioni dell'agente
+In modalità record salva ogni richiesta/risposta del modello e ogni tool call;
+in modalità replay le riserve con le latenze originali (o scalate), così grafo,
+cache e dashboard si possono misurare offline senza consumare quota API
+"""
+import os
+import sys
+import glob
+import gzip
+import json
+import hashlib
+import time
+import argparse
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from langchain_core.messages import message_to_dict, messages_from_dict
+
+
+CASSETTE_DIR = os.getenv("CASSETTE_DIR", "cassettes")
+
+RECORD = "record"
+REPLAY = "replay"
+
+
+class CassetteMismatch(RuntimeError):
+    """La sessione riprodotta ha chiesto qualcosa che non è nella cassetta."""
+
+
+def _tool_key(name: str, args: dict) -> str:
+    return f"{name}:{json.dumps(args, sort_keys=True, default=str)}"
+
+
+def request_hash(messages) -> str:
+    """Impronta stabile dei messaggi inviati al modello (tipo, contenuto e tool calls).
+
+    Gli id generati dal provider sono esclusi: cambiano a ogni registrazione
+    senza cambiare la richiesta.
+    """
+    payload = [
+        {
+            "type": m.type,
+            "content": m.content,
+            "tool_calls": [
+                {"name": c["name"], "args": c["args"]} for c in getattr(m, "tool_calls", None) or []
+            ],
+        }
+        for m in messages
+    ]
+    encoded = json.dumps(payload, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8")
+    return hashlib.sha256(encoded).hexdigest()
+
+
+class Cassette:
+    """Registrazione di una sessione: chiamate al modello in ordine e tool calls per chiave."""
+
+    def __init__(self, mode: str, meta: dict = None, model_events: list = None,
+                 tool_events: list = None, latency_scale: float = 1.0):
+        self.mode = mode
+        self.meta = meta or {}
+        self.latency_scale = latency_scale
+        self.model_events = model_events or []
+        self.tool_events = tool_events or []
+        self._lock = threading.Lock()
+        self._model_cursor = 0
+        self._tool_queues = {}
+        for event in self.tool_events:
+            self._tool_queues.setdefault(_tool_key(event["name"], event["args"]), deque()).append(event)
+
+    @classmethod
+    def recorder(cls, **meta) -> "Cassette":
+        return cls(RECORD, meta={**meta, "recorded_at": time.time()})
+
+    @classmethod
+    def load(cls, path: str, latency_scale: float = 1.0) -> "Cassette":
+        """Carica una cassetta pronta per la riproduzione (ogni load ha il proprio cursore)."""
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            data = json.load(f)
+        return cls(REPLAY, data["meta"], data["model"], data["tools"], latency_scale)
+
+    @property
+    def replaying(self) -> bool:
+        return self.mode == REPLAY
+
+    @property
+    def recording(self) -> bool:
+        return self.mode == RECORD
+
+    # ------------ Registrazione ------------
+
+    def record_model(self, tier: str, messages, latency_s: float, response):
+        with self._lock:
+            self.model_events.append({
+                "tier": tier,
+                "request": request_hash(messages),
+                "messages": len(messages),
+                "latency_s": round(latency_s, 4),
+                "response": message_to_dict(response),
+            })
+
+    def record_tool(self, name: str, args: dict, latency_s: float, output):
+        with self._lock:
+            self.tool_events.append({
+                "name": name,
+                "args": args,
+                "latency_s": round(latency_s, 4),
+                "output": output,
+            })
+
+    def save(self, path: str):
+        """Salva la cassetta come JSON compresso con gzip."""
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        data = {"meta": self.meta, "model": self.model_events, "tools": self.tool_events}
+        with gzip.open(path, "wt", encoding="utf-8", compresslevel=9) as f:
+            json.dump(data, f, ensure_ascii=False, separators=(",", ":"), default=str)
+
+    # ------------ Riproduzione ------------
+
+    def _sleep(self, latency_s: float):
+        if self.latency_scale > 0:
+            time.sleep(latency_s * self.latency_scale)
+
+    def replay_model(self, tier: str, messages):
+        """Restituisce la prossima risposta registrata del modello.
+
+        Solleva CassetteMismatch se tier o messaggi differiscono da quelli registrati.
+        """
+        with self._lock:
+            position = self._model_cursor
+            if position >= len(self.model_events):
+                raise CassetteMismatch(f"chiamata al modello ({tier}) oltre la fine della cassetta")
+            event = self.model_events[position]
+            if event["tier"] != tier:
+                raise CassetteMismatch(
+                    f"chiamata al modello #{position}: tier {tier}, registrato {event['tier']}"
+                )
+            if event.get("request") not in (None, request_hash(messages)):
+                raise CassetteMismatch(
+                    f"chiamata al modello #{position} ({tier}): richiesta diversa da quella registrata "
+                    f"({len(messages)} messaggi, registrati {event.get('messages')})"
+                )
+            self._model_cursor += 1
+        self._sleep(event["latency_s"])
+        return messages_from_dict([event["response"]])[0]
+
+    def replay_tool(self, name: str, args: dict):
+        """Restituisce l'output registrato per la tool call con gli stessi argomenti."""
+        with self._lock:
+            queue = self._tool_queues.get(_tool_key(name, args))
+            if not queue:
+                raise CassetteMismatch(f"tool call non registrata: {name}({args})")
+            event = queue.popleft()
+        self._sleep(event["latency_s"])
+        return event["output"]
+
+
+# ------------ Sessioni ------------
+
+def record_session(amount: float, risk_profile: str, path: str, agent_app=None) -> dict:
+    """Esegue una sessione reale dell'agente registrandola nella cassetta `path`."""
+    from investment_agent import run_advisory
+
+    cassette = Cassette.recorder(amount=amount, risk_profile=risk_profile)
+    final_state = run_advisory(
+        amount, risk_profile, mode="agent",
+        thread_id=f"record_{os.path.basename(path)}",
+        agent_app=agent_app, cassette=cassette,
+    )
+    cassette.save(path)
+    return final_state
+
+
+def replay_session(path: str, latency_scale: float = 1.0, agent_app=None,
+                   thread_id: str = None, archive: bool = False) -> dict:
+    """Riproduce offline la sessione registrata in `path`."""
+    from investment_agent import run_advisory
+
+    cassette = Cassette.load(path, latency_scale)
+    return run_advisory(
+        cassette.meta["amount"], cassette.meta["risk_profile"], mode="agent",
+        thread_id=thread_id or f"replay_{os.path.basename(path)}_{time.perf_counter_ns()}",
+        agent_app=agent_app, cassette=cassette, archive=archive,
+    )
+
+
+def percentile(values: list, pct: float) -> float:
+    """Percentile con interpolazione lineare (values non vuoto)."""
+    ordered = sorted(values)
+    k = (len(ordered) - 1) * pct / 100
+    lower = int(k)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (k - lower)
+
+
+def replay_many(paths: list, concurrency: int = 32, latency_scale: float = 1.0,
+                repeat: int = 1, archive: bool = False) -> dict:
+    """Riproduce le cassette in parallelo e restituisce throughput e latenze."""
+    from investment_agent import create_investment_agent
+
+    agent_app = create_investment_agent()
+    jobs = [path for _ in range(repeat) for path in paths]
+    latencies, errors = [], []
+
+    def run(path):
+        t0 = time.perf_counter()
+        replay_session(path, latency_scale, agent_app, archive=archive)
+        return time.perf_counter() - t0
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        futures = [pool.submit(run, path) for path in jobs]
+        for future in as_completed(futures):
+            try:
+                latencies.append(future.result())
+            except Exception as e:
+                errors.append(f"{type(e).__name__}: {e}")
+    elapsed = time.perf_counter() - started
+
+    report = {
+        "sessions": len(jobs),
+        "concurrency": concurrency,
+        "latency_scale": latency_scale,
+        "elapsed_s": elapsed,
+        "throughput_per_s": len(latencies) / elapsed if elapsed else 0.0,
+        "errors": len(errors),
+        "error_samples": errors[:5],
+    }
+    if latencies:
+        report.update({
+            "p50_s": percentile(latencies, 50),
+            "p95_s": percentile(latencies, 95),
+            "p99_s": percentile(latencies, 99),
+            "max_s": max(latencies),
+        })
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Registrazione e riproduzione offline delle sessioni")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    rec = sub.add_parser("record", help="Registra sessioni reali dell'agente")
+    rec.add_argument("--amount", type=float, default=10000.0)
+    rec.add_argument("--risk-profile", default="moderate",
+                     choices=["conservative", "moderate", "aggressive"])
+    rec.add_argument("--sessions", type=int, default=1)
+    rec.add_argument("--out", default=CASSETTE_DIR)
+
+    rep = sub.add_parser("replay", help="Riproduce le cassette registrate")
+    rep.add_argument("paths", nargs="*", help="File .json.gz (default: tutte le cassette in --dir)")
+    rep.add_argument("--dir", default=CASSETTE_DIR)
+    rep.add_argument("--concurrency", type=int, default=32)
+    rep.add_argument("--latency-scale", type=float, default=1.0,
+                     help="1.0 = latenze originali, 0 = nessuna attesa")
+    rep.add_argument("--repeat", type=int, default=1)
+    rep.add_argument("--archive", action="store_true", help="Salva anche i risultati nell'archivio")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "record":
+        from investment_agent import create_investment_agent
+
+        agent_app = create_investment_agent()
+        for i in range(args.sessions):
+            path = os.path.join(args.out, f"{args.risk_profile}_{int(args.amount)}_{int(time.time())}_{i}.json.gz")
+            record_session(args.amount, args.risk_profile, path, agent_app)
+            print(f"✅ Cassetta salvata in: {path}")
+        return
+
+    paths = args.paths or sorted(glob.glob(os.path.join(args.dir, "*.json.gz")))
+    if not paths:
+        print(f"⚠️  Nessuna cassetta trovata in {args.dir}")
+        sys.exit(1)
+
+    print(f"▶️  Riproduzione di {len(paths)} cassette x{args.repeat} con concorrenza {args.concurrency}...")
+    report = replay_many(paths, args.concurrency, args.latency_scale, args.repeat, args.archive)
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,222 @@
+"""
+Checkpoint compatti e contabilità della memoria per sessione
+I canali che crescono per accumulo (messages, market_data) salvano solo le
+scritture di ogni super-step, con uno snapshot completo ogni N aggiornamenti;
+i blob più grandi sono compressi con zlib
+"""
+import os
+import copy
+import time
+import zlib
+import threading
+
+from langgraph.checkpoint.memory import InMemorySaver
+from langgraph.checkpoint.serde.jsonplus import JsonPlusSerializer
+
+from market_data import RECORD_TYPES
+
+# Lo snapshot dei canali delta è un tipo privato di langgraph-checkpoint (coperto da
+# tests/test_checkpointing.py): se viene spostato o rinominato lo si riconosce dal nome della classe
+try:
+    from langgraph.checkpoint.serde.types import _DeltaSnapshot as _DELTA_SNAPSHOT_TYPE
+except ImportError:
+    _DELTA_SNAPSHOT_TYPE = None
+
+
+def _is_delta_snapshot(value) -> bool:
+    if _DELTA_SNAPSHOT_TYPE is not None:
+        return isinstance(value, _DELTA_SNAPSHOT_TYPE)
+    return type(value).__name__ == "_DeltaSnapshot"
+
+
+# Snapshot completo dei canali delta ogni N aggiornamenti
+CHECKPOINT_SNAPSHOT_EVERY = int(os.getenv("CHECKPOINT_SNAPSHOT_EVERY", "8"))
+# Blob più piccoli di questa soglia non vengono compressi
+CHECKPOINT_COMPRESS_MIN_BYTES = int(os.getenv("CHECKPOINT_COMPRESS_MIN_BYTES", "512"))
+
+_ZLIB_SUFFIX = "+zlib"
+
+
+def append_items(items: list, writes: list) -> list:
+    """Reducer a lotti per `DeltaChannel`: equivale a sommare le liste con `add`."""
+    result = list(items) if items else []
+    for update in writes:
+        if isinstance(update, list):
+            result.extend(update)
+        else:
+            result.append(update)
+    return result
+
+
+class CompressedSerializer:
+    """Serializer che comprime con zlib i payload oltre `min_bytes`."""
+
+    def __init__(self, serde=None, min_bytes: int = CHECKPOINT_COMPRESS_MIN_BYTES, level: int = 1):
+        self.serde = serde or JsonPlusSerializer(allowed_msgpack_modules=RECORD_TYPES)
+        self.min_bytes = min_bytes
+        self.level = level
+
+    def dumps_typed(self, obj) -> tuple:
+        typ, data = self.serde.dumps_typed(obj)
+        if len(data) >= self.min_bytes:
+            return typ + _ZLIB_SUFFIX, zlib.compress(data, self.level)
+        return typ, data
+
+    def loads_typed(self, data: tuple):
+        typ, payload = data
+        if typ.endswith(_ZLIB_SUFFIX):
+            return self.serde.loads_typed((typ[:-len(_ZLIB_SUFFIX)], zlib.decompress(payload)))
+        return self.serde.loads_typed(data)
+
+
+def _empty_stats() -> dict:
+    return {
+        "checkpoints": 0,
+        "snapshots": 0,
+        "checkpoint_bytes": 0,
+        "write_bytes": 0,
+        "unmeasured": 0,  # salvataggi di cui non è stato possibile leggere la dimensione
+        "serialize_s": 0.0,
+        "message_types": {},  # tipo -> {"count", "bytes"}
+    }
+
+
+# ------------ Lettura dei Blob Salvati ------------
+# `storage`, `blobs` e `writes` sono strutture interne di InMemorySaver: le dimensioni
+# si leggono solo qui, e se la struttura cambia le statistiche restano senza byte
+# invece di far fallire il salvataggio
+
+_LAYOUT_ERRORS = (AttributeError, KeyError, IndexError, TypeError)
+
+
+def _checkpoint_bytes(saver: InMemorySaver, thread_id: str, checkpoint_ns: str,
+                      checkpoint_id: str, new_versions: dict):
+    """Byte di checkpoint, metadati e blob dei canali appena salvati, o None."""
+    try:
+        size = sum(len(part) for part in saver.storage[thread_id][checkpoint_ns][checkpoint_id][:2])
+        size += sum(len(saver.blobs[(thread_id, checkpoint_ns, k, v)][1]) for k, v in new_versions.items())
+        return size
+    except _LAYOUT_ERRORS:
+        return None
+
+
+def _task_write_blobs(saver: InMemorySaver, thread_id: str, checkpoint_ns: str,
+                      checkpoint_id: str, task_id: str):
+    """[(canale, byte)] dei write salvati per il task, in ordine di scrittura, o None."""
+    try:
+        stored = saver.writes.get((thread_id, checkpoint_ns, checkpoint_id), {})
+        return [(entry[1], len(entry[2][1])) for entry in stored.values() if entry[0] == task_id]
+    except _LAYOUT_ERRORS:
+        return None
+
+
+class CompactMemorySaver(InMemorySaver):
+    """MemorySaver con payload compressi e statistiche di memoria per thread_id."""
+
+    def __init__(self, min_bytes: int = CHECKPOINT_COMPRESS_MIN_BYTES):
+        super().__init__(serde=CompressedSerializer(min_bytes=min_bytes))
+        self._stats_lock = threading.Lock()
+        self._session_stats = {}
+
+    def with_allowlist(self, extra_allowlist):
+        inner = self.serde.serde.with_msgpack_allowlist(extra_allowlist)
+        if inner is self.serde.serde:
+            return self
+        clone = copy.copy(self)
+        clone.serde = CompressedSerializer(inner, self.serde.min_bytes, self.serde.level)
+        return clone
+
+    def _stats(self, thread_id: str) -> dict:
+        stats = self._session_stats.get(thread_id)
+        if stats is None:
+            stats = self._session_stats[thread_id] = _empty_stats()
+        return stats
+
+    def put(self, config, checkpoint, metadata, new_versions):
+        t0 = time.perf_counter()
+        next_config = super().put(config, checkpoint, metadata, new_versions)
+        elapsed = time.perf_counter() - t0
+
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"]["checkpoint_ns"]
+        size = _checkpoint_bytes(self, thread_id, checkpoint_ns, checkpoint["id"], new_versions)
+        snapshots = sum(
+            1 for value in checkpoint["channel_values"].values() if _is_delta_snapshot(value)
+        )
+        with self._stats_lock:
+            stats = self._stats(thread_id)
+            stats["checkpoints"] += 1
+            stats["snapshots"] += snapshots
+            if size is None:
+                stats["unmeasured"] += 1
+            else:
+                stats["checkpoint_bytes"] += size
+            stats["serialize_s"] += elapsed
+        return next_config
+
+    def put_writes(self, config, writes, task_id, task_path=""):
+        t0 = time.perf_counter()
+        super().put_writes(config, writes, task_id, task_path)
+        elapsed = time.perf_counter() - t0
+
+        thread_id = config["configurable"]["thread_id"]
+        blobs = _task_write_blobs(self, thread_id, config["configurable"].get("checkpoint_ns", ""),
+                                  config["configurable"]["checkpoint_id"], task_id)
+
+        # Byte per tipo di messaggio dai blob già salvati: un write con più messaggi
+        # è un solo blob, ripartito in parti uguali tra i suoi messaggi
+        per_type = []
+        if blobs is not None:
+            message_blobs = [nbytes for channel, nbytes in blobs if channel == "messages"]
+            message_writes = [value for channel, value in writes if channel == "messages"]
+            for value, nbytes in zip(message_writes, message_blobs):
+                messages = value if isinstance(value, list) else [value]
+                for message in messages:
+                    per_type.append((type(message).__name__, nbytes / len(messages)))
+
+        with self._stats_lock:
+            stats = self._stats(thread_id)
+            if blobs is None:
+                stats["unmeasured"] += 1
+            else:
+                stats["write_bytes"] += sum(nbytes for _, nbytes in blobs)
+            stats["serialize_s"] += elapsed
+            for name, nbytes in per_type:
+                entry = stats["message_types"].setdefault(name, {"count": 0, "bytes": 0})
+                entry["count"] += 1
+                entry["bytes"] += nbytes
+
+    def delete_thread(self, thread_id: str) -> None:
+        super().delete_thread(thread_id)
+        with self._stats_lock:
+            self._session_stats.pop(thread_id, None)
+
+    # ------------ Statistiche ------------
+
+    def session_stats(self, thread_id: str) -> dict:
+        """Memoria occupata dai checkpoint di una sessione."""
+        with self._stats_lock:
+            stats = copy.deepcopy(self._session_stats.get(thread_id) or _empty_stats())
+        stats["total_bytes"] = stats["checkpoint_bytes"] + stats["write_bytes"]
+        stats["bytes_per_checkpoint"] = (
+            stats["total_bytes"] / stats["checkpoints"] if stats["checkpoints"] else 0.0
+        )
+        return stats
+
+    def sessions(self) -> list:
+        with self._stats_lock:
+            return list(self._session_stats)
+
+
+def format_session_report(stats: dict) -> str:
+    lines = [
+        f"Checkpoint: {stats['checkpoints']} (snapshot completi: {stats['snapshots']}), "
+        f"{stats['total_bytes'] / 1024:.1f} KB totali, "
+        f"{stats['bytes_per_checkpoint'] / 1024:.2f} KB per checkpoint",
+        f"Serializzazione: {stats['serialize_s'] * 1000:.1f} ms",
+    ]
+    if stats.get("unmeasured"):
+        lines.append(f"  ⚠️  {stats['unmeasured']} salvataggi senza dimensione (struttura del saver non riconosciuta)")
+    for name, entry in sorted(stats["message_types"].items(), key=lambda item: -item[1]["bytes"]):
+        lines.append(f"  {name}: {entry['count']} messaggi, {entry['bytes'] / 1024:.1f} KB")
+    return "\n".join(lines)
@@ -3,12 +3,21 @@ Dashboard Interattiva per Consulente di Investimento AI
 Interfaccia Streamlit per visualizzare raccomandazioni di investimento
 """
 import streamlit as st
-import os
 from datetime import datetime
-from investment_agent import create_investment_agent
-from langchain_core.messages import HumanMessage, AIMessage
+from investment_agent import run_advisory, extract_final_answer, ADVISORY_MODE
+from model_metrics import model_metrics
+from llm_scheduler import get_scheduler, LLM_SCHEDULER_ENABLED
+from visualize_investment_dag import dag_svg
+from quote_stream import get_quote_bus, PortfolioRevaluator
+from reanalysis import ResultStore, REANALYSIS_REUSE
+from fast_path import market_snapshot
+from market_data import ticker_amounts
+import os
 import re
 
+# Intervallo di aggiornamento delle card con le quotazioni in streaming (secondi)
+LIVE_REFRESH_SECONDS = float(os.getenv("LIVE_REFRESH_SECONDS", "2"))
+
 # Configurazione della pagina
 st.set_page_config(
     page_title="💼 Consulente di Investimento AI",
@@ -132,62 +141,220 @@ def parse_recommendations(content: str) -> dict:
             "change": float(match.group(3))
         })
     
-    # Estrai raccomandazioni per ticker con importi
-    rec_pattern = r'([A-Z]{2,5}):\s*€([\d,]+)'
-    for match in re.finditer(rec_pattern, content):
-        result["recommendations"].append({
-            "ticker": match.group(1),
-            "amount": float(match.group(2).replace(',', ''))
-        })
-    
-    # Estrai conclusione
-    conclusion_match = re.search(r'### Conclusione\s+(.*?)(?=###|$)', content, re.DOTALL)
-    if conclusion_match:
-        result["conclusion"] = conclusion_match.group(1).strip()
+    result["recommendations"] = parse_ticker_amounts(content)
+    result["conclusion"] = parse_conclusion(content)
     
     return result
 
 
-def run_investment_analysis(amount: float, risk_profile: str):
-    """Esegue l'analisi di investimento."""
-    agent_app = create_investment_agent()
-    
-    initial_message = HumanMessage(
-        content=f"""Sono un investitore con €{amount:,.2f} da investire.
-        
-Il mio profilo di rischio è: {risk_profile}
+def parse_ticker_amounts(content: str) -> list:
+    """Estrae le raccomandazioni per ticker con importi dal testo (stesso parser di finalize)."""
+    return [{"ticker": ticker, "amount": amount} for ticker, amount in ticker_amounts(content).items()]
 
-Per favore:
-1. Analizza la situazione attuale del mercato usando get_market_overview
-2. Calcola l'allocazione ottimale del portafoglio con calculate_portfolio_allocation
-3. Analizza i settori più promettenti con analyze_sector_performance
-4. Ottieni quotazioni di titoli specifici usando get_stock_quote per i top picks
-5. Fornisci raccomandazioni dettagliate con razionale
 
-Sii specifico e fornisci ticker, percentuali di allocazione, e giustificazioni."""
-    )
+def parse_conclusion(content: str) -> str:
+    """Estrae la sezione di conclusione dal testo."""
+    conclusion_match = re.search(r'### Conclusione\s+(.*?)(?=###|$)', content, re.DOTALL)
+    return conclusion_match.group(1).strip() if conclusion_match else ""
+
+
+def build_view(state: dict, content: str) -> dict:
+    """Dati per la dashboard letti da `market_data` e dalle posizioni strutturate.
     
-    initial_state = {
-        "messages": [initial_message],
-        "investment_amount": amount,
-        "risk_profile": risk_profile,
+    Dal testo si estrae solo la conclusione, che esiste unicamente nella risposta
+    del modello. Se lo stato non contiene dati strutturati si ricade sul parsing completo.
+    """
+    data = state.get("market_data") or {}
+    if not data:
+        return parse_recommendations(content)
+    
+    result = {
+        "market_overview": {},
+        "allocation": {},
+        "sectors": [dict(s) for s in (data.get("sectors") or {}).values()],
+        "stocks": [
+            {"ticker": q["symbol"], "price": q["price"], "change": q["change_percent"]}
+            for q in (data.get("quotes") or {}).values()
+        ],
         "recommendations": [],
-        "market_data": {},
-        "rationale": "",
-        "next_action": "start"
+        "conclusion": parse_conclusion(content),
     }
     
-    config = {"configurable": {"thread_id": f"investment_session_{datetime.now().timestamp()}"}}
+    overview = data.get("overview")
+    if overview:
+        result["market_overview"] = {
+            "sp500": overview["sp500_change"],
+            "nasdaq": overview["nasdaq_change"],
+            "vix": overview["vix"],
+            "sentiment": overview["sentiment"],
+        }
+    
+    allocation = data.get("allocation")
+    if allocation:
+        result["allocation"] = dict(allocation["allocation"])
+    
+    # Posizioni strutturate prodotte da entrambi i motori (PositionRecord)
+    result["recommendations"] = [
+        {"ticker": p["ticker"], "amount": p["amount"]} for p in state.get("recommendations") or []
+    ]
+    
+    return result
+
+
+SECTOR_LABELS = {
+    "Technology": "💻 Settore Tecnologia",
+    "Healthcare": "🏥 Settore Healthcare",
+    "Energy": "⚡ Settore Energia",
+    "Financials": "🏦 Settore Finanziario",
+    "Consumer": "🛒 Settore Consumi",
+    "ETF": "📊 ETF Azionari",
+    "Bonds": "🛡️ Obbligazioni",
+    "Other": "❔ Altri Titoli",
+}
+
+
+def build_live_positions(state: dict) -> list:
+    """Posizioni raccomandate con prezzo di riferimento e settore, per la rivalutazione live.
+    
+    Il prezzo di riferimento è quello visto dall'analisi; in mancanza si usa
+    l'ultimo tick noto sul bus.
+    """
+    bus = get_quote_bus()
+    positions = []
+    for p in state.get("recommendations") or []:
+        price = p["price"]
+        if not price:
+            tick = bus.latest.get(p["ticker"])
+            price = tick.price if tick else None
+        if not price:
+            continue
+        positions.append({"ticker": p["ticker"], "amount": p["amount"], "price": price, "sector": p["sector"]})
+    return positions
+
+
+def start_live_revaluation(positions: list):
+    """Sostituisce il rivalutatore della sessione con uno nuovo sulle posizioni date."""
+    previous = st.session_state.pop("revaluator", None)
+    if previous is not None:
+        previous.close()
+    st.session_state.live_sectors = {p["ticker"]: p["sector"] for p in positions}
+    st.session_state.revaluator = PortfolioRevaluator(
+        get_quote_bus(), [(p["ticker"], p["amount"], p["price"]) for p in positions]
+    )
+
+
+@st.fragment(run_every=LIVE_REFRESH_SECONDS)
+def render_live_recommendations():
+    """Card delle raccomandazioni con prezzo, valore e P&L aggiornati dai tick in streaming.
+    
+    Solo questo frammento viene rieseguito a ogni intervallo: il resto della pagina
+    non si ricalcola e il valore del portafoglio è già mantenuto incrementalmente.
+    """
+    revaluator = st.session_state.get("revaluator")
+    if revaluator is None:
+        return
+    snapshot = revaluator.snapshot()
+    
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        st.metric("Valore Attuale", f"€{snapshot['value']:,.2f}",
+                  f"{snapshot['pnl_percent']:+.2f}%")
+    with col2:
+        st.metric("P&L dall'Analisi", f"€{snapshot['pnl']:+,.2f}")
+    with col3:
+        st.metric("Tick Ricevuti", snapshot["updates"])
+    
+    by_sector = {}
+    sectors = st.session_state.get("live_sectors", {})
+    for position in snapshot["positions"]:
+        by_sector.setdefault(sectors.get(position["ticker"], "Other"), []).append(position)
+    
+    columns = st.columns(2)
+    for i, (sector, positions) in enumerate(by_sector.items()):
+        with columns[i % 2]:
+            st.markdown(f"### {SECTOR_LABELS.get(sector, sector)}")
+            for p in positions:
+                change_emoji = "📈" if p["change_percent"] > 0 else "📉"
+                st.markdown(f"""
+                <div class="stock-card">
+                    <h3>{change_emoji} {p['ticker']}</h3>
+                    <h2>€{p['value']:,.2f}</h2>
+                    <p>Investiti: €{p['amount']:,.2f} · P&L: €{p['pnl']:+,.2f} ({p['pnl_percent']:+.2f}%)</p>
+                    <p>Prezzo: €{p['price']:.2f} ({p['change_percent']:+.2f}% oggi)</p>
+                </div>
+                """, unsafe_allow_html=True)
+
+
+def run_investment_analysis(amount: float, risk_profile: str, mode: str = ADVISORY_MODE):
+    """Esegue l'analisi di investimento."""
+    thread_id = f"investment_session_{datetime.now().timestamp()}"
     
     with st.spinner("🤖 L'agente AI sta analizzando i mercati..."):
-        final_state = agent_app.invoke(initial_state, config)
+        final_state = run_advisory(amount, risk_profile, mode=mode, thread_id=thread_id)
+    
+    return extract_final_answer(final_state), final_state
+
+
+def render_history_page():
+    """Pagina storico: interroga l'archivio delle analisi completate."""
+    import time
+    import pandas as pd
+    from archive import get_archive, AMOUNT_BANDS, amount_band_label
     
-    # Estrai la risposta finale
-    for msg in final_state["messages"]:
-        if isinstance(msg, AIMessage) and not (hasattr(msg, "tool_calls") and msg.tool_calls):
-            return msg.content, final_state
+    archive = get_archive()
     
-    return None, final_state
+    st.header("🗂️ Storico Analisi")
+    
+    col1, col2, col3, col4 = st.columns(4)
+    with col1:
+        profile_filter = st.selectbox("Profilo di rischio", ["tutti", "conservative", "moderate", "aggressive"])
+    with col2:
+        ticker_filter = st.text_input("Ticker", placeholder="es: NVDA").strip().upper()
+    with col3:
+        period_days = st.selectbox("Periodo", [1, 7, 30, 90, 365], index=2,
+                                   format_func=lambda d: f"Ultimi {d} giorni")
+    with col4:
+        band_options = [None] + list(range(len(AMOUNT_BANDS)))
+        band_filter = st.selectbox("Fascia di importo", band_options,
+                                   format_func=lambda b: "tutte" if b is None else amount_band_label(b))
+    
+    risk = None if profile_filter == "tutti" else profile_filter
+    since = time.time() - period_days * 86400
+    
+    t0 = time.perf_counter()
+    rows = archive.query(risk_profile=risk, ticker=ticker_filter or None, since=since,
+                         band=band_filter, limit=500)
+    query_ms = (time.perf_counter() - t0) * 1000
+    st.caption(f"{len(rows)} analisi trovate in {query_ms:.1f} ms")
+    
+    if not rows:
+        st.info("Nessuna analisi archiviata con questi filtri")
+        return
+    
+    col1, col2 = st.columns([2, 1])
+    with col1:
+        daily = archive.daily_counts(since=since, risk_profile=risk)
+        if daily:
+            st.markdown("### 📅 Analisi per giorno")
+            st.bar_chart(pd.DataFrame(daily, columns=["Giorno", "Analisi", "Latenza media (ms)"])
+                         .set_index("Giorno")[["Analisi"]])
+    with col2:
+        top = archive.top_tickers(since=since, risk_profile=risk)
+        if top:
+            st.markdown("### 🏆 Ticker più raccomandati")
+            st.dataframe(pd.DataFrame(top, columns=["Ticker", "Analisi"]), hide_index=True)
+    
+    df = pd.DataFrame(rows)
+    df["created_at"] = pd.to_datetime(df["created_at"], unit="s")
+    df["amount_band"] = df["amount_band"].map(amount_band_label)
+    st.dataframe(df, hide_index=True, use_container_width=True)
+    
+    selected = st.selectbox("Dettaglio analisi", [r["id"] for r in rows])
+    detail = archive.get(selected)
+    if detail:
+        st.markdown(f"**Ticker raccomandati**: {', '.join(t['ticker'] for t in detail['tickers']) or 'n/d'}")
+        with st.expander("📄 Report", expanded=True):
+            st.markdown(detail["payload"]["answer"])
 
 
 # Header
@@ -196,6 +363,8 @@ st.markdown("---")
 
 # Sidebar per input
 with st.sidebar:
+    page = st.radio("Pagina", ["🔍 Analisi", "🗂️ Storico"], horizontal=True)
+    
     st.header("⚙️ Configurazione")
     
     st.markdown("### 💰 Capitale da Investire")
@@ -229,19 +398,58 @@ with st.sidebar:
     
     st.info(risk_descriptions[risk_profile])
     
+    st.markdown("### ⚡ Motore di Analisi")
+    mode_options = ["auto", "agent", "fast"]
+    mode = st.selectbox(
+        "Modalità",
+        options=mode_options,
+        index=mode_options.index(ADVISORY_MODE) if ADVISORY_MODE in mode_options else 0,
+        help="""
+        - **Auto**: fast path a regole per le richieste standard, agente completo altrimenti
+        - **Agent**: agente LangGraph con loop di tools e modello
+        - **Fast**: motore a regole senza LLM (millisecondi)
+        """
+    )
+    
+    reuse_results = st.checkbox(
+        "♻️ Riusa l'analisi se cambia solo l'importo",
+        value=REANALYSIS_REUSE,
+        help="A parità di profilo e di snapshot di mercato riscala l'ultimo risultato senza rieseguire l'agente"
+    )
+    
     st.markdown("---")
     
     analyze_button = st.button("🔍 Analizza Investimenti", type="primary", use_container_width=True)
 
+if page == "🗂️ Storico":
+    render_history_page()
+    st.stop()
+
 # Area principale
 if analyze_button:
-    # Esegui l'analisi
-    content, state = run_investment_analysis(amount, risk_profile)
+    # Se cambia solo l'importo riscala il risultato già calcolato sullo stesso snapshot
+    # I risultati riusabili sono della sessione: non si servono ad altri utenti
+    result_store = st.session_state.setdefault("result_store", ResultStore())
+    state = result_store.reuse(amount, risk_profile, mode) if reuse_results else None
+    if state is not None:
+        content = extract_final_answer(state)
+    else:
+        snapshot_version = market_snapshot.current_version()
+        content, state = run_investment_analysis(amount, risk_profile, mode)
     
     if content:
         # Salva in session state
         st.session_state.analysis_result = content
-        st.session_state.parsed_data = parse_recommendations(content)
+        st.session_state.engine = state.get("engine", "agent")
+        st.session_state.rationale = state.get("rationale", "")
+        st.session_state.degraded_reason = state.get("degraded_reason", "") if state.get("degraded") else ""
+        st.session_state.checkpoint_stats = state.get("checkpoint_stats")
+        st.session_state.trace = state.get("trace") or []
+        st.session_state.reused_from = state.get("reused_from")
+        st.session_state.parsed_data = build_view(state, content)
+        if not state.get("reused_from"):
+            result_store.remember(state, snapshot_version)
+        start_live_revaluation(build_live_positions(state))
         st.session_state.amount = amount
         st.session_state.risk_profile = risk_profile
 
@@ -249,6 +457,22 @@ if analyze_button:
 if "analysis_result" in st.session_state:
     parsed = st.session_state.parsed_data
     
+    if st.session_state.get("engine") == "fast_path":
+        st.caption(f"⚡ {st.session_state.get('rationale', 'Fast path a regole')}")
+    
+    reused_from = st.session_state.get("reused_from")
+    if reused_from:
+        source = (f"snapshot di mercato v{reused_from['snapshot_version']}, "
+                  if reused_from["engine"] == "fast_path" else "")
+        st.info(f"♻️ Risultato riusato: analisi da €{reused_from['amount']:,.2f} "
+                f"({reused_from['risk_profile']}, motore {reused_from['engine']}, "
+                f"{source}{reused_from['age_s']:.0f}s fa) riscalata a €{st.session_state.amount:,.2f}. "
+                "Il report completo riporta gli importi dell'analisi originale.")
+    
+    if st.session_state.get("degraded_reason"):
+        st.warning(f"⚠️ Risultato parziale: {st.session_state.degraded_reason}. "
+                   "L'analisi è stata finalizzata con i dati raccolti entro il budget.")
+    
     # Sezione 1: Panoramica Mercato
     st.header("📈 Panoramica Mercato")
     
@@ -334,44 +558,8 @@ if "analysis_result" in st.session_state:
     st.header("🎯 Raccomandazioni di Investimento")
     
     if parsed["recommendations"]:
-        # Raggruppa per settore (semplificato)
-        tech_stocks = ["AAPL", "MSFT", "NVDA", "GOOGL"]
-        health_stocks = ["JNJ", "UNH", "PFE", "ABBV"]
-        
-        tech_recs = [r for r in parsed["recommendations"] if r["ticker"] in tech_stocks]
-        health_recs = [r for r in parsed["recommendations"] if r["ticker"] in health_stocks]
-        
-        col1, col2 = st.columns(2)
-        
-        with col1:
-            if tech_recs:
-                st.markdown("### 💻 Settore Tecnologia")
-                for rec in tech_recs:
-                    stock_info = next((s for s in parsed["stocks"] if s["ticker"] == rec["ticker"]), None)
-                    change_emoji = "📈" if stock_info and stock_info["change"] > 0 else "📉"
-                    
-                    st.markdown(f"""
-                    <div class="stock-card">
-                        <h3>{change_emoji} {rec['ticker']}</h3>
-                        <h2>€{rec['amount']:,.2f}</h2>
-                        {f"<p>Prezzo: €{stock_info['price']:.2f} ({stock_info['change']:+.2f}%)</p>" if stock_info else ""}
-                    </div>
-                    """, unsafe_allow_html=True)
-        
-        with col2:
-            if health_recs:
-                st.markdown("### 🏥 Settore Healthcare")
-                for rec in health_recs:
-                    stock_info = next((s for s in parsed["stocks"] if s["ticker"] == rec["ticker"]), None)
-                    change_emoji = "📈" if stock_info and stock_info["change"] > 0 else "📉"
-                    
-                    st.markdown(f"""
-                    <div class="stock-card">
-                        <h3>{change_emoji} {rec['ticker']}</h3>
-                        <h2>€{rec['amount']:,.2f}</h2>
-                        {f"<p>Prezzo: €{stock_info['price']:.2f} ({stock_info['change']:+.2f}%)</p>" if stock_info else ""}
-                    </div>
-                    """, unsafe_allow_html=True)
+        st.caption(f"🔴 Quotazioni in streaming dal simulatore, aggiornate ogni {LIVE_REFRESH_SECONDS:g}s")
+        render_live_recommendations()
     
     st.markdown("---")
     
@@ -381,6 +569,32 @@ if "analysis_result" in st.session_state:
     with st.expander("📄 Visualizza Report Completo", expanded=False):
         st.markdown(st.session_state.analysis_result)
     
+    tier_metrics = model_metrics.snapshot()
+    if tier_metrics:
+        with st.expander("📈 Metriche Modelli (latenza e token per tier)", expanded=False):
+            import pandas as pd
+            st.dataframe(pd.DataFrame(tier_metrics).T[
+                ["model", "calls", "avg_latency_s", "max_latency_s", "input_tokens",
+                 "cached_input_tokens", "cache_hit_ratio", "output_tokens"]
+            ])
+    
+    if LLM_SCHEDULER_ENABLED:
+        scheduler_metrics = get_scheduler().snapshot()
+        if any(s["admitted"] for s in scheduler_metrics.values()):
+            with st.expander("🚦 Scheduler LLM (coda e attese per priorità)", expanded=False):
+                import pandas as pd
+                st.dataframe(pd.DataFrame(scheduler_metrics).T)
+    
+    checkpoint_stats = st.session_state.get("checkpoint_stats")
+    if checkpoint_stats:
+        with st.expander("💾 Memoria Checkpoint della Sessione", expanded=False):
+            cols = st.columns(3)
+            cols[0].metric("Checkpoint", checkpoint_stats["checkpoints"])
+            cols[1].metric("Per checkpoint", f"{checkpoint_stats['bytes_per_checkpoint'] / 1024:.2f} KB")
+            cols[2].metric("Serializzazione", f"{checkpoint_stats['serialize_s'] * 1000:.1f} ms")
+            import pandas as pd
+            st.dataframe(pd.DataFrame(checkpoint_stats["message_types"]).T)
+    
     # Sezione 5: Conclusioni
     if parsed["conclusion"]:
         st.header("💡 Conclusioni")
@@ -397,10 +611,10 @@ if "analysis_result" in st.session_state:
     
     with col1:
         st.markdown("### 📊 Grafo del Workflow")
-        if os.path.exists("investment_agent_dag.png"):
-            st.image("investment_agent_dag.png", use_container_width=True)
-        else:
-            st.info("Esegui `python visualize_investment_dag.py` per generare il DAG")
+        trace = st.session_state.get("trace") or []
+        if trace:
+            st.caption("Traccia della sessione: visite per nodo, latenza cumulativa (heatmap) e archi percorsi")
+        st.markdown(dag_svg(trace), unsafe_allow_html=True)
     
     with col2:
         st.markdown("### 🔄 Flusso di Esecuzione")
@@ -441,6 +655,9 @@ if "analysis_result" in st.session_state:
         for key in ["analysis_result", "parsed_data"]:
             if key in st.session_state:
                 del st.session_state[key]
+        revaluator = st.session_state.pop("revaluator", None)
+        if revaluator is not None:
+            revaluator.close()
         st.rerun()
 
 else:
@@ -0,0 +1,325 @@
+"""
+Fast path senza LLM per le richieste di allocazione standard
+Costruisce la raccomandazione strutturata direttamente dai tools
+e da uno snapshot di mercato in cache, in millisecondi
+"""
+import os
+import json
+import time
+import threading
+
+from langchain_core.messages import HumanMessage, AIMessage, SystemMessage
+
+from market_data import QuoteRecord, overview_record, sector_record, allocation_record, position_record
+from sector_subgraph import sector_score, VOLATILITY_PENALTY
+from investment_agent import (
+    get_stock_quote,
+    get_market_overview,
+    analyze_sector_performance,
+    calculate_portfolio_allocation,
+)
+
+
+# Durata dello snapshot di mercato condiviso (secondi)
+SNAPSHOT_TTL = float(os.getenv("FAST_PATH_SNAPSHOT_TTL", "60"))
+
+# Narrativa: "template" (nessuna chiamata al modello) oppure "llm" (una sola chiamata)
+FAST_PATH_NARRATIVE = os.getenv("FAST_PATH_NARRATIVE", "template")
+
+# Oltre questo importo la richiesta passa sempre dall'agente completo
+FAST_PATH_MAX_AMOUNT = float(os.getenv("FAST_PATH_MAX_AMOUNT", "1000000"))
+
+STANDARD_PROFILES = ("conservative", "moderate", "aggressive")
+
+# Regole di selezione per profilo di rischio
+PROFILE_RULES = {
+    "conservative": {"sectors": 1, "picks_per_sector": 2, "volatility_penalty": VOLATILITY_PENALTY["conservative"]},
+    "moderate": {"sectors": 2, "picks_per_sector": 2, "volatility_penalty": VOLATILITY_PENALTY["moderate"]},
+    "aggressive": {"sectors": 3, "picks_per_sector": 2, "volatility_penalty": VOLATILITY_PENALTY["aggressive"]},
+}
+
+# ETF usato per la quota obbligazionaria
+BOND_ETF = "BND"
+
+ASSET_LABELS = {
+    "stocks": "Azioni",
+    "bonds": "Obbligazioni",
+    "cash": "Liquidità",
+    "commodities": "Commodities",
+}
+
+
+# ------------ Snapshot di Mercato ------------
+
+class MarketSnapshot:
+    """Snapshot di mercato condiviso con TTL: panoramica, settori e quotazioni."""
+
+    def __init__(self, ttl: float = SNAPSHOT_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._expires = 0.0
+        self.version = 0
+        self.overview = {}
+        self.sectors = {}
+        self.quotes = {}
+
+    def _refresh_if_stale(self):
+        now = time.monotonic()
+        if now < self._expires:
+            return
+        self.overview = get_market_overview.invoke({})
+        self.sectors = {
+            sector: analyze_sector_performance.invoke({"sector": sector})
+            for sector in self.overview.get("sector_leaders", [])
+        }
+        self.quotes = {}
+        self.version += 1
+        self._expires = now + self.ttl
+
+    def read(self, symbols=(), select=None) -> dict:
+        """Restituisce panoramica, settori e le quotazioni richieste (caricate se mancanti).
+
+        `select(settori) -> simboli` sceglie i titoli da quotare sugli stessi settori
+        restituiti, sotto un'unica acquisizione del lock: un refresh non può cadere in mezzo.
+        """
+        with self._lock:
+            self._refresh_if_stale()
+            if select is not None:
+                symbols = list(symbols) + list(select(self.sectors))
+            for symbol in symbols:
+                if symbol not in self.quotes:
+                    self.quotes[symbol] = get_stock_quote.invoke({"symbol": symbol})
+            return {
+                "version": self.version,
+                "overview": self.overview,
+                "sectors": dict(self.sectors),
+                "quotes": {s: self.quotes[s] for s in symbols},
+            }
+
+    def current_version(self) -> int:
+        """Versione dello snapshot valido ora (cambia quando il TTL scade)."""
+        with self._lock:
+            self._refresh_if_stale()
+            return self.version
+
+    def invalidate(self):
+        with self._lock:
+            self._expires = 0.0
+
+
+market_snapshot = MarketSnapshot()
+
+
+# ------------ Selezione del Percorso ------------
+
+def is_standard_request(amount: float, risk_profile: str, custom_request: str = "") -> bool:
+    """True se la richiesta corrisponde al template standard gestibile dal fast path."""
+    if custom_request and custom_request.strip():
+        return False
+    if risk_profile.lower() not in STANDARD_PROFILES:
+        return False
+    return 0 < amount <= FAST_PATH_MAX_AMOUNT
+
+
+# ------------ Motore a Regole ------------
+
+def _select_picks(sectors: dict, risk_profile: str) -> list:
+    """Ordina i settori per punteggio e sceglie i titoli con il relativo peso."""
+    rules = PROFILE_RULES[risk_profile]
+    ranked = sorted(
+        (
+            (sector, sector_score(analysis, rules["volatility_penalty"]), analysis)
+            for sector, analysis in sectors.items()
+            if analysis["top_stocks"] != ["N/A"]
+        ),
+        key=lambda item: item[1],
+        reverse=True,
+    )[:rules["sectors"]]
+
+    # Peso dei settori proporzionale al punteggio (minimo 1 per non azzerarli)
+    total_score = sum(max(score, 1.0) for _, score, _ in ranked) or 1.0
+    picks = []
+    for sector, score, analysis in ranked:
+        sector_weight = max(score, 1.0) / total_score
+        tickers = analysis["top_stocks"][:rules["picks_per_sector"]]
+        for ticker in tickers:
+            picks.append({
+                "ticker": ticker,
+                "sector": sector,
+                "weight": sector_weight / len(tickers),
+                "sector_score": round(score, 2),
+            })
+    return picks
+
+
+def build_recommendation(amount: float, risk_profile: str) -> dict:
+    """Costruisce la raccomandazione strutturata completa senza invocare il modello."""
+    risk_profile = risk_profile.lower()
+    allocation = calculate_portfolio_allocation.invoke({"amount": amount, "risk_profile": risk_profile})
+
+    # Scelta dei titoli e quotazioni dallo stesso snapshot
+    snapshot = market_snapshot.read(
+        [BOND_ETF], select=lambda sectors: [p["ticker"] for p in _select_picks(sectors, risk_profile)]
+    )
+    picks = _select_picks(snapshot["sectors"], risk_profile)
+
+    stock_budget = allocation["allocation"]["stocks"]
+    positions = []
+    for pick in picks:
+        quote = snapshot["quotes"][pick["ticker"]]
+        position_amount = round(stock_budget * pick["weight"], 2)
+        positions.append({
+            "ticker": pick["ticker"],
+            "sector": pick["sector"],
+            "amount": position_amount,
+            "weight": round(pick["weight"] * allocation["allocation_percentages"]["stocks"], 4),
+            "price": quote["price"],
+            "change_percent": quote["change_percent"],
+            "volume": quote["volume"],
+            "shares": round(position_amount / quote["price"], 4) if quote["price"] else 0.0,
+        })
+
+    # Assegna il resto dovuto agli arrotondamenti all'ultima posizione
+    if positions:
+        remainder = round(stock_budget - sum(p["amount"] for p in positions), 2)
+        last = positions[-1]
+        last["amount"] = round(last["amount"] + remainder, 2)
+        last["shares"] = round(last["amount"] / last["price"], 4) if last["price"] else 0.0
+
+    bond_quote = snapshot["quotes"][BOND_ETF]
+    bond_amount = allocation["allocation"]["bonds"]
+    positions.append({
+        "ticker": BOND_ETF,
+        "sector": "Bonds",
+        "amount": bond_amount,
+        "weight": allocation["allocation_percentages"]["bonds"],
+        "price": bond_quote["price"],
+        "change_percent": bond_quote["change_percent"],
+        "volume": bond_quote["volume"],
+        "shares": round(bond_amount / bond_quote["price"], 4) if bond_quote["price"] else 0.0,
+    })
+
+    return {
+        "snapshot_version": snapshot["version"],
+        "market_overview": snapshot["overview"],
+        "sectors": snapshot["sectors"],
+        "allocation": allocation,
+        "positions": positions,
+    }
+
+
+# ------------ Narrativa ------------
+
+def render_template_narrative(recommendation: dict) -> str:
+    """Scrive il report in markdown senza modello (stesso formato atteso dalla dashboard)."""
+    overview = recommendation["market_overview"]
+    allocation = recommendation["allocation"]
+    lines = [
+        "### Panoramica del Mercato",
+        f"- S&P 500: {overview['sp500_change']:+.2f}%",
+        f"- NASDAQ: {overview['nasdaq_change']:+.2f}%",
+        f"- Dow Jones: {overview['dow_change']:+.2f}%",
+        f"- VIX: {overview['vix']:.2f}",
+        f"- Sentiment: {overview['sentiment']}",
+        "",
+        f"### Allocazione del Portafoglio ({allocation['risk_profile']})",
+    ]
+    for asset, value in allocation["allocation"].items():
+        pct = allocation["allocation_percentages"][asset] * 100
+        lines.append(f"- {ASSET_LABELS.get(asset, asset)} ({pct:.0f}%): €{value:,.2f}")
+
+    lines += ["", "### Settori Analizzati"]
+    for sector, analysis in recommendation["sectors"].items():
+        lines.append(
+            f"- {sector}: YTD {analysis['ytd_performance']:+.2f}%, trend {analysis['trend']}, "
+            f"volatilità {analysis['volatility']}"
+        )
+
+    lines += ["", "### Raccomandazioni"]
+    for p in recommendation["positions"]:
+        lines.append(
+            f"- {p['ticker']}: €{p['amount']:,.2f} — prezzo €{p['price']:.2f} ({p['change_percent']:+.2f}%), "
+            f"settore {p['sector']}"
+        )
+
+    stock_sectors = sorted({p["sector"] for p in recommendation["positions"] if p["sector"] != "Bonds"})
+    lines += [
+        "",
+        "### Conclusione",
+        f"Per un profilo {allocation['risk_profile']} la quota azionaria è concentrata nei settori "
+        f"con il miglior rapporto tra performance, trend e volatilità ({', '.join(stock_sectors) or 'n/d'}), "
+        f"mentre la componente obbligazionaria è coperta da {BOND_ETF}.",
+    ]
+    return "\n".join(lines)
+
+
+NARRATIVE_SYSTEM_PROMPT = (
+    "Sei un consulente di investimento. Ricevi una raccomandazione già calcolata in JSON: "
+    "scrivi un report in italiano in markdown con le sezioni Panoramica del Mercato, "
+    "Allocazione del Portafoglio, Raccomandazioni (una riga per ticker nel formato 'TICKER: €importo') "
+    "e '### Conclusione'. Non modificare numeri, ticker o importi."
+)
+
+
+def render_llm_narrative(recommendation: dict) -> str:
+    """Scrive il report con una singola chiamata al modello (nessun tool)."""
+    from investment_agent import get_model, OPENAI_WRITER_MODEL
+    from model_metrics import model_metrics
+    from llm_scheduler import get_scheduler, LLM_SCHEDULER_ENABLED
+
+    t0 = time.perf_counter()
+    messages = [
+        SystemMessage(content=NARRATIVE_SYSTEM_PROMPT),
+        HumanMessage(content=json.dumps(recommendation, ensure_ascii=False)),
+    ]
+    if LLM_SCHEDULER_ENABLED:
+        response = get_scheduler().call(get_model("writer").invoke, messages)
+    else:
+        response = get_model("writer").invoke(messages)
+    model_metrics.record("fast_path_narrative", OPENAI_WRITER_MODEL, time.perf_counter() - t0, response)
+    return response.content
+
+
+# ------------ Entry Point ------------
+
+def run_fast_path(amount: float, risk_profile: str, narrative: str = FAST_PATH_NARRATIVE) -> dict:
+    """Esegue il fast path e restituisce uno stato finale compatibile con quello del grafo.
+
+    Args:
+        amount: Importo da investire
+        risk_profile: conservative, moderate, aggressive
+        narrative: "template" oppure "llm"
+    """
+    from investment_agent import build_initial_state
+
+    t0 = time.perf_counter()
+    recommendation = build_recommendation(amount, risk_profile)
+    if narrative == "llm":
+        content = render_llm_narrative(recommendation)
+    else:
+        content = render_template_narrative(recommendation)
+
+    state = build_initial_state(amount, risk_profile)
+    state["messages"] = list(state["messages"]) + [AIMessage(content=content)]
+    state.update({
+        "recommendations": [position_record(p) for p in recommendation["positions"]],
+        "market_data": {
+            "overview": overview_record(recommendation["market_overview"]),
+            "sectors": {name: sector_record(s) for name, s in recommendation["sectors"].items()},
+            "allocation": allocation_record(recommendation["allocation"]),
+            "quotes": {
+                p["ticker"]: QuoteRecord(
+                    symbol=p["ticker"],
+                    price=p["price"],
+                    change_percent=p["change_percent"],
+                    volume=p["volume"],
+                )
+                for p in recommendation["positions"]
+            },
+            "snapshot_version": recommendation["snapshot_version"],
+        },
+        "rationale": f"Fast path a regole ({narrative}) in {(time.perf_counter() - t0) * 1000:.1f} ms",
+        "next_action": "complete",
+        "engine": "fast_path",
+    })
+    return state
@@ -4,17 +4,32 @@ Suggerisce investimenti basati su dati di mercato in tempo reale
 """
 import os
 import sys
-from typing import TypedDict, Annotated, Sequence
-from operator import add
+import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError, wait
+from typing import TypedDict, Annotated, Sequence, Optional
 
 from dotenv import load_dotenv
 from langchain_openai import ChatOpenAI
-from langchain_core.messages import BaseMessage, HumanMessage, AIMessage
+from langchain_core.messages import BaseMessage, HumanMessage, AIMessage, ToolMessage
 from langchain_core.tools import tool
+from langchain_core.runnables import RunnableConfig
+from pydantic import ValidationError
 
 from langgraph.graph import StateGraph, END
-from langgraph.prebuilt import ToolNode
-from langgraph.checkpoint.memory import MemorySaver
+from langgraph.channels.delta import DeltaChannel
+
+from model_metrics import model_metrics
+from llm_scheduler import get_scheduler, LLM_SCHEDULER_ENABLED, DEFAULT_PRIORITY
+from speculation import SpeculativeExecutor, SPECULATIVE_TOOLS
+from prompts import build_messages
+from market_sim import get_market, TICKER_SECTORS
+from sector_subgraph import run_sector_analysis
+from market_data import (
+    MarketData, merge_market_data, merge_market_data_batch, market_data_update, positions_from_answer,
+)
+from checkpointing import CompactMemorySaver, append_items, format_session_report, CHECKPOINT_SNAPSHOT_EVERY
 
 # Carica configurazione
 env_path = os.path.join(os.path.dirname(__file__), '.env')
@@ -23,31 +38,80 @@ load_dotenv(dotenv_path=env_path)
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
 
-if not OPENAI_API_KEY:
-    raise RuntimeError("Devi impostare OPENAI_API_KEY nel file .env")
+# Tiering dei modelli: router per i turni di sola selezione dei tools,
+# writer per la risposta finale (e come escalation se il router sbaglia)
+OPENAI_ROUTER_MODEL = os.getenv("OPENAI_ROUTER_MODEL", OPENAI_MODEL)
+OPENAI_WRITER_MODEL = os.getenv("OPENAI_WRITER_MODEL", OPENAI_MODEL)
+
+MODEL_ROLES = {
+    "router": OPENAI_ROUTER_MODEL,
+    "writer": OPENAI_WRITER_MODEL,
+}
+
+# Con modelli distinti il router non scrive mai la risposta finale: è obbligato a chiamare
+# un tool (o `ready_to_answer`) e i suoi token di output sono limitati
+ROUTER_TIERING = OPENAI_ROUTER_MODEL != OPENAI_WRITER_MODEL
+ROUTER_MAX_TOKENS = int(os.getenv("ROUTER_MAX_TOKENS", "512"))
+
+# Modalità di default: auto (fast path se la richiesta è standard), agent, fast
+ADVISORY_MODE = os.getenv("ADVISORY_MODE", "auto")
+
+# Budget per richiesta: deadline complessiva, numero massimo di turni del modello,
+# timeout per singola chiamata al modello e per singolo tool (secondi)
+REQUEST_DEADLINE_SECONDS = float(os.getenv("REQUEST_DEADLINE_SECONDS", "120"))
+STEP_BUDGET = int(os.getenv("STEP_BUDGET", "10"))
+LLM_TIMEOUT_SECONDS = float(os.getenv("LLM_TIMEOUT_SECONDS", "45"))
+TOOL_TIMEOUT_SECONDS = float(os.getenv("TOOL_TIMEOUT_SECONDS", "10"))
 
 # Configura il modello
 import httpx
 http_client = httpx.Client(verify=False) if os.getenv("SSL_VERIFY", "true").lower() == "false" else None
 
-model = ChatOpenAI(
-    model=OPENAI_MODEL,
-    temperature=0.2,  # Leggermente creativo ma preciso
-    http_client=http_client,
-)
+_models = {}
+
+
+def get_model(role: str = "writer") -> ChatOpenAI:
+    """Restituisce il modello per il ruolo indicato, creandolo al primo utilizzo.
+    
+    La creazione è differita così il fast path senza LLM non richiede la API key.
+    
+    Args:
+        role: "router" (selezione dei tools) o "writer" (risposta finale)
+    """
+    if role not in _models:
+        if not OPENAI_API_KEY:
+            raise RuntimeError("Devi impostare OPENAI_API_KEY nel file .env")
+        _models[role] = ChatOpenAI(
+            model=MODEL_ROLES[role],
+            temperature=0.2,  # Leggermente creativo ma preciso
+            http_client=http_client,
+            timeout=LLM_TIMEOUT_SECONDS,
+            max_tokens=ROUTER_MAX_TOKENS if role == "router" and ROUTER_TIERING else None,
+            # Con lo scheduler i retry (429 ed errori transitori) sono suoi, entro la deadline
+            max_retries=0 if LLM_SCHEDULER_ENABLED else 1,
+        )
+    return _models[role]
 
 
 # ------------ Stato dell'Agente ------------
 
 class InvestmentAgentState(TypedDict):
     """Stato dell'agente di investimento."""
-    messages: Annotated[Sequence[BaseMessage], add]
+    # I canali che crescono per accumulo salvano nei checkpoint solo le scritture (delta)
+    messages: Annotated[Sequence[BaseMessage], DeltaChannel(append_items, snapshot_frequency=CHECKPOINT_SNAPSHOT_EVERY)]
     investment_amount: float
     risk_profile: str  # conservative, moderate, aggressive
     recommendations: list
-    market_data: dict
+    market_data: Annotated[MarketData, DeltaChannel(merge_market_data_batch, snapshot_frequency=CHECKPOINT_SNAPSHOT_EVERY)]  # risultati tipizzati dei tools
     rationale: str
     next_action: str
+    deadline: float  # timestamp epoch oltre il quale si finalizza con i dati disponibili
+    step_budget: int  # numero massimo di turni del nodo agent
+    steps: int
+    degraded: bool  # True se il risultato è parziale (budget esaurito o timeout)
+    degraded_reason: str
+    token_usage: dict  # token di prompt (cached/uncached) e di output delle chiamate al modello
+    trace: Annotated[list, DeltaChannel(append_items, snapshot_frequency=CHECKPOINT_SNAPSHOT_EVERY)]  # visite ai nodi con latenza
 
 
 # ------------ Tools per Alpha Vantage (Placeholder per MCP) ------------
@@ -63,31 +127,8 @@ def get_stock_quote(symbol: str) -> dict:
         Dizionario con prezzo, variazione, volume
     """
     # TODO: Integrare con MCP Alpha Vantage
-    # Per ora ritorna dati mock
-    import random
-    base_prices = {
-        "AAPL": 180.0,
-        "MSFT": 380.0,
-        "GOOGL": 140.0,
-        "AMZN": 150.0,
-        "TSLA": 250.0,
-        "NVDA": 500.0,
-        "SPY": 450.0,  # S&P 500 ETF
-        "QQQ": 380.0,  # NASDAQ ETF
-        "VTI": 240.0,  # Total Market ETF
-        "BND": 75.0,   # Bond ETF
-    }
-    
-    price = base_prices.get(symbol.upper(), 100.0)
-    change_pct = random.uniform(-3.0, 3.0)
-    
-    return {
-        "symbol": symbol.upper(),
-        "price": round(price * (1 + change_pct/100), 2),
-        "change_percent": round(change_pct, 2),
-        "volume": random.randint(1000000, 50000000),
-        "market_cap": f"${random.randint(100, 3000)}B"
-    }
+    # Per ora i dati arrivano dal simulatore di mercato locale
+    return get_market().quote(symbol)
 
 
 @tool
@@ -98,16 +139,7 @@ def get_market_overview() -> dict:
         Dati su indici principali, sentiment, volatilità
     """
     # TODO: Integrare con MCP Alpha Vantage
-    import random
-    
-    return {
-        "sp500_change": round(random.uniform(-1.5, 1.5), 2),
-        "nasdaq_change": round(random.uniform(-2.0, 2.0), 2),
-        "dow_change": round(random.uniform(-1.0, 1.0), 2),
-        "vix": round(random.uniform(12.0, 25.0), 2),
-        "sentiment": random.choice(["bullish", "neutral", "bearish"]),
-        "sector_leaders": ["Technology", "Healthcare", "Financials"]
-    }
+    return get_market().overview()
 
 
 @tool
@@ -121,23 +153,24 @@ def analyze_sector_performance(sector: str) -> dict:
         Performance del settore e top titoli
     """
     # TODO: Integrare con MCP Alpha Vantage
-    import random
-    
-    top_stocks = {
-        "Technology": ["AAPL", "MSFT", "NVDA", "GOOGL"],
-        "Healthcare": ["JNJ", "UNH", "PFE", "ABBV"],
-        "Energy": ["XOM", "CVX", "COP", "SLB"],
-        "Financials": ["JPM", "BAC", "WFC", "GS"],
-        "Consumer": ["AMZN", "TSLA", "NKE", "MCD"]
-    }
+    return get_market().sector(sector)
+
+
+@tool
+def analyze_sectors(risk_profile: str = "moderate", sectors: Optional[list[str]] = None) -> dict:
+    """Confronta più settori in una sola chiamata e restituisce una classifica compatta.
     
-    return {
-        "sector": sector,
-        "ytd_performance": round(random.uniform(-10.0, 30.0), 2),
-        "trend": random.choice(["upward", "stable", "downward"]),
-        "top_stocks": top_stocks.get(sector, ["N/A"]),
-        "volatility": random.choice(["low", "medium", "high"])
-    }
+    Per ogni settore: punteggio, performance YTD, trend, volatilità e
+    quotazioni dei titoli principali, analizzati in parallelo.
+    
+    Args:
+        risk_profile: conservative, moderate, aggressive (pesa la volatilità nel punteggio)
+        sectors: Settori da confrontare (default: tutti i settori disponibili)
+        
+    Returns:
+        Settori ordinati per punteggio con i top titoli già quotati
+    """
+    return run_sector_analysis(sectors, risk_profile)
 
 
 @tool
@@ -190,55 +223,458 @@ tools = [
     get_stock_quote,
     get_market_overview,
     analyze_sector_performance,
+    analyze_sectors,
     calculate_portfolio_allocation
 ]
+tools_by_name = {t.name: t for t in tools}
+
+
+@tool
+def ready_to_answer() -> str:
+    """Segnala che i dati raccolti bastano per la risposta finale, che sarà scritta da un altro modello.
+    
+    Chiamalo da solo, senza altri tools e senza scrivere la risposta.
+    """
+    return ""
+
+
+# Tool riservato al router: non viene mai eseguito
+FINISH_TOOL = ready_to_answer.name
+
+
+# ------------ Esecuzione dei Tools ------------
+
+# Pool condiviso dal processo: evita di ricreare thread ad ogni passo del grafo
+_tool_pool = ThreadPoolExecutor(max_workers=int(os.getenv("TOOL_CONCURRENCY", "16")), thread_name_prefix="tool")
+
+# Cache dei risultati dei tools (disabilitata di default, TTL in secondi).
+# I worker batch la abilitano per riusare i dati di mercato tra job consecutivi.
+_tool_cache: dict = {}
+_tool_cache_lock = threading.Lock()
+_tool_cache_ttl = float(os.getenv("TOOL_CACHE_TTL", "0"))
+
+
+def enable_tool_cache(ttl_seconds: float):
+    """Abilita (ttl > 0) o disabilita (ttl = 0) la cache dei risultati dei tools."""
+    global _tool_cache_ttl
+    _tool_cache_ttl = float(ttl_seconds)
+    with _tool_cache_lock:
+        _tool_cache.clear()
+
+
+def _tool_cache_key(name: str, args: dict) -> tuple:
+    return (name, json.dumps(args, sort_keys=True, default=str))
+
+
+def _run_tool(name: str, args: dict):
+    """Esegue un tool consultando la cache, se abilitata."""
+    if _tool_cache_ttl <= 0:
+        return tools_by_name[name].invoke(args)
+    
+    key = _tool_cache_key(name, args)
+    now = time.monotonic()
+    with _tool_cache_lock:
+        hit = _tool_cache.get(key)
+    if hit is not None and hit[0] > now:
+        return hit[1]
+    
+    result = tools_by_name[name].invoke(args)
+    with _tool_cache_lock:
+        _tool_cache[key] = (now + _tool_cache_ttl, result)
+    return result
+
+
+def _format_tool_output(output) -> str:
+    """Serializza l'output di un tool come fa ToolNode di LangGraph."""
+    if isinstance(output, str):
+        return output
+    try:
+        return json.dumps(output, ensure_ascii=False)
+    except TypeError:
+        return str(output)
+
+
+def _execute_tool_call(tool_call: dict, session_id: str = None, cassette=None) -> tuple:
+    """Esegue una singola tool call e la converte in ToolMessage.
+    
+    Se la chiamata era stata anticipata dall'esecutore speculativo,
+    il risultato già calcolato viene consegnato senza rieseguire il tool.
+    Con una cassetta in riproduzione l'output registrato sostituisce il tool.
+    
+    Returns:
+        (ToolMessage, output grezzo del tool oppure None in caso di errore)
+    """
+    name = tool_call["name"]
+    
+    if name not in tools_by_name:
+        return ToolMessage(
+            content=f"Error: {name} is not a valid tool, try one of [{', '.join(tools_by_name)}].",
+            name=name,
+            tool_call_id=tool_call["id"],
+            status="error",
+        ), None
+    
+    try:
+        t0 = time.perf_counter()
+        if cassette is not None and cassette.replaying:
+            output = cassette.replay_tool(name, tool_call["args"])
+        else:
+            hit = False
+            if session_id is not None:
+                hit, output = speculator.take(session_id, name, tool_call["args"])
+            if not hit:
+                output = _run_tool(name, tool_call["args"])
+            if cassette is not None:
+                cassette.record_tool(name, tool_call["args"], time.perf_counter() - t0, output)
+    except Exception as e:
+        return ToolMessage(
+            content=f"Error: {e!r}\n Please fix your mistakes.",
+            name=name,
+            tool_call_id=tool_call["id"],
+            status="error",
+        ), None
+    
+    return ToolMessage(
+        content=_format_tool_output(output),
+        name=name,
+        tool_call_id=tool_call["id"],
+    ), output
+
+
+# Esecutore speculativo: anticipa le tool calls prevedibili durante la chiamata al modello
+speculator = SpeculativeExecutor(_run_tool)
+
+
+def _model_override(config: RunnableConfig):
+    """Modello alternativo per la sessione (es. modello fittizio nei load test), se presente."""
+    return (config or {}).get("configurable", {}).get("model_override")
+
+
+def _cassette(config: RunnableConfig):
+    """Cassetta di registrazione/riproduzione della sessione, se presente."""
+    return (config or {}).get("configurable", {}).get("cassette")
+
+
+def _priority(config: RunnableConfig) -> str:
+    """Classe di priorità delle chiamate al modello: "interactive" (default) o "batch"."""
+    return (config or {}).get("configurable", {}).get("priority", DEFAULT_PRIORITY)
+
+
+def _session_id(config: RunnableConfig):
+    """Identificativo della sessione per la speculazione (None se disabilitata).
+    
+    In riproduzione la speculazione è disattivata: i tools sono serviti dalla cassetta.
+    """
+    if not SPECULATIVE_TOOLS:
+        return None
+    cassette = _cassette(config)
+    if cassette is not None and cassette.replaying:
+        return None
+    return (config or {}).get("configurable", {}).get("thread_id")
 
 
 # ------------ Nodi del Grafo ------------
 
-def agent_node(state: InvestmentAgentState) -> InvestmentAgentState:
-    """Nodo dell'agente: decide quali tools usare per analizzare."""
+_bound_models = {}
+
+
+def _bound_tools() -> list:
+    """Tools collegati a entrambi i ruoli: stesso schema, quindi stesso prefisso cacheabile."""
+    return tools + [ready_to_answer] if ROUTER_TIERING else tools
+
+
+def _get_model_with_tools(role: str):
+    """Modello del ruolo con i tools collegati e chiamate parallele abilitate.
+    
+    Con il tiering attivo il router deve sempre chiamare un tool: per passare la mano
+    al writer usa `ready_to_answer` invece di scrivere una risposta che andrebbe scartata.
+    """
+    if role not in _bound_models:
+        if role == "router" and ROUTER_TIERING:
+            _bound_models[role] = get_model(role).bind_tools(
+                _bound_tools(), parallel_tool_calls=True, tool_choice="required",
+            )
+        else:
+            _bound_models[role] = get_model(role).bind_tools(_bound_tools(), parallel_tool_calls=True)
+    return _bound_models[role]
+
+
+def _without_finish_calls(response):
+    """Toglie le chiamate a `ready_to_answer`, che non vanno mai eseguite né salvate."""
+    if not any(call["name"] == FINISH_TOOL for call in response.tool_calls):
+        return response
+    data_calls = [call for call in response.tool_calls if call["name"] != FINISH_TOOL]
+    return response.model_copy(update={"tool_calls": data_calls})
+
+
+# Pool per le chiamate al modello, così il timeout vale per qualunque provider
+_llm_pool = ThreadPoolExecutor(max_workers=int(os.getenv("LLM_CONCURRENCY", "32")), thread_name_prefix="llm")
+
+
+def _remaining_seconds(state: InvestmentAgentState) -> float:
+    deadline = state.get("deadline")
+    if not deadline:
+        return float("inf")
+    return deadline - time.time()
+
+
+def _budget_exhausted(state: InvestmentAgentState):
+    """Motivo per cui la richiesta deve essere finalizzata, o None se c'è ancora budget."""
+    if _remaining_seconds(state) <= 0:
+        return "deadline superata"
+    if state.get("step_budget") and state.get("steps", 0) >= state["step_budget"]:
+        return f"budget di {state['step_budget']} passi esaurito"
+    return None
+
+
+def _invoke_model(role: str, tier: str, messages, timeout: float = LLM_TIMEOUT_SECONDS,
+                  cassette=None, model_override=None, priority: str = DEFAULT_PRIORITY,
+                  session: str = ""):
+    """Invoca il modello del ruolo registrando latenza e token sotto `tier`.
+    
+    Solleva TimeoutError se la risposta non arriva entro `timeout` secondi.
+    Con una cassetta la chiamata viene registrata o riprodotta; `model_override`
+    sostituisce il modello configurato (deve esporre `invoke(messages)`).
+    Le chiamate al provider passano dallo scheduler di ammissione globale
+    (budget RPM/TPM, priorità e retry sui 429); il timeout include l'attesa in coda.
+    """
+    t0 = time.perf_counter()
+    replaying = cassette is not None and cassette.replaying
+    try:
+        if replaying or not LLM_SCHEDULER_ENABLED:
+            if replaying:
+                future = _llm_pool.submit(cassette.replay_model, tier, messages)
+            elif model_override is not None:
+                future = _llm_pool.submit(model_override.invoke, messages)
+            else:
+                future = _llm_pool.submit(_get_model_with_tools(role).invoke, messages)
+            try:
+                response = future.result(timeout=timeout)
+            except FutureTimeoutError:
+                future.cancel()
+                raise TimeoutError(f"timeout del modello {MODEL_ROLES[role]} dopo {timeout:.1f}s")
+        else:
+            invoke = model_override.invoke if model_override is not None else _get_model_with_tools(role).invoke
+            response = get_scheduler().call(invoke, messages, priority, session, timeout, _llm_pool)
+    except TimeoutError:
+        model_metrics.record(f"{tier}_timeout", MODEL_ROLES[role], time.perf_counter() - t0)
+        raise
+    latency = time.perf_counter() - t0
+    model_metrics.record(tier, MODEL_ROLES[role], latency, response)
+    if cassette is not None and cassette.recording:
+        cassette.record_model(tier, messages, latency, response)
+    return response
+
+
+def _add_usage(total: dict, response) -> dict:
+    """Somma i token di una risposta al totale della sessione."""
+    usage = getattr(response, "usage_metadata", None) or {}
+    cached = (usage.get("input_token_details") or {}).get("cache_read", 0)
+    input_tokens = usage.get("input_tokens", 0)
+    return {
+        "calls": total.get("calls", 0) + 1,
+        "input_tokens": total.get("input_tokens", 0) + input_tokens,
+        "cached_input_tokens": total.get("cached_input_tokens", 0) + cached,
+        "uncached_input_tokens": total.get("uncached_input_tokens", 0) + input_tokens - cached,
+        "output_tokens": total.get("output_tokens", 0) + usage.get("output_tokens", 0),
+    }
+
+
+def _has_valid_tool_calls(response) -> bool:
+    """Verifica che le tool calls esistano e che gli argomenti rispettino lo schema."""
+    if getattr(response, "invalid_tool_calls", None):
+        return False
+    for call in response.tool_calls:
+        tool_fn = tools_by_name.get(call["name"])
+        if tool_fn is None:
+            return False
+        try:
+            tool_fn.args_schema.model_validate(call["args"])
+        except ValidationError:
+            return False
+    return True
+
+
+def agent_node(state: InvestmentAgentState, config: RunnableConfig) -> InvestmentAgentState:
+    """Nodo dell'agente: decide quali tools usare per analizzare.
+    
+    Il router (modello economico) gestisce i turni di selezione dei tools;
+    se produce tool calls non valide si passa al writer. Quando il router
+    chiama `ready_to_answer` (o non chiede altri tools) la risposta finale
+    è scritta dal writer; la risposta del router non entra nei messaggi.
+    """
     messages = state["messages"]
     
-    model_with_tools = model.bind_tools(tools)
-    response = model_with_tools.invoke(messages)
+    reason = _budget_exhausted(state)
+    if reason:
+        return {"degraded": True, "degraded_reason": reason}
+    
+    session_id = _session_id(config)
+    if session_id is not None:
+        speculator.launch(session_id, state)
+    
+    cassette = _cassette(config)
+    override = _model_override(config)
+    priority = _priority(config)
+    thread_id = (config or {}).get("configurable", {}).get("thread_id", "")
+    steps = state.get("steps", 0) + 1
+    timeout = min(LLM_TIMEOUT_SECONDS, _remaining_seconds(state))
+    
+    usage = state.get("token_usage") or {}
+    
+    try:
+        response = _invoke_model("router", "router", messages, timeout, cassette, override,
+                                 priority, thread_id)
+        usage = _add_usage(usage, response)
+        
+        # `ready_to_answer` insieme ad altri tools è prematuro: si eseguono i tools richiesti
+        finished = bool(response.tool_calls)
+        response = _without_finish_calls(response)
+        finished = finished and not response.tool_calls
+        
+        escalate_tier = None
+        if finished:
+            escalate_tier = "writer"
+        elif response.tool_calls:
+            if not _has_valid_tool_calls(response):
+                escalate_tier = "writer_escalation"
+        elif getattr(response, "invalid_tool_calls", None):
+            escalate_tier = "writer_escalation"
+        elif ROUTER_TIERING:
+            escalate_tier = "writer"
+        
+        if escalate_tier:
+            timeout = min(LLM_TIMEOUT_SECONDS, _remaining_seconds(state))
+            response = _invoke_model("writer", escalate_tier, messages, timeout, cassette, override,
+                                     priority, thread_id)
+            usage = _add_usage(usage, response)
+            response = _without_finish_calls(response)
+    except TimeoutError as e:
+        return {"steps": steps, "token_usage": usage, "degraded": True, "degraded_reason": str(e)}
     
     return {
-        **state,
-        "messages": [response]
+        "messages": [response],
+        "steps": steps,
+        "token_usage": usage,
     }
 
 
-def tool_node(state: InvestmentAgentState) -> InvestmentAgentState:
-    """Esegue i tools richiesti dall'agente."""
-    tool_executor = ToolNode(tools)
-    result = tool_executor.invoke(state)
-    return result
+def tool_node(state: InvestmentAgentState, config: RunnableConfig) -> InvestmentAgentState:
+    """Esegue i tools richiesti dall'agente (in parallelo, con timeout)."""
+    tool_calls = state["messages"][-1].tool_calls
+    session_id = _session_id(config)
+    timeout = max(0.0, min(TOOL_TIMEOUT_SECONDS, _remaining_seconds(state)))
+    
+    cassette = _cassette(config)
+    futures = [_tool_pool.submit(_execute_tool_call, call, session_id, cassette) for call in tool_calls]
+    wait(futures, timeout=timeout)
+    
+    tool_messages = []
+    market_data = {}
+    timed_out = []
+    try:
+        for call, future in zip(tool_calls, futures):
+            if future.done():
+                message, output = future.result()
+                tool_messages.append(message)
+                market_data = merge_market_data(market_data, market_data_update(call["name"], output))
+            else:
+                future.cancel()
+                timed_out.append(call["name"])
+                tool_messages.append(ToolMessage(
+                    content=f"Error: timeout dopo {timeout:.1f}s, dati non disponibili.",
+                    name=call["name"],
+                    tool_call_id=call["id"],
+                    status="error",
+                ))
+    finally:
+        # Le speculazioni non richieste dal modello vengono scartate
+        if session_id is not None:
+            speculator.discard(session_id)
+    
+    update = {"messages": tool_messages, "market_data": market_data}
+    if timed_out:
+        update["degraded"] = True
+        update["degraded_reason"] = f"timeout dei tools: {', '.join(timed_out)}"
+    return update
 
 
 def should_continue(state: InvestmentAgentState) -> str:
-    """Decide se continuare con tools o finalizzare."""
+    """Decide se continuare con tools o finalizzare.
+    
+    Con budget esaurito si passa a finalize anche se il modello chiede altri tools.
+    """
     messages = state["messages"]
     last_message = messages[-1]
     
     if hasattr(last_message, "tool_calls") and last_message.tool_calls:
+        if _budget_exhausted(state):
+            return "finalize"
         return "tools"
     
     return "finalize"
 
 
-def finalize_recommendations(state: InvestmentAgentState) -> InvestmentAgentState:
+def _degraded_summary(state: InvestmentAgentState) -> str:
+    """Riepilogo dei dati raccolti quando manca la risposta finale del modello."""
+    data = state.get("market_data") or {}
+    lines = [
+        f"⚠️ Analisi parziale ({state.get('degraded_reason') or 'budget esaurito'}).",
+        "Di seguito i dati raccolti finora, senza raccomandazione finale del modello.",
+        "",
+    ]
+    overview = data.get("overview")
+    if overview:
+        lines += [
+            "### Panoramica del Mercato",
+            f"- S&P 500: {overview['sp500_change']:+.2f}%",
+            f"- NASDAQ: {overview['nasdaq_change']:+.2f}%",
+            f"- VIX: {overview['vix']:.2f}",
+            f"- Sentiment: {overview['sentiment']}",
+            "",
+        ]
+    allocation = data.get("allocation")
+    if allocation:
+        lines.append(f"### Allocazione ({allocation['risk_profile']})")
+        lines += [f"- {asset}: €{value:,.2f}" for asset, value in allocation["allocation"].items()]
+        lines.append("")
+    for sector in (data.get("sectors") or {}).values():
+        lines.append(
+            f"- Settore {sector['sector']}: YTD {sector['ytd_performance']:+.2f}%, trend {sector['trend']}, "
+            f"top: {', '.join(sector['top_stocks'])}"
+        )
+    for quote in (data.get("quotes") or {}).values():
+        lines.append(f"- {quote['symbol']}: €{quote['price']:.2f} ({quote['change_percent']:+.2f}%)")
+    return "\n".join(lines)
+
+
+def finalize_recommendations(state: InvestmentAgentState, config: RunnableConfig) -> InvestmentAgentState:
     """Finalizza le raccomandazioni di investimento."""
     messages = state["messages"]
     
-    # Estrai le raccomandazioni dai messaggi
-    recommendations = []
-    market_data = {}
+    # Speculazioni avviate durante l'ultimo turno del modello: non più utili
+    session_id = _session_id(config)
+    if session_id is not None:
+        speculator.discard(session_id)
     
-    for msg in messages:
-        if hasattr(msg, "content") and isinstance(msg.content, str):
-            if "recommendation" in msg.content.lower() or "invest" in msg.content.lower():
-                recommendations.append(msg.content)
+    # Senza risposta finale del modello (budget esaurito) si restituiscono i dati raccolti
+    last_message = messages[-1]
+    degraded = state.get("degraded", False)
+    degraded_reason = state.get("degraded_reason", "")
+    new_messages = []
+    if not isinstance(last_message, AIMessage) or last_message.tool_calls:
+        degraded = True
+        degraded_reason = degraded_reason or _budget_exhausted(state) or "risposta finale mancante"
+        summary = AIMessage(content=_degraded_summary({**state, "degraded_reason": degraded_reason}))
+        new_messages.append(summary)
+    
+    # Posizioni strutturate estratte una sola volta dalla risposta finale del modello;
+    # il riepilogo dei dati raccolti non contiene raccomandazioni
+    recommendations = []
+    if not new_messages and isinstance(last_message.content, str):
+        recommendations = positions_from_answer(
+            last_message.content, state.get("market_data"), state["investment_amount"], TICKER_SECTORS,
+        )
     
     # Genera un rationale finale
     rationale = """
@@ -249,24 +685,44 @@ def finalize_recommendations(state: InvestmentAgentState) -> InvestmentAgentStat
     - Diversificazione ottimale del portafoglio
     """
     
+    if degraded:
+        rationale += f"""
+    ⚠️ Risultato parziale: {degraded_reason}
+    """
+    
     return {
-        **state,
+        "messages": new_messages,
         "recommendations": recommendations,
         "rationale": rationale,
-        "next_action": "complete"
+        "next_action": "complete",
+        "degraded": degraded,
+        "degraded_reason": degraded_reason,
     }
 
 
 # ------------ Costruzione del Grafo ------------
 
+def _traced(name: str, node):
+    """Aggiunge all'aggiornamento del nodo la sua visita nella traccia di esecuzione."""
+    def traced_node(state: InvestmentAgentState, config: RunnableConfig) -> InvestmentAgentState:
+        started_at = time.time()
+        t0 = time.perf_counter()
+        update = node(state, config)
+        visit = {"node": name, "started_at": started_at, "latency_s": time.perf_counter() - t0}
+        return {**update, "trace": [visit]}
+    
+    traced_node.__name__ = name
+    return traced_node
+
+
 def create_investment_agent():
     """Crea il grafo dell'agente di investimento."""
     workflow = StateGraph(InvestmentAgentState)
     
     # Aggiungi nodi
-    workflow.add_node("agent", agent_node)
-    workflow.add_node("tools", tool_node)
-    workflow.add_node("finalize", finalize_recommendations)
+    workflow.add_node("agent", _traced("agent", agent_node))
+    workflow.add_node("tools", _traced("tools", tool_node))
+    workflow.add_node("finalize", _traced("finalize", finalize_recommendations))
     
     # Set entry point
     workflow.set_entry_point("agent")
@@ -285,7 +741,7 @@ def create_investment_agent():
     workflow.add_edge("finalize", END)
     
     # Compila
-    memory = MemorySaver()
+    memory = CompactMemorySaver()
     app = workflow.compile(checkpointer=memory)
     
     return app
@@ -293,64 +749,157 @@ def create_investment_agent():
 
 # ------------ Funzione Principale ------------
 
-def get_investment_advice(amount: float, risk_profile: str = "moderate"):
-    """Ottiene consigli di investimento dall'agente.
+def build_initial_state(amount: float, risk_profile: str,
+                        deadline_seconds: float = REQUEST_DEADLINE_SECONDS,
+                        step_budget: int = STEP_BUDGET) -> InvestmentAgentState:
+    """Costruisce lo stato iniziale del grafo per una richiesta di consulenza.
     
     Args:
         amount: Importo da investire
         risk_profile: conservative, moderate, aggressive
+        deadline_seconds: Tempo massimo per la richiesta (0 = nessuna deadline)
+        step_budget: Numero massimo di turni del modello (0 = illimitato)
     """
-    agent_app = create_investment_agent()
-    
-    # Messaggio iniziale
-    initial_message = HumanMessage(
-        content=f"""Sono un investitore con €{amount:,.2f} da investire.
-        
-Il mio profilo di rischio è: {risk_profile}
-
-Per favore:
-1. Analizza la situazione attuale del mercato usando get_market_overview
-2. Calcola l'allocazione ottimale del portafoglio con calculate_portfolio_allocation
-3. Analizza i settori più promettenti con analyze_sector_performance
-4. Ottieni quotazioni di titoli specifici usando get_stock_quote per i top picks
-5. Fornisci raccomandazioni dettagliate con razionale
-
-Sii specifico e fornisci ticker, percentuali di allocazione, e giustificazioni."""
-    )
-    
-    initial_state = {
-        "messages": [initial_message],
+    return {
+        "messages": build_messages(amount, risk_profile),
         "investment_amount": amount,
         "risk_profile": risk_profile,
         "recommendations": [],
         "market_data": {},
         "rationale": "",
-        "next_action": "start"
+        "next_action": "start",
+        "deadline": time.time() + deadline_seconds if deadline_seconds else 0.0,
+        "step_budget": step_budget,
+        "steps": 0,
+        "degraded": False,
+        "degraded_reason": "",
+        "token_usage": {},
+        "trace": [],
     }
     
+
+
+def extract_final_answer(final_state: dict) -> str:
+    """Restituisce il testo dell'ultima risposta dell'agente senza tool calls."""
+    for msg in reversed(final_state.get("messages", [])):
+        if isinstance(msg, AIMessage) and not (hasattr(msg, "tool_calls") and msg.tool_calls):
+            return msg.content
+    return ""
+
+
+def run_advisory(amount: float, risk_profile: str, mode: str = ADVISORY_MODE,
+                 thread_id: str = "investment_session", agent_app=None,
+                 custom_request: str = "", archive: bool = None, cassette=None,
+                 model_override=None, priority: str = DEFAULT_PRIORITY) -> dict:
+    """Esegue una consulenza scegliendo tra grafo completo e fast path a regole.
+    
+    Args:
+        amount: Importo da investire
+        risk_profile: conservative, moderate, aggressive
+        mode: "auto" (fast path se la richiesta è standard), "agent" o "fast"
+        thread_id: Identificativo della sessione per il checkpointer
+        agent_app: Grafo già compilato da riusare (opzionale)
+        custom_request: Richieste aggiuntive in linguaggio naturale
+        archive: Salva il risultato nell'archivio storico (default: ARCHIVE_ENABLED)
+        cassette: Cassetta per registrare o riprodurre la sessione (forza il grafo completo)
+        model_override: Modello da usare al posto di quelli configurati (es. load test)
+        priority: Classe di priorità per lo scheduler LLM ("interactive" o "batch")
+    """
+    from archive import ARCHIVE_ENABLED
+    from fast_path import run_fast_path, is_standard_request
+    
+    if archive is None:
+        archive = ARCHIVE_ENABLED
+    
+    t0 = time.perf_counter()
+    if cassette is not None:
+        mode = "agent"
+    
+    if mode == "fast" or (mode == "auto" and is_standard_request(amount, risk_profile, custom_request)):
+        final_state = run_fast_path(amount, risk_profile)
+    else:
+        if agent_app is None:
+            agent_app = create_investment_agent()
+        initial_state = build_initial_state(amount, risk_profile)
+        if custom_request:
+            initial_state["messages"].append(HumanMessage(content=custom_request))
+        
+        config = {"configurable": {"thread_id": thread_id, "priority": priority}}
+        if cassette is not None:
+            config["configurable"]["cassette"] = cassette
+        if model_override is not None:
+            config["configurable"]["model_override"] = model_override
+        # Se il grafo fallisce a metà (modello o tool) le speculazioni della sessione non restano in volo
+        with speculator.session(thread_id):
+            final_state = agent_app.invoke(initial_state, config)
+        final_state["engine"] = "agent"
+        if isinstance(agent_app.checkpointer, CompactMemorySaver):
+            final_state["checkpoint_stats"] = agent_app.checkpointer.session_stats(thread_id)
+    
+    if archive:
+        _archive_result(final_state, time.perf_counter() - t0)
+    return final_state
+
+
+def _archive_result(final_state: dict, latency_s: float):
+    """Salva l'analisi nell'archivio storico; un errore di scrittura non blocca la risposta."""
+    import sqlite3
+    from archive import get_archive
+    
+    try:
+        final_state["archive_id"] = get_archive().record(final_state, latency_s)
+    except sqlite3.Error as e:
+        print(f"⚠️  Archiviazione non riuscita: {e}")
+
+
+def get_investment_advice(amount: float, risk_profile: str = "moderate", mode: str = ADVISORY_MODE):
+    """Ottiene consigli di investimento dall'agente.
+    
+    Args:
+        amount: Importo da investire
+        risk_profile: conservative, moderate, aggressive
+        mode: auto, agent, fast
+    """
     print(f"\n{'='*70}")
     print(f"💼 CONSULENTE DI INVESTIMENTO AI")
     print(f"{'='*70}")
     print(f"💰 Capitale disponibile: €{amount:,.2f}")
     print(f"📊 Profilo di rischio: {risk_profile.upper()}")
+    print(f"⚙️  Modalità: {mode}")
     print(f"{'='*70}\n")
     print("🔍 Analisi in corso...\n")
     
-    config = {"configurable": {"thread_id": "investment_session"}}
-    
     try:
-        final_state = agent_app.invoke(initial_state, config)
+        final_state = run_advisory(amount, risk_profile, mode)
         
         print("\n" + "="*70)
         print("📋 RACCOMANDAZIONI DI INVESTIMENTO")
         print("="*70 + "\n")
         
+        if final_state.get("degraded"):
+            print(f"⚠️  Risultato parziale: {final_state.get('degraded_reason')}\n")
+        
         # Estrai e stampa la risposta finale
         for msg in final_state["messages"]:
             if isinstance(msg, AIMessage) and not (hasattr(msg, "tool_calls") and msg.tool_calls):
                 print(msg.content)
                 print()
         
+        if final_state.get("engine") == "agent":
+            print("="*70)
+            print("📈 METRICHE MODELLI")
+            print("="*70)
+            print(model_metrics.format_report())
+            if SPECULATIVE_TOOLS:
+                print()
+                print(speculator.format_report())
+            if LLM_SCHEDULER_ENABLED:
+                print()
+                print(get_scheduler().format_report())
+            if final_state.get("checkpoint_stats"):
+                print()
+                print(format_session_report(final_state["checkpoint_stats"]))
+        
         return final_state
         
     except Exception as e:
@@ -370,11 +919,21 @@ if __name__ == "__main__":
     else:
         risk_profile = "moderate"  # Default: moderate
     
+    if len(sys.argv) > 3:
+        mode = sys.argv[3].lower()
+    else:
+        mode = ADVISORY_MODE
+    
     # Valida risk profile
     if risk_profile not in ["conservative", "moderate", "aggressive"]:
         print(f"⚠️  Profilo di rischio '{risk_profile}' non valido.")
         print("   Usa: conservative, moderate, o aggressive")
         sys.exit(1)
     
+    if mode not in ["auto", "agent", "fast"]:
+        print(f"⚠️  Modalità '{mode}' non valida.")
+        print("   Usa: auto, agent, o fast")
+        sys.exit(1)
+    
     # Esegui l'agente
-    get_investment_advice(amount, risk_profile)
+    get_investment_advice(amount, risk_profile, mode)
@@ -0,0 +1,640 @@
+"""
+Coda di job durevole per le esecuzioni batch notturne del consulente
+Backend SQLite (default) o Redis (opzionale), semantica enqueue/lease/ack
+e worker multi-processo che mantengono un agente compilato ciascuno
+"""
+import os
+import sys
+import json
+import time
+import random
+import socket
+import sqlite3
+import argparse
+import threading
+import multiprocessing
+from contextlib import contextmanager
+from typing import TypedDict, Optional
+
+
+DEFAULT_QUEUE_URL = os.getenv("JOB_QUEUE_URL", "sqlite:///jobs.db")
+
+# Parametri di retry
+DEFAULT_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "5"))
+DEFAULT_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "300"))
+# Rinnovo del lease mentre un job è in esecuzione (heartbeat del worker)
+JOB_HEARTBEAT_SECONDS = float(os.getenv("JOB_HEARTBEAT_SECONDS", str(DEFAULT_LEASE_SECONDS / 3)))
+BACKOFF_BASE_SECONDS = 2.0
+BACKOFF_MAX_SECONDS = 600.0
+
+# Stati di un job
+QUEUED = "queued"
+LEASED = "leased"
+DONE = "done"
+DEAD = "dead"  # poison job: superato il numero massimo di tentativi
+
+
+class Job(TypedDict):
+    """Job acquisito in lease da un worker."""
+    id: str
+    payload: dict
+    attempts: int
+    max_attempts: int
+    lease_owner: str
+
+
+def backoff_delay(attempts: int) -> float:
+    """Ritardo esponenziale con jitter prima del prossimo tentativo."""
+    delay = min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * (2 ** max(0, attempts - 1)))
+    return delay * random.uniform(0.5, 1.0)
+
+
+# ------------ Backend SQLite ------------
+
+class SQLiteJobQueue:
+    """Coda durevole su file SQLite, condivisibile tra processi dello stesso nodo."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn = sqlite3.connect(path, timeout=30.0, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                max_attempts INTEGER NOT NULL,
+                available_at REAL NOT NULL,
+                lease_owner TEXT,
+                lease_expires REAL,
+                last_error TEXT,
+                result TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_jobs_ready ON jobs(status, available_at);
+            CREATE TABLE IF NOT EXISTS workers (
+                worker_id TEXT PRIMARY KEY,
+                host TEXT,
+                pid INTEGER,
+                started_at REAL,
+                updated_at REAL,
+                jobs_done INTEGER NOT NULL DEFAULT 0,
+                jobs_failed INTEGER NOT NULL DEFAULT 0,
+                busy_seconds REAL NOT NULL DEFAULT 0
+            );
+        """)
+
+    def enqueue(self, payload: dict, max_attempts: int = DEFAULT_MAX_ATTEMPTS) -> str:
+        now = time.time()
+        cur = self._conn.execute(
+            "INSERT INTO jobs (payload, status, max_attempts, available_at, created_at, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (json.dumps(payload), QUEUED, max_attempts, now, now, now),
+        )
+        return str(cur.lastrowid)
+
+    def enqueue_many(self, payloads: list, max_attempts: int = DEFAULT_MAX_ATTEMPTS) -> int:
+        now = time.time()
+        rows = [(json.dumps(p), QUEUED, max_attempts, now, now, now) for p in payloads]
+        with self._conn:
+            self._conn.execute("BEGIN IMMEDIATE")
+            self._conn.executemany(
+                "INSERT INTO jobs (payload, status, max_attempts, available_at, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+        return len(rows)
+
+    def lease(self, owner: str, lease_seconds: float = DEFAULT_LEASE_SECONDS) -> Optional[Job]:
+        """Acquisisce il prossimo job pronto (o con lease scaduto)."""
+        now = time.time()
+        with self._conn:
+            self._conn.execute("BEGIN IMMEDIATE")
+            # Lease scaduti di job che hanno esaurito i tentativi: poison job
+            self._conn.execute(
+                "UPDATE jobs SET status = ?, last_error = COALESCE(last_error, 'lease scaduto'), "
+                "updated_at = ? WHERE status = ? AND lease_expires < ? AND attempts >= max_attempts",
+                (DEAD, now, LEASED, now),
+            )
+            row = self._conn.execute(
+                "SELECT id, payload, attempts, max_attempts FROM jobs "
+                "WHERE (status = ? AND available_at <= ?) OR (status = ? AND lease_expires < ?) "
+                "ORDER BY available_at, id LIMIT 1",
+                (QUEUED, now, LEASED, now),
+            ).fetchone()
+            if row is None:
+                return None
+            job_id, payload, attempts, max_attempts = row
+            self._conn.execute(
+                "UPDATE jobs SET status = ?, lease_owner = ?, lease_expires = ?, "
+                "attempts = attempts + 1, updated_at = ? WHERE id = ?",
+                (LEASED, owner, now + lease_seconds, now, job_id),
+            )
+        return {
+            "id": str(job_id),
+            "payload": json.loads(payload),
+            "attempts": attempts + 1,
+            "max_attempts": max_attempts,
+            "lease_owner": owner,
+        }
+
+    def renew(self, job: Job, lease_seconds: float = DEFAULT_LEASE_SECONDS) -> bool:
+        """Prolunga il lease di un job ancora posseduto; False se il lease è stato perso."""
+        now = time.time()
+        cur = self._conn.execute(
+            "UPDATE jobs SET lease_expires = ?, updated_at = ? WHERE id = ? AND status = ? AND lease_owner = ?",
+            (now + lease_seconds, now, int(job["id"]), LEASED, job["lease_owner"]),
+        )
+        return cur.rowcount == 1
+
+    def ack(self, job: Job, result: dict) -> bool:
+        """Completa un job; False se nel frattempo il lease è passato a un altro worker."""
+        now = time.time()
+        cur = self._conn.execute(
+            "UPDATE jobs SET status = ?, result = ?, lease_owner = NULL, lease_expires = NULL, "
+            "updated_at = ? WHERE id = ? AND status = ? AND lease_owner = ?",
+            (DONE, json.dumps(result, default=str), now, int(job["id"]), LEASED, job["lease_owner"]),
+        )
+        return cur.rowcount == 1
+
+    def nack(self, job: Job, error: str) -> bool:
+        """Rilascia un job fallito: retry con backoff o stato dead se poison."""
+        now = time.time()
+        if job["attempts"] >= job["max_attempts"]:
+            status, available_at = DEAD, now
+        else:
+            status, available_at = QUEUED, now + backoff_delay(job["attempts"])
+        cur = self._conn.execute(
+            "UPDATE jobs SET status = ?, available_at = ?, last_error = ?, lease_owner = NULL, "
+            "lease_expires = NULL, updated_at = ? WHERE id = ? AND status = ? AND lease_owner = ?",
+            (status, available_at, error, now, int(job["id"]), LEASED, job["lease_owner"]),
+        )
+        return cur.rowcount == 1
+
+    def get(self, job_id: str) -> Optional[dict]:
+        row = self._conn.execute(
+            "SELECT id, payload, status, attempts, max_attempts, last_error, result FROM jobs WHERE id = ?",
+            (int(job_id),),
+        ).fetchone()
+        if row is None:
+            return None
+        return {
+            "id": str(row[0]),
+            "payload": json.loads(row[1]),
+            "status": row[2],
+            "attempts": row[3],
+            "max_attempts": row[4],
+            "last_error": row[5],
+            "result": json.loads(row[6]) if row[6] else None,
+        }
+
+    def counts(self) -> dict:
+        rows = self._conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        return {status: n for status, n in rows}
+
+    def next_wakeup(self) -> Optional[float]:
+        """Primo istante in cui un job in coda diventa pronto o un lease scade (None se nessuno)."""
+        row = self._conn.execute(
+            "SELECT MIN(CASE WHEN status = ? THEN available_at ELSE lease_expires END) "
+            "FROM jobs WHERE status IN (?, ?)",
+            (QUEUED, QUEUED, LEASED),
+        ).fetchone()
+        return row[0]
+
+    def record_worker(self, worker_id: str, done: int, failed: int, busy_seconds: float, started_at: float):
+        now = time.time()
+        self._conn.execute(
+            "INSERT INTO workers (worker_id, host, pid, started_at, updated_at, jobs_done, jobs_failed, busy_seconds) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(worker_id) DO UPDATE SET updated_at = excluded.updated_at, "
+            "jobs_done = excluded.jobs_done, jobs_failed = excluded.jobs_failed, "
+            "busy_seconds = excluded.busy_seconds",
+            (worker_id, socket.gethostname(), os.getpid(), started_at, now, done, failed, busy_seconds),
+        )
+
+    def worker_stats(self) -> list:
+        rows = self._conn.execute(
+            "SELECT worker_id, host, pid, started_at, updated_at, jobs_done, jobs_failed, busy_seconds "
+            "FROM workers ORDER BY worker_id"
+        ).fetchall()
+        keys = ["worker_id", "host", "pid", "started_at", "updated_at", "jobs_done", "jobs_failed", "busy_seconds"]
+        return [dict(zip(keys, row)) for row in rows]
+
+    def close(self):
+        self._conn.close()
+
+
+# ------------ Backend Redis (opzionale, multi-nodo) ------------
+
+# Sposta i lease scaduti in ready (o dead se esauriti) e acquisisce il primo job pronto
+_REDIS_LEASE_SCRIPT = """
+local ready, leased, dead, prefix = KEYS[1], KEYS[2], KEYS[3], ARGV[4]
+local now, expires, owner = tonumber(ARGV[1]), tonumber(ARGV[2]), ARGV[3]
+for _, id in ipairs(redis.call('ZRANGEBYSCORE', leased, '-inf', now)) do
+    redis.call('ZREM', leased, id)
+    local key = prefix .. ':job:' .. id
+    local h = redis.call('HMGET', key, 'attempts', 'max_attempts')
+    if tonumber(h[1]) >= tonumber(h[2]) then
+        redis.call('HSET', key, 'status', 'dead', 'last_error', 'lease scaduto', 'lease_owner', '')
+        redis.call('SADD', dead, id)
+    else
+        redis.call('HSET', key, 'status', 'queued', 'lease_owner', '')
+        redis.call('ZADD', ready, now, id)
+    end
+end
+local ids = redis.call('ZRANGEBYSCORE', ready, '-inf', now, 'LIMIT', 0, 1)
+if #ids == 0 then return false end
+local id = ids[1]
+redis.call('ZREM', ready, id)
+redis.call('ZADD', leased, expires, id)
+local key = prefix .. ':job:' .. id
+redis.call('HINCRBY', key, 'attempts', 1)
+redis.call('HSET', key, 'status', 'leased', 'lease_owner', owner)
+return {id, redis.call('HGET', key, 'payload'), redis.call('HGET', key, 'attempts'), redis.call('HGET', key, 'max_attempts')}
+"""
+
+# ack, nack e renew valgono solo per il proprietario del lease, come il filtro
+# su lease_owner del backend SQLite: un worker il cui lease è scaduto e passato
+# ad altri non può chiudere né riaccodare il job
+_REDIS_OWNER_CHECK = """
+local key, leased = KEYS[1], KEYS[2]
+local id, owner = ARGV[1], ARGV[2]
+local h = redis.call('HMGET', key, 'status', 'lease_owner')
+if h[1] ~= 'leased' or h[2] ~= owner then return 0 end
+"""
+
+_REDIS_ACK_SCRIPT = _REDIS_OWNER_CHECK + """
+redis.call('ZREM', leased, id)
+redis.call('HSET', key, 'status', 'done', 'result', ARGV[3], 'lease_owner', '')
+return 1
+"""
+
+# ARGV[3]: stato di destinazione (queued o dead), ARGV[4]: errore, ARGV[5]: istante del retry
+_REDIS_NACK_SCRIPT = _REDIS_OWNER_CHECK + """
+local ready, dead = KEYS[3], KEYS[4]
+redis.call('ZREM', leased, id)
+redis.call('HSET', key, 'status', ARGV[3], 'last_error', ARGV[4], 'lease_owner', '')
+if ARGV[3] == 'dead' then
+    redis.call('SADD', dead, id)
+else
+    redis.call('ZADD', ready, tonumber(ARGV[5]), id)
+end
+return 1
+"""
+
+_REDIS_RENEW_SCRIPT = _REDIS_OWNER_CHECK + """
+redis.call('ZADD', leased, 'XX', tonumber(ARGV[3]), id)
+return 1
+"""
+
+
+class RedisJobQueue:
+    """Coda condivisa tra nodi diversi tramite Redis (richiede il pacchetto `redis`)."""
+
+    def __init__(self, url: str, prefix: str = "invest_jobs"):
+        try:
+            import redis
+        except ImportError as e:
+            raise RuntimeError("Per il backend Redis installa il pacchetto: pip install redis") from e
+        self._redis = redis.Redis.from_url(url, decode_responses=True)
+        self._prefix = prefix
+        self._ready = f"{prefix}:ready"
+        self._leased = f"{prefix}:leased"
+        self._dead = f"{prefix}:dead"
+        self._lease_script = self._redis.register_script(_REDIS_LEASE_SCRIPT)
+        self._ack_script = self._redis.register_script(_REDIS_ACK_SCRIPT)
+        self._nack_script = self._redis.register_script(_REDIS_NACK_SCRIPT)
+        self._renew_script = self._redis.register_script(_REDIS_RENEW_SCRIPT)
+
+    def _key(self, job_id: str) -> str:
+        return f"{self._prefix}:job:{job_id}"
+
+    def enqueue(self, payload: dict, max_attempts: int = DEFAULT_MAX_ATTEMPTS) -> str:
+        job_id = str(self._redis.incr(f"{self._prefix}:seq"))
+        now = time.time()
+        pipe = self._redis.pipeline()
+        pipe.hset(self._key(job_id), mapping={
+            "payload": json.dumps(payload),
+            "status": QUEUED,
+            "attempts": 0,
+            "max_attempts": max_attempts,
+            "created_at": now,
+        })
+        pipe.zadd(self._ready, {job_id: now})
+        pipe.execute()
+        return job_id
+
+    def enqueue_many(self, payloads: list, max_attempts: int = DEFAULT_MAX_ATTEMPTS) -> int:
+        for payload in payloads:
+            self.enqueue(payload, max_attempts)
+        return len(payloads)
+
+    def lease(self, owner: str, lease_seconds: float = DEFAULT_LEASE_SECONDS) -> Optional[Job]:
+        now = time.time()
+        row = self._lease_script(
+            keys=[self._ready, self._leased, self._dead],
+            args=[now, now + lease_seconds, owner, self._prefix],
+        )
+        if not row:
+            return None
+        job_id, payload, attempts, max_attempts = row
+        return {
+            "id": job_id,
+            "payload": json.loads(payload),
+            "attempts": int(attempts),
+            "max_attempts": int(max_attempts),
+            "lease_owner": owner,
+        }
+
+    def renew(self, job: Job, lease_seconds: float = DEFAULT_LEASE_SECONDS) -> bool:
+        """Prolunga il lease di un job ancora posseduto; False se il lease è stato perso."""
+        return bool(self._renew_script(
+            keys=[self._key(job["id"]), self._leased],
+            args=[job["id"], job["lease_owner"], time.time() + lease_seconds],
+        ))
+
+    def ack(self, job: Job, result: dict) -> bool:
+        """Completa un job; False se nel frattempo il lease è passato a un altro worker."""
+        return bool(self._ack_script(
+            keys=[self._key(job["id"]), self._leased],
+            args=[job["id"], job["lease_owner"], json.dumps(result, default=str)],
+        ))
+
+    def nack(self, job: Job, error: str) -> bool:
+        """Rilascia un job fallito: retry con backoff o stato dead se poison."""
+        if job["attempts"] >= job["max_attempts"]:
+            status, available_at = DEAD, time.time()
+        else:
+            status, available_at = QUEUED, time.time() + backoff_delay(job["attempts"])
+        return bool(self._nack_script(
+            keys=[self._key(job["id"]), self._leased, self._ready, self._dead],
+            args=[job["id"], job["lease_owner"], status, error, available_at],
+        ))
+
+    def get(self, job_id: str) -> Optional[dict]:
+        data = self._redis.hgetall(self._key(job_id))
+        if not data:
+            return None
+        return {
+            "id": job_id,
+            "payload": json.loads(data["payload"]),
+            "status": data["status"],
+            "attempts": int(data["attempts"]),
+            "max_attempts": int(data["max_attempts"]),
+            "last_error": data.get("last_error"),
+            "result": json.loads(data["result"]) if data.get("result") else None,
+        }
+
+    def counts(self) -> dict:
+        return {
+            QUEUED: self._redis.zcard(self._ready),
+            LEASED: self._redis.zcard(self._leased),
+            DEAD: self._redis.scard(self._dead),
+        }
+
+    def next_wakeup(self) -> Optional[float]:
+        """Primo istante in cui un job in coda diventa pronto o un lease scade (None se nessuno)."""
+        scores = [
+            entries[0][1]
+            for entries in (self._redis.zrange(key, 0, 0, withscores=True) for key in (self._ready, self._leased))
+            if entries
+        ]
+        return min(scores) if scores else None
+
+    def record_worker(self, worker_id: str, done: int, failed: int, busy_seconds: float, started_at: float):
+        self._redis.hset(f"{self._prefix}:worker:{worker_id}", mapping={
+            "worker_id": worker_id,
+            "host": socket.gethostname(),
+            "pid": os.getpid(),
+            "started_at": started_at,
+            "updated_at": time.time(),
+            "jobs_done": done,
+            "jobs_failed": failed,
+            "busy_seconds": busy_seconds,
+        })
+        self._redis.sadd(f"{self._prefix}:workers", worker_id)
+
+    def worker_stats(self) -> list:
+        stats = []
+        for worker_id in sorted(self._redis.smembers(f"{self._prefix}:workers")):
+            data = self._redis.hgetall(f"{self._prefix}:worker:{worker_id}")
+            for key in ("pid", "jobs_done", "jobs_failed"):
+                data[key] = int(data[key])
+            for key in ("started_at", "updated_at", "busy_seconds"):
+                data[key] = float(data[key])
+            stats.append(data)
+        return stats
+
+    def close(self):
+        self._redis.close()
+
+
+def open_queue(url: str = DEFAULT_QUEUE_URL):
+    """Apre la coda indicata da un URL `sqlite:///percorso` o `redis://host:port/db`."""
+    if url.startswith("sqlite:///"):
+        return SQLiteJobQueue(url[len("sqlite:///"):])
+    if url.startswith(("redis://", "rediss://")):
+        return RedisJobQueue(url)
+    raise ValueError(f"URL della coda non supportato: {url}")
+
+
+# ------------ Worker ------------
+
+@contextmanager
+def lease_heartbeat(queue_url: str, job: Job, interval: float = JOB_HEARTBEAT_SECONDS,
+                    lease_seconds: float = DEFAULT_LEASE_SECONDS):
+    """Rinnova il lease di `job` ogni `interval` secondi finché il blocco è in esecuzione.
+
+    Il rinnovo usa una connessione propria (le connessioni SQLite non passano tra thread).
+    Restituisce un Event che si attiva se il lease è stato perso.
+    """
+    stop = threading.Event()
+    lost = threading.Event()
+
+    def beat():
+        queue = open_queue(queue_url)
+        try:
+            while not stop.wait(interval):
+                if not queue.renew(job, lease_seconds):
+                    lost.set()
+                    return
+        finally:
+            queue.close()
+
+    thread = threading.Thread(target=beat, daemon=True, name=f"heartbeat-{job['id']}")
+    thread.start()
+    try:
+        yield lost
+    finally:
+        stop.set()
+        thread.join()
+
+def summarize_final_state(final_state: dict) -> dict:
+    """Estrae dallo stato finale del grafo un risultato serializzabile in JSON."""
+    from investment_agent import extract_final_answer
+    from market_data import market_data_to_dict, positions_to_dicts
+
+    return {
+        "investment_amount": final_state.get("investment_amount"),
+        "risk_profile": final_state.get("risk_profile"),
+        "answer": extract_final_answer(final_state),
+        "recommendations": positions_to_dicts(final_state.get("recommendations")),
+        "market_data": market_data_to_dict(final_state.get("market_data")),
+        "rationale": final_state.get("rationale", ""),
+        "next_action": final_state.get("next_action"),
+        "engine": final_state.get("engine"),
+        "degraded": final_state.get("degraded", False),
+        "degraded_reason": final_state.get("degraded_reason", ""),
+        "archive_id": final_state.get("archive_id"),
+    }
+
+
+def run_worker(queue_url: str, worker_id: str, exit_when_idle: bool = False,
+               poll_seconds: float = 1.0, tool_cache_ttl: float = 300.0):
+    """Ciclo di un worker: un agente compilato e una cache tools calda per processo."""
+    from investment_agent import create_investment_agent, run_advisory, enable_tool_cache, ADVISORY_MODE
+
+    queue = open_queue(queue_url)
+    enable_tool_cache(tool_cache_ttl)
+    agent_app = create_investment_agent()
+
+    started_at = time.time()
+    done = failed = 0
+    busy_seconds = 0.0
+    queue.record_worker(worker_id, done, failed, busy_seconds, started_at)
+
+    try:
+        while True:
+            job = queue.lease(worker_id)
+            if job is None:
+                # Esce solo se non restano job in coda (anche in backoff) né in lease
+                wakeup = queue.next_wakeup()
+                if exit_when_idle and wakeup is None:
+                    break
+                delay = poll_seconds if wakeup is None else min(poll_seconds, max(0.05, wakeup - time.time()))
+                time.sleep(delay)
+                continue
+
+            # Un thread per tentativo: un retry non eredita la storia di quello fallito
+            thread_id = f"job_{job['id']}_{job['attempts']}"
+            t0 = time.perf_counter()
+            try:
+                payload = job["payload"]
+                with lease_heartbeat(queue_url, job):
+                    final_state = run_advisory(
+                        float(payload["amount"]),
+                        payload["risk_profile"],
+                        mode=payload.get("mode", ADVISORY_MODE),
+                        thread_id=thread_id,
+                        agent_app=agent_app,
+                        priority="batch",
+                    )
+                if queue.ack(job, summarize_final_state(final_state)):
+                    done += 1
+                else:
+                    print(f"⚠️  Job {job['id']}: lease perso, risultato scartato (il job è di un altro worker)")
+            except Exception as e:
+                if queue.nack(job, f"{type(e).__name__}: {e}"):
+                    failed += 1
+            finally:
+                # L'agente è condiviso tra i job: i checkpoint del tentativo non servono più
+                agent_app.checkpointer.delete_thread(thread_id)
+            busy_seconds += time.perf_counter() - t0
+            queue.record_worker(worker_id, done, failed, busy_seconds, started_at)
+    finally:
+        queue.record_worker(worker_id, done, failed, busy_seconds, started_at)
+        queue.close()
+
+
+def run_workers(queue_url: str, num_workers: int, exit_when_idle: bool = False):
+    """Avvia `num_workers` processi worker sul nodo corrente e attende la loro fine."""
+    host = socket.gethostname()
+    processes = []
+    for i in range(num_workers):
+        worker_id = f"{host}-{os.getpid()}-{i}"
+        p = multiprocessing.Process(
+            target=run_worker,
+            args=(queue_url, worker_id, exit_when_idle),
+            name=worker_id,
+        )
+        p.start()
+        processes.append(p)
+
+    for p in processes:
+        p.join()
+
+
+def print_stats(queue):
+    """Stampa lo stato della coda e il throughput per worker."""
+    print("\n📦 Stato coda:")
+    for status, n in sorted(queue.counts().items()):
+        print(f"   - {status}: {n}")
+
+    print("\n⚙️  Throughput per worker:")
+    for w in queue.worker_stats():
+        elapsed = max(1e-9, w["updated_at"] - w["started_at"])
+        per_min = w["jobs_done"] / elapsed * 60
+        avg = w["busy_seconds"] / w["jobs_done"] if w["jobs_done"] else 0.0
+        print(f"   - {w['worker_id']} ({w['host']}): {w['jobs_done']} ok, {w['jobs_failed']} ko, "
+              f"{per_min:.1f} job/min, {avg:.2f}s/job")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Coda di job per analisi di investimento batch")
+    parser.add_argument("--queue", default=DEFAULT_QUEUE_URL, help="URL della coda (sqlite:/// o redis://)")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    enq = sub.add_parser("enqueue", help="Accoda analisi da un file JSONL o da parametri")
+    enq.add_argument("--file", help="File JSONL con oggetti {amount, risk_profile}")
+    enq.add_argument("--amount", type=float)
+    enq.add_argument("--risk-profile", default="moderate")
+    enq.add_argument("--mode", choices=["auto", "agent", "fast"], help="Motore di analisi per il job")
+
+    work = sub.add_parser("work", help="Avvia i worker su questo nodo")
+    work.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    work.add_argument("--exit-when-idle", action="store_true")
+
+    sub.add_parser("stats", help="Mostra stato della coda e throughput")
+
+    status = sub.add_parser("status", help="Mostra lo stato di un job")
+    status.add_argument("job_id")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "work":
+        run_workers(args.queue, args.workers, args.exit_when_idle)
+        return
+
+    queue = open_queue(args.queue)
+    try:
+        if args.command == "enqueue":
+            if args.file:
+                with open(args.file, encoding="utf-8") as f:
+                    payloads = [json.loads(line) for line in f if line.strip()]
+                n = queue.enqueue_many(payloads)
+                print(f"✅ Accodati {n} job")
+            elif args.amount is not None:
+                payload = {"amount": args.amount, "risk_profile": args.risk_profile}
+                if args.mode:
+                    payload["mode"] = args.mode
+                job_id = queue.enqueue(payload)
+                print(f"✅ Accodato job {job_id}")
+            else:
+                parser.error("specifica --file oppure --amount")
+        elif args.command == "stats":
+            print_stats(queue)
+        elif args.command == "status":
+            job = queue.get(args.job_id)
+            if job is None:
+                print(f"⚠️  Job {args.job_id} non trovato")
+                sys.exit(1)
+            print(json.dumps(job, indent=2, ensure_ascii=False))
+    finally:
+        queue.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,482 @@
+"""
+Scheduler di ammissione globale per le chiamate al modello
+Budget di richieste e token al minuto (token bucket) condivisi dal processo o,
+opzionalmente, tra processi; classi di priorità (interattivo prima del batch)
+con accodamento equo tra sessioni e retry con backoff sui 429 del provider
+"""
+import os
+import json
+import time
+import random
+import sqlite3
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+
+# Budget del provider: richieste e token al minuto
+LLM_RPM = int(os.getenv("LLM_RPM", "500"))
+LLM_TPM = int(os.getenv("LLM_TPM", "200000"))
+
+# Token di output riservati per chiamata, corretti con l'usage reale a fine chiamata
+LLM_OUTPUT_TOKENS_ESTIMATE = int(os.getenv("LLM_OUTPUT_TOKENS_ESTIMATE", "500"))
+
+# Budget condiviso: "" = solo questo processo, "sqlite:///llm_budget.db" = tutti i processi del nodo
+LLM_SCHEDULER_URL = os.getenv("LLM_SCHEDULER_URL", "")
+
+LLM_SCHEDULER_ENABLED = os.getenv("LLM_SCHEDULER_ENABLED", "true").lower() == "true"
+
+# Raffica ammessa a bucket pieno, in secondi di budget: il resto si ricarica nel minuto,
+# così in una qualunque finestra di 60s non si supera mai il limite
+LLM_BURST_SECONDS = float(os.getenv("LLM_BURST_SECONDS", "6"))
+
+# Retry sui 429 del provider
+LLM_RATE_LIMIT_RETRIES = int(os.getenv("LLM_RATE_LIMIT_RETRIES", "4"))
+BACKOFF_BASE_SECONDS = 1.0
+BACKOFF_MAX_SECONDS = 30.0
+
+# Retry sugli errori transitori (5xx, timeout e connessioni interrotte), come l'SDK OpenAI
+LLM_TRANSIENT_RETRIES = int(os.getenv("LLM_TRANSIENT_RETRIES", "2"))
+TRANSIENT_BACKOFF_BASE_SECONDS = 0.5
+TRANSIENT_BACKOFF_MAX_SECONDS = 8.0
+TRANSIENT_ERROR_NAMES = ("APITimeoutError", "APIConnectionError", "InternalServerError",
+                         "ConnectTimeout", "ReadTimeout", "RemoteProtocolError")
+
+# Quote di ammissione per classe quando più classi sono in coda (4 interattive ogni batch)
+PRIORITY_WEIGHTS = {"interactive": 4, "batch": 1}
+DEFAULT_PRIORITY = "interactive"
+
+# Campioni di attesa conservati per i percentili
+WAIT_SAMPLES = 2048
+
+
+def estimate_tokens(messages, output_tokens: int = LLM_OUTPUT_TOKENS_ESTIMATE) -> int:
+    """Stima dei token della chiamata: ~4 caratteri per token più l'output previsto."""
+    chars = 0
+    for msg in messages:
+        chars += len(str(msg.content)) + 16
+        tool_calls = getattr(msg, "tool_calls", None)
+        if tool_calls:
+            chars += len(json.dumps([c["args"] for c in tool_calls], default=str))
+    return chars // 4 + output_tokens
+
+
+def is_rate_limit_error(error: Exception) -> bool:
+    """True per i 429 del provider (openai.RateLimitError o eccezioni con `status_code`)."""
+    return getattr(error, "status_code", None) == 429 or type(error).__name__ == "RateLimitError"
+
+
+def is_transient_error(error: Exception) -> bool:
+    """True per errori del provider che un nuovo tentativo può risolvere (5xx, timeout HTTP, rete).
+
+    Il TimeoutError della deadline della richiesta non è transitorio: il budget è finito.
+    """
+    if type(error) is TimeoutError:
+        return False
+    status = getattr(error, "status_code", None)
+    if isinstance(status, int) and status >= 500:
+        return True
+    return isinstance(error, ConnectionError) or type(error).__name__ in TRANSIENT_ERROR_NAMES
+
+
+def retry_after_seconds(error: Exception):
+    """Valore di Retry-After indicato dal provider, se presente."""
+    retry_after = getattr(error, "retry_after", None)
+    if retry_after is None:
+        response = getattr(error, "response", None)
+        headers = getattr(response, "headers", None) or {}
+        retry_after = headers.get("retry-after")
+    try:
+        return float(retry_after) if retry_after is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt: int, retry_after: float = None) -> float:
+    """Ritardo prima del prossimo tentativo: Retry-After se noto, altrimenti esponenziale con jitter."""
+    if retry_after is not None:
+        return min(BACKOFF_MAX_SECONDS, retry_after)
+    delay = min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * (2 ** max(0, attempt - 1)))
+    return delay * random.uniform(0.5, 1.0)
+
+
+def transient_backoff_delay(attempt: int) -> float:
+    """Ritardo esponenziale con jitter prima di ritentare un errore transitorio."""
+    delay = min(TRANSIENT_BACKOFF_MAX_SECONDS, TRANSIENT_BACKOFF_BASE_SECONDS * (2 ** max(0, attempt - 1)))
+    return delay * random.uniform(0.5, 1.0)
+
+
+# ------------ Budget (Token Bucket) ------------
+
+class _Bucket:
+    """Parametri di un token bucket: capacità e ricarica al secondo.
+
+    Capacità `limit * burst / 60` e ricarica `(limit - capacità) / 60` garantiscono
+    che raffica iniziale più ricarica non superino `limit` in nessuna finestra di 60s.
+    """
+
+    __slots__ = ("capacity", "rate")
+
+    def __init__(self, limit: float, burst_seconds: float = LLM_BURST_SECONDS):
+        self.capacity = max(1.0, limit * min(burst_seconds, 60.0) / 60.0)
+        self.rate = max(limit - self.capacity, 1.0) / 60.0
+
+    def refill(self, level: float, updated: float, now: float) -> float:
+        return min(self.capacity, level + (now - updated) * self.rate)
+
+    def wait_for(self, level: float, amount: float) -> float:
+        """Secondi di ricarica necessari per prelevare `amount` (le richieste più grandi
+        del bucket passano a bucket pieno, altrimenti resterebbero bloccate per sempre)."""
+        needed = min(amount, self.capacity)
+        if level >= needed:
+            return 0.0
+        return (needed - level) / self.rate
+
+
+class LocalBudget:
+    """Budget RPM/TPM condiviso dai thread del processo."""
+
+    def __init__(self, rpm: int = LLM_RPM, tpm: int = LLM_TPM):
+        self.rpm = rpm
+        self.tpm = tpm
+        self._rpm = _Bucket(rpm)
+        self._tpm = _Bucket(tpm)
+        self._lock = threading.Lock()
+        now = time.time()
+        self._requests = (self._rpm.capacity, now)
+        self._tokens = (self._tpm.capacity, now)
+        self._paused_until = 0.0
+
+    def reserve(self, tokens: int) -> float:
+        """Preleva una richiesta e `tokens` token; restituisce 0 se ammesso, altrimenti i secondi da attendere."""
+        with self._lock:
+            now = time.time()
+            if now < self._paused_until:
+                return self._paused_until - now
+            requests = self._rpm.refill(*self._requests, now)
+            budget = self._tpm.refill(*self._tokens, now)
+            wait = max(self._rpm.wait_for(requests, 1), self._tpm.wait_for(budget, tokens))
+            if wait > 0:
+                return wait
+            self._requests = (requests - 1, now)
+            self._tokens = (budget - tokens, now)
+            return 0.0
+
+    def adjust(self, delta_tokens: int):
+        """Corregge il bucket dei token con la differenza tra usage reale e stima (anche in debito)."""
+        with self._lock:
+            now = time.time()
+            self._tokens = (self._tpm.refill(*self._tokens, now) - delta_tokens, now)
+
+    def pause(self, seconds: float):
+        """Sospende le ammissioni dopo un 429: il provider ha già esaurito la finestra."""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.time() + seconds)
+
+    def close(self):
+        pass
+
+
+class SQLiteBudget:
+    """Budget RPM/TPM condiviso tra i processi del nodo tramite un file SQLite."""
+
+    def __init__(self, path: str, rpm: int = LLM_RPM, tpm: int = LLM_TPM):
+        self.rpm = rpm
+        self.tpm = tpm
+        self._rpm = _Bucket(rpm)
+        self._tpm = _Bucket(tpm)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30.0, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS llm_budget (name TEXT PRIMARY KEY, level REAL NOT NULL, updated REAL NOT NULL)"
+        )
+        now = time.time()
+        self._conn.executemany(
+            "INSERT OR IGNORE INTO llm_budget (name, level, updated) VALUES (?, ?, ?)",
+            [("requests", self._rpm.capacity, now), ("tokens", self._tpm.capacity, now), ("paused_until", 0.0, now)],
+        )
+
+    def _load(self) -> dict:
+        return {name: (level, updated) for name, level, updated in
+                self._conn.execute("SELECT name, level, updated FROM llm_budget")}
+
+    def reserve(self, tokens: int) -> float:
+        with self._lock, self._conn:
+            self._conn.execute("BEGIN IMMEDIATE")
+            rows = self._load()
+            now = time.time()
+            paused_until = rows["paused_until"][0]
+            if now < paused_until:
+                return paused_until - now
+            requests = self._rpm.refill(*rows["requests"], now)
+            budget = self._tpm.refill(*rows["tokens"], now)
+            wait = max(self._rpm.wait_for(requests, 1), self._tpm.wait_for(budget, tokens))
+            if wait > 0:
+                return wait
+            self._conn.executemany(
+                "UPDATE llm_budget SET level = ?, updated = ? WHERE name = ?",
+                [(requests - 1, now, "requests"), (budget - tokens, now, "tokens")],
+            )
+            return 0.0
+
+    def adjust(self, delta_tokens: int):
+        with self._lock, self._conn:
+            self._conn.execute("BEGIN IMMEDIATE")
+            now = time.time()
+            budget = self._tpm.refill(*self._load()["tokens"], now)
+            self._conn.execute("UPDATE llm_budget SET level = ?, updated = ? WHERE name = 'tokens'",
+                               (budget - delta_tokens, now))
+
+    def pause(self, seconds: float):
+        with self._lock, self._conn:
+            self._conn.execute("BEGIN IMMEDIATE")
+            self._conn.execute("UPDATE llm_budget SET level = MAX(level, ?), updated = ? WHERE name = 'paused_until'",
+                               (time.time() + seconds, time.time()))
+
+    def close(self):
+        self._conn.close()
+
+
+def open_budget(url: str = LLM_SCHEDULER_URL, rpm: int = LLM_RPM, tpm: int = LLM_TPM):
+    """Apre il budget indicato da un URL vuoto (processo) o `sqlite:///percorso` (nodo)."""
+    if not url:
+        return LocalBudget(rpm, tpm)
+    if url.startswith("sqlite:///"):
+        return SQLiteBudget(url[len("sqlite:///"):], rpm, tpm)
+    raise ValueError(f"URL del budget LLM non supportato: {url}")
+
+
+# ------------ Scheduler di Ammissione ------------
+
+class _Ticket:
+    __slots__ = ("priority", "session", "tokens", "enqueued_at")
+
+    def __init__(self, priority: str, session: str, tokens: int):
+        self.priority = priority
+        self.session = session
+        self.tokens = tokens
+        self.enqueued_at = time.perf_counter()
+
+
+class AdmissionScheduler:
+    """Coda di ammissione davanti al provider.
+
+    Tra le classi si usa uno stride scheduling pesato (`PRIORITY_WEIGHTS`): il batch
+    avanza anche sotto carico interattivo, ma con una quota ridotta. Dentro una classe
+    le sessioni sono servite a turno, così una sessione con molte chiamate in coda
+    non ritarda le altre. Solo la testa della coda preleva dal budget.
+    """
+
+    def __init__(self, budget=None, weights: dict = None,
+                 max_retries: int = LLM_RATE_LIMIT_RETRIES,
+                 transient_retries: int = LLM_TRANSIENT_RETRIES):
+        self.budget = budget or open_budget()
+        self.weights = dict(weights or PRIORITY_WEIGHTS)
+        self.max_retries = max_retries
+        self.transient_retries = transient_retries
+        self._cond = threading.Condition()
+        self._queues = {p: OrderedDict() for p in self.weights}  # classe -> sessione -> deque di ticket
+        self._pass = {p: 0.0 for p in self.weights}
+        self._stats = {p: self._empty_stats() for p in self.weights}
+
+    @staticmethod
+    def _empty_stats() -> dict:
+        return {"queued": 0, "max_queued": 0, "admitted": 0, "timeouts": 0,
+                "rate_limited": 0, "transient_retries": 0, "wait_s": 0.0, "max_wait_s": 0.0, "waits": deque(maxlen=WAIT_SAMPLES)}
+
+    def _enqueue(self, ticket: _Ticket):
+        queue = self._queues[ticket.priority]
+        if not queue:
+            # Una classe che torna in coda non accumula credito dal periodo di inattività
+            active = [self._pass[p] for p, q in self._queues.items() if q]
+            if active:
+                self._pass[ticket.priority] = max(self._pass[ticket.priority], min(active))
+        queue.setdefault(ticket.session, deque()).append(ticket)
+        stats = self._stats[ticket.priority]
+        stats["queued"] += 1
+        stats["max_queued"] = max(stats["max_queued"], stats["queued"])
+
+    def _remove(self, ticket: _Ticket):
+        queue = self._queues[ticket.priority]
+        tickets = queue.get(ticket.session)
+        if tickets is None:
+            return
+        try:
+            tickets.remove(ticket)
+        except ValueError:
+            return
+        if not tickets:
+            del queue[ticket.session]
+        self._stats[ticket.priority]["queued"] -= 1
+
+    def _head(self):
+        active = [p for p, q in self._queues.items() if q]
+        if not active:
+            return None
+        priority = min(active, key=lambda p: (self._pass[p], -self.weights[p]))
+        return next(iter(self._queues[priority].values()))[0]
+
+    def _admit(self, ticket: _Ticket):
+        queue = self._queues[ticket.priority]
+        tickets = queue.pop(ticket.session)
+        tickets.popleft()
+        if tickets:
+            queue[ticket.session] = tickets  # la sessione torna in fondo al giro
+        self._pass[ticket.priority] += 1.0 / self.weights[ticket.priority]
+        wait = time.perf_counter() - ticket.enqueued_at
+        stats = self._stats[ticket.priority]
+        stats["queued"] -= 1
+        stats["admitted"] += 1
+        stats["wait_s"] += wait
+        stats["max_wait_s"] = max(stats["max_wait_s"], wait)
+        stats["waits"].append(wait)
+
+    def acquire(self, tokens: int, priority: str = DEFAULT_PRIORITY, session: str = "",
+                timeout: float = None):
+        """Attende il proprio turno e il budget; solleva TimeoutError oltre `timeout` secondi."""
+        if priority not in self.weights:
+            priority = DEFAULT_PRIORITY
+        ticket = _Ticket(priority, session or "", tokens)
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        with self._cond:
+            self._enqueue(ticket)
+            try:
+                while True:
+                    remaining = None if deadline is None else deadline - time.perf_counter()
+                    if remaining is not None and remaining <= 0:
+                        self._stats[priority]["timeouts"] += 1
+                        raise TimeoutError(f"nessuna capacità LLM disponibile entro {timeout:.1f}s")
+                    wait = None
+                    if self._head() is ticket:
+                        wait = self.budget.reserve(tokens)
+                        if wait == 0.0:
+                            self._admit(ticket)
+                            ticket = None
+                            return
+                    if remaining is not None:
+                        wait = remaining if wait is None else min(wait, remaining)
+                    self._cond.wait(wait)
+            finally:
+                if ticket is not None:
+                    self._remove(ticket)
+                self._cond.notify_all()
+
+    def settle(self, estimated_tokens: int, response):
+        """Riporta nel budget la differenza tra token stimati e `usage_metadata` reale."""
+        usage = getattr(response, "usage_metadata", None) or {}
+        actual = usage.get("input_tokens", 0) + usage.get("output_tokens", 0)
+        if actual and actual != estimated_tokens:
+            self.budget.adjust(actual - estimated_tokens)
+
+    def call(self, fn, messages, priority: str = DEFAULT_PRIORITY, session: str = "",
+             timeout: float = None, executor=None):
+        """Esegue `fn(messages)` quando c'è budget, ritentando i 429 e gli errori transitori.
+
+        I 429 sospendono le ammissioni di tutti per il tempo indicato dal provider;
+        gli errori transitori (5xx, timeout HTTP, rete) attendono solo il chiamante.
+        Con `executor` la chiamata gira nel pool e `timeout` copre attesa in coda,
+        chiamata e retry; allo scadere solleva TimeoutError.
+        """
+        tokens = estimate_tokens(messages)
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        stats_key = priority if priority in self.weights else DEFAULT_PRIORITY
+        attempt = transient_attempt = 0
+        while True:
+            remaining = None if deadline is None else max(0.0, deadline - time.perf_counter())
+            self.acquire(tokens, priority, session, remaining)
+            try:
+                if executor is None:
+                    response = fn(messages)
+                else:
+                    future = executor.submit(fn, messages)
+                    remaining = None if deadline is None else max(0.0, deadline - time.perf_counter())
+                    try:
+                        response = future.result(timeout=remaining)
+                    except FutureTimeoutError:
+                        future.cancel()
+                        raise TimeoutError(f"nessuna risposta del modello entro {timeout:.1f}s")
+            except Exception as e:
+                if is_rate_limit_error(e) and attempt < self.max_retries:
+                    attempt += 1
+                    delay = backoff_delay(attempt, retry_after_seconds(e))
+                    with self._cond:
+                        self._stats[stats_key]["rate_limited"] += 1
+                    # Il provider ha esaurito la finestra: fermare tutti evita una raffica di 429
+                    self.budget.pause(delay)
+                    continue
+                if is_transient_error(e) and transient_attempt < self.transient_retries:
+                    transient_attempt += 1
+                    delay = transient_backoff_delay(transient_attempt)
+                    if deadline is not None and time.perf_counter() + delay >= deadline:
+                        raise
+                    with self._cond:
+                        self._stats[stats_key]["transient_retries"] += 1
+                    time.sleep(delay)
+                    continue
+                raise
+            self.settle(tokens, response)
+            return response
+
+    def snapshot(self) -> dict:
+        """Profondità della coda e tempi di attesa per classe di priorità."""
+        from cassettes import percentile
+
+        with self._cond:
+            result = {}
+            for priority, stats in self._stats.items():
+                waits = list(stats["waits"])
+                admitted = stats["admitted"] or 1
+                result[priority] = {
+                    "queued": stats["queued"],
+                    "sessions_queued": len(self._queues[priority]),
+                    "max_queued": stats["max_queued"],
+                    "admitted": stats["admitted"],
+                    "timeouts": stats["timeouts"],
+                    "rate_limited": stats["rate_limited"],
+                    "transient_retries": stats["transient_retries"],
+                    "avg_wait_s": stats["wait_s"] / admitted,
+                    "p95_wait_s": percentile(waits, 95) if waits else 0.0,
+                    "max_wait_s": stats["max_wait_s"],
+                }
+            return result
+
+    def reset_stats(self):
+        with self._cond:
+            self._stats = {p: self._empty_stats() for p in self.weights}
+
+    def format_report(self) -> str:
+        """Tabella testuale per la stampa da CLI."""
+        lines = [f"{'Classe':<14}{'In coda':>9}{'Max coda':>10}{'Ammesse':>9}{'Attesa media':>14}"
+                 f"{'p95':>9}{'429':>6}{'Retry':>7}{'Timeout':>9}"]
+        for priority, s in self.snapshot().items():
+            lines.append(
+                f"{priority:<14}{s['queued']:>9}{s['max_queued']:>10}{s['admitted']:>9}"
+                f"{s['avg_wait_s']:>13.2f}s{s['p95_wait_s']:>8.2f}s{s['rate_limited']:>6}"
+                f"{s['transient_retries']:>7}{s['timeouts']:>9}"
+            )
+        return "\n".join(lines)
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler() -> AdmissionScheduler:
+    """Scheduler condiviso dal processo, creato al primo utilizzo."""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = AdmissionScheduler()
+        return _scheduler
+
+
+def configure_scheduler(rpm: int = LLM_RPM, tpm: int = LLM_TPM, url: str = LLM_SCHEDULER_URL,
+                        max_retries: int = LLM_RATE_LIMIT_RETRIES) -> AdmissionScheduler:
+    """Sostituisce lo scheduler del processo (es. load test con limiti diversi)."""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is not None:
+            _scheduler.budget.close()
+        _scheduler = AdmissionScheduler(open_budget(url, rpm, tpm), max_retries=max_retries)
+        return _scheduler
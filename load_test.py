@@ -0,0 +1,528 @@
+"""
+Generatore di carico con utenti concorrenti per dashboard e runtime dell'agente
+Simula N sessioni simultanee della logica di `run_investment_analysis` /
+`get_investment_advice` con un modello fittizio a latenza configurabile,
+aumenta gli utenti a gradini e individua il punto di saturazione
+"""
+import os
+import sys
+import json
+import math
+import time
+import random
+import argparse
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from langchain_core.messages import AIMessage, ToolMessage
+
+from cassettes import percentile
+
+
+PROFILES = ("conservative", "moderate", "aggressive")
+
+
+# ------------ Modello Fittizio ------------
+
+class FakeAdvisorModel:
+    """Modello fittizio che segue lo script del prompt con latenza log-normale.
+
+    La risposta dipende solo dai messaggi ricevuti, quindi invocazioni ripetute
+    sullo stesso turno (es. escalation al writer) restituiscono lo stesso risultato.
+    """
+
+    def __init__(self, amount: float, risk_profile: str, median_s: float = 1.0,
+                 sigma: float = 0.4, seed: int = None):
+        self.amount = amount
+        self.risk_profile = risk_profile
+        self.median_s = median_s
+        self.sigma = sigma
+        self._rng = random.Random(seed)
+
+    def _latency(self) -> float:
+        if self.median_s <= 0:
+            return 0.0
+        return self.median_s * math.exp(self._rng.gauss(0.0, self.sigma))
+
+    @staticmethod
+    def _usage(messages, output_tokens: int) -> dict:
+        input_tokens = sum(len(str(m.content)) for m in messages) // 4
+        return {"input_tokens": input_tokens, "output_tokens": output_tokens,
+                "total_tokens": input_tokens + output_tokens}
+
+    def _results(self, messages) -> dict:
+        results = {}
+        for msg in messages:
+            if isinstance(msg, ToolMessage) and msg.status != "error":
+                results.setdefault(msg.name, []).append(json.loads(msg.content))
+        return results
+
+    def _call(self, name: str, args: dict, n: int) -> dict:
+        return {"name": name, "args": args, "id": f"call_{name}_{n}", "type": "tool_call"}
+
+    def invoke(self, messages):
+        time.sleep(self._latency())
+        results = self._results(messages)
+        n = len(messages)
+
+        if "get_market_overview" not in results:
+            calls = [
+                self._call("get_market_overview", {}, n),
+                self._call("calculate_portfolio_allocation",
+                           {"amount": self.amount, "risk_profile": self.risk_profile}, n + 1),
+            ]
+            return AIMessage(content="", tool_calls=calls, usage_metadata=self._usage(messages, 40))
+
+        if "analyze_sectors" not in results:
+            calls = [self._call("analyze_sectors", {"risk_profile": self.risk_profile}, n)]
+            return AIMessage(content="", tool_calls=calls, usage_metadata=self._usage(messages, 30))
+
+        ranking = results["analyze_sectors"][-1]["ranking"][:3]
+        picks = [t for s in ranking for t in s["top_stocks"][:2] if t != "N/A"]
+
+        stocks = results["calculate_portfolio_allocation"][-1]["allocation"]["stocks"]
+        per_pick = stocks / max(1, len(picks))
+        lines = ["### Raccomandazioni"] + [f"- {t}: €{per_pick:,.2f}" for t in picks]
+        lines += ["", "### Conclusione", "Portafoglio diversificato sui settori leader."]
+        return AIMessage(content="\n".join(lines), usage_metadata=self._usage(messages, 400))
+
+
+class ProviderRateLimitError(Exception):
+    """429 del provider fittizio, con lo stesso `status_code` delle eccezioni HTTP reali."""
+
+    status_code = 429
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"rate limit del provider, riprovare tra {retry_after:.2f}s")
+        self.retry_after = retry_after
+
+
+class FakeRateLimitedEndpoint:
+    """Endpoint locale che applica limiti RPM/TPM su una finestra scorrevole di 60s.
+
+    Le chiamate oltre i limiti falliscono con `ProviderRateLimitError` (429)
+    senza consumare latenza, come un provider reale. I token di input sono
+    contati all'ingresso, quelli di output a risposta ricevuta.
+    """
+
+    WINDOW_S = 60.0
+
+    def __init__(self, rpm: int, tpm: int):
+        self.rpm = rpm
+        self.tpm = tpm
+        self._lock = threading.Lock()
+        self._requests = deque()  # (istante, token)
+        self._tokens = 0
+        self.accepted = 0
+        self.rejected = 0
+
+    def _expire(self, now: float):
+        while self._requests and self._requests[0][0] <= now - self.WINDOW_S:
+            self._tokens -= self._requests.popleft()[1]
+
+    def _admit(self, input_tokens: int) -> list:
+        with self._lock:
+            now = time.monotonic()
+            self._expire(now)
+            if len(self._requests) >= self.rpm or self._tokens + input_tokens > self.tpm:
+                self.rejected += 1
+                retry_after = self._requests[0][0] + self.WINDOW_S - now if self._requests else 1.0
+                raise ProviderRateLimitError(max(0.05, retry_after))
+            entry = [now, input_tokens]
+            self._requests.append(entry)
+            self._tokens += input_tokens
+            self.accepted += 1
+            return entry
+
+    def _add_output(self, entry: list, output_tokens: int):
+        with self._lock:
+            if self._requests and self._requests[0][0] <= entry[0]:
+                entry[1] += output_tokens
+                self._tokens += output_tokens
+
+    def wrap(self, model):
+        endpoint = self
+
+        class _LimitedModel:
+            def invoke(self, messages):
+                entry = endpoint._admit(sum(len(str(m.content)) for m in messages) // 4)
+                response = model.invoke(messages)
+                usage = getattr(response, "usage_metadata", None) or {}
+                endpoint._add_output(entry, usage.get("output_tokens", 0))
+                return response
+
+        return _LimitedModel()
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.accepted + self.rejected
+            return {"rpm": self.rpm, "tpm": self.tpm, "accepted": self.accepted, "rejected_429": self.rejected,
+                    "reject_rate": self.rejected / total if total else 0.0}
+
+
+# ------------ Misure ------------
+
+def current_rss_mb() -> float:
+    """Memoria residente del processo in MB."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1e6
+    except (OSError, ValueError):
+        import resource
+        # ru_maxrss è il picco (KB su Linux, byte su macOS)
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss / 1e6 if sys.platform == "darwin" else rss / 1e3
+
+
+class LoadRecorder:
+    """Raccoglie gli esiti delle sessioni e campiona la RSS nel tempo."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.sessions = []  # (istante di fine, latenza, esito, utenti attivi)
+        self.rss = []  # (istante, MB)
+        self.started = time.perf_counter()
+        self._stop = threading.Event()
+
+    def now(self) -> float:
+        return time.perf_counter() - self.started
+
+    def add(self, latency_s: float, outcome: str, users: int):
+        with self._lock:
+            self.sessions.append((self.now(), latency_s, outcome, users))
+
+    def start_sampling(self, interval_s: float = 1.0):
+        def sample():
+            while not self._stop.wait(interval_s):
+                self.rss.append((self.now(), current_rss_mb()))
+        self.rss.append((0.0, current_rss_mb()))
+        threading.Thread(target=sample, daemon=True, name="rss-sampler").start()
+
+    def stop(self):
+        self._stop.set()
+
+
+# ------------ Esecuzione ------------
+
+def run_session(rng: random.Random, amount_range: tuple, profile_mix: dict, mode: str,
+                median_s: float, sigma: float, agent_app, endpoint: FakeRateLimitedEndpoint = None) -> str:
+    """Una sessione utente: stessa logica della dashboard con modello fittizio.
+
+    Restituisce l'esito: "degraded" per le risposte parziali a deadline scaduta, che non
+    contano né come riuscite né come errori.
+    """
+    from investment_agent import run_advisory
+
+    amount = round(rng.uniform(*amount_range), -2)
+    risk_profile = rng.choices(list(profile_mix), weights=list(profile_mix.values()))[0]
+    model = FakeAdvisorModel(amount, risk_profile, median_s, sigma, seed=rng.random())
+    if endpoint is not None:
+        model = endpoint.wrap(model)
+    thread_id = f"load_{threading.get_ident()}_{time.perf_counter_ns()}"
+    try:
+        state = run_advisory(
+            amount, risk_profile, mode=mode, thread_id=thread_id,
+            agent_app=agent_app, archive=False, model_override=model,
+        )
+        return "degraded" if state.get("degraded") else "ok"
+    finally:
+        # L'agente è condiviso tra le sessioni: senza pulizia la RSS misurata crescerebbe
+        # con i checkpoint accumulati invece che con il carico
+        agent_app.checkpointer.delete_thread(thread_id)
+
+
+def run_load(stages: list, stage_seconds: float, amount_range: tuple = (1000.0, 100000.0),
+             profile_mix: dict = None, mode: str = "agent", median_s: float = 1.0,
+             sigma: float = 0.4, seed: int = 42, endpoint: FakeRateLimitedEndpoint = None) -> dict:
+    """Esegue il carico a gradini: `stages` è la lista degli utenti concorrenti per gradino.
+
+    Con `endpoint` le chiamate al modello passano da un provider fittizio con limiti RPM/TPM.
+    """
+    from investment_agent import create_investment_agent
+    from llm_scheduler import get_scheduler, LLM_SCHEDULER_ENABLED
+
+    profile_mix = profile_mix or {p: 1.0 for p in PROFILES}
+    agent_app = create_investment_agent()
+    recorder = LoadRecorder()
+    recorder.start_sampling()
+
+    active = {"users": 0}
+    active_lock = threading.Lock()
+    stage_stop = threading.Event()
+
+    def user_loop(user_id: int):
+        rng = random.Random(seed * 100003 + user_id)
+        while not stage_stop.is_set():
+            t0 = time.perf_counter()
+            try:
+                outcome = run_session(rng, amount_range, profile_mix, mode, median_s, sigma, agent_app, endpoint)
+            except Exception:
+                outcome = "error"
+            recorder.add(time.perf_counter() - t0, outcome, active["users"])
+
+    stage_bounds = []
+    pool = ThreadPoolExecutor(max_workers=max(stages), thread_name_prefix="vuser")
+    try:
+        for users in stages:
+            stage_start = recorder.now()
+            with active_lock:
+                to_start = users - active["users"]
+                for i in range(to_start):
+                    pool.submit(user_loop, active["users"] + i)
+                active["users"] = users
+            print(f"👥 {users} utenti concorrenti per {stage_seconds:.0f}s...")
+            time.sleep(stage_seconds)
+            stage_bounds.append((users, stage_start, recorder.now()))
+    finally:
+        stage_stop.set()
+        pool.shutdown(wait=True)
+        recorder.stop()
+
+    stage_reports = [summarize_stage(recorder, users, start, end) for users, start, end in stage_bounds]
+    return {
+        "config": {
+            "stages": stages,
+            "stage_seconds": stage_seconds,
+            "amount_range": list(amount_range),
+            "profile_mix": profile_mix,
+            "mode": mode,
+            "model_median_s": median_s,
+            "model_sigma": sigma,
+            "llm_scheduler": LLM_SCHEDULER_ENABLED,
+        },
+        "stages": stage_reports,
+        "llm_scheduler": get_scheduler().snapshot() if LLM_SCHEDULER_ENABLED else {},
+        "provider": endpoint.stats() if endpoint is not None else {},
+        "saturation": find_saturation(stage_reports),
+        "timeline": {
+            "sessions": [
+                {"t": round(t, 3), "latency_s": round(lat, 4), "outcome": outcome, "users": u}
+                for t, lat, outcome, u in recorder.sessions
+            ],
+            "rss_mb": [{"t": round(t, 3), "mb": round(mb, 1)} for t, mb in recorder.rss],
+        },
+    }
+
+
+def summarize_stage(recorder: LoadRecorder, users: int, start: float, end: float) -> dict:
+    sessions = [s for s in recorder.sessions if start <= s[0] < end]
+    latencies = [lat for _, lat, outcome, _ in sessions if outcome == "ok"]
+    degraded = [lat for _, lat, outcome, _ in sessions if outcome == "degraded"]
+    errors = sum(1 for _, _, outcome, _ in sessions if outcome == "error")
+    rss = [mb for t, mb in recorder.rss if start <= t < end] or [recorder.rss[-1][1]]
+    duration = max(1e-9, end - start)
+    report = {
+        "users": users,
+        "sessions": len(sessions),
+        "throughput_per_s": len(latencies) / duration,
+        "error_rate": errors / len(sessions) if sessions else 0.0,
+        "degraded_rate": len(degraded) / len(sessions) if sessions else 0.0,
+        "rss_mb_max": max(rss),
+    }
+    if latencies:
+        report.update({
+            "p50_s": percentile(latencies, 50),
+            "p95_s": percentile(latencies, 95),
+            "p99_s": percentile(latencies, 99),
+        })
+    if degraded:
+        report.update({
+            "degraded_p50_s": percentile(degraded, 50),
+            "degraded_p95_s": percentile(degraded, 95),
+        })
+    return report
+
+
+def find_saturation(stages: list, min_gain: float = 0.10, max_error_rate: float = 0.01) -> dict:
+    """Primo gradino in cui aggiungere utenti non aumenta più il throughput.
+
+    Saturazione: il throughput cresce meno di `min_gain` rispetto al gradino
+    precedente (in proporzione agli utenti aggiunti) oppure gli errori superano
+    `max_error_rate`. Si restituisce l'ultimo gradino ancora sano.
+    """
+    for prev, cur in zip(stages, stages[1:]):
+        if cur["error_rate"] > max_error_rate:
+            return {"users": prev["users"], "reason": f"error rate {cur['error_rate']:.1%} a {cur['users']} utenti"}
+        if prev["throughput_per_s"] <= 0:
+            continue
+        user_gain = cur["users"] / prev["users"] - 1
+        tput_gain = cur["throughput_per_s"] / prev["throughput_per_s"] - 1
+        if user_gain > 0 and tput_gain < min_gain * user_gain:
+            return {
+                "users": prev["users"],
+                "reason": f"throughput +{tput_gain:.0%} con utenti +{user_gain:.0%} a {cur['users']} utenti",
+            }
+    return {"users": None, "reason": "nessuna saturazione entro i gradini provati"}
+
+
+# ------------ Report HTML ------------
+
+def _svg_line_chart(series: list, title: str, y_label: str, width: int = 720, height: int = 260) -> str:
+    """Grafico a linee SVG: series = [(etichetta, colore, [(x, y), ...]), ...]."""
+    points = [p for _, _, pts in series for p in pts]
+    if not points:
+        return ""
+    x_max = max(x for x, _ in points) or 1.0
+    y_max = max(y for _, y in points) or 1.0
+    pad = 45
+
+    def sx(x):
+        return pad + x / x_max * (width - 2 * pad)
+
+    def sy(y):
+        return height - pad - y / y_max * (height - 2 * pad)
+
+    parts = [
+        f'<svg width="{width}" height="{height}" xmlns="http://www.w3.org/2000/svg" font-family="sans-serif">',
+        f'<text x="{width / 2}" y="18" text-anchor="middle" font-size="14" font-weight="bold">{title}</text>',
+        f'<line x1="{pad}" y1="{height - pad}" x2="{width - pad}" y2="{height - pad}" stroke="#999"/>',
+        f'<line x1="{pad}" y1="{pad}" x2="{pad}" y2="{height - pad}" stroke="#999"/>',
+        f'<text x="{pad - 5}" y="{pad}" text-anchor="end" font-size="10">{y_max:.2f}</text>',
+        f'<text x="{pad - 5}" y="{height - pad}" text-anchor="end" font-size="10">0</text>',
+        f'<text x="{width - pad}" y="{height - pad + 15}" text-anchor="end" font-size="10">{x_max:.0f}s</text>',
+        f'<text x="12" y="{height / 2}" font-size="10" transform="rotate(-90 12 {height / 2})">{y_label}</text>',
+    ]
+    for i, (label, color, pts) in enumerate(series):
+        path = " ".join(f"{sx(x):.1f},{sy(y):.1f}" for x, y in pts)
+        parts.append(f'<polyline fill="none" stroke="{color}" stroke-width="2" points="{path}"/>')
+        parts.append(f'<text x="{width - pad}" y="{pad + 14 * i}" text-anchor="end" font-size="11" fill="{color}">{label}</text>')
+    parts.append("</svg>")
+    return "\n".join(parts)
+
+
+def _windowed(sessions: list, window_s: float = 5.0) -> list:
+    """Throughput e percentili di latenza per finestre temporali."""
+    if not sessions:
+        return []
+    end = max(s["t"] for s in sessions)
+    rows = []
+    t = 0.0
+    while t < end:
+        window = [s for s in sessions if t <= s["t"] < t + window_s]
+        ok = [s["latency_s"] for s in window if s["outcome"] == "ok"]
+        rows.append({
+            "t": t + window_s,
+            "throughput": len(ok) / window_s,
+            "p50": percentile(ok, 50) if ok else 0.0,
+            "p95": percentile(ok, 95) if ok else 0.0,
+            "p99": percentile(ok, 99) if ok else 0.0,
+            "degraded": sum(1 for s in window if s["outcome"] == "degraded"),
+            "errors": sum(1 for s in window if s["outcome"] == "error"),
+        })
+        t += window_s
+    return rows
+
+
+def render_html(report: dict) -> str:
+    windows = _windowed(report["timeline"]["sessions"])
+    charts = [
+        _svg_line_chart([("sessioni/s", "#1f77b4", [(w["t"], w["throughput"]) for w in windows])],
+                        "Throughput", "sessioni/s"),
+        _svg_line_chart([
+            ("p50", "#2ca02c", [(w["t"], w["p50"]) for w in windows]),
+            ("p95", "#ff7f0e", [(w["t"], w["p95"]) for w in windows]),
+            ("p99", "#d62728", [(w["t"], w["p99"]) for w in windows]),
+        ], "Latenza", "secondi"),
+        _svg_line_chart([("RSS", "#9467bd", [(r["t"], r["mb"]) for r in report["timeline"]["rss_mb"]])],
+                        "Memoria residente", "MB"),
+    ]
+    rows = "\n".join(
+        f"<tr><td>{s['users']}</td><td>{s['sessions']}</td><td>{s['throughput_per_s']:.2f}</td>"
+        f"<td>{s.get('p50_s', 0):.2f}</td><td>{s.get('p95_s', 0):.2f}</td><td>{s.get('p99_s', 0):.2f}</td>"
+        f"<td>{s['error_rate']:.1%}</td><td>{s['degraded_rate']:.1%}</td>"
+        f"<td>{s.get('degraded_p95_s', 0):.2f}</td><td>{s['rss_mb_max']:.0f}</td></tr>"
+        for s in report["stages"]
+    )
+    saturation = report["saturation"]
+    return f"""<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>Load test - Consulente di Investimento AI</title>
+<style>body{{font-family:sans-serif;margin:2rem}} table{{border-collapse:collapse}}
+td,th{{border:1px solid #ccc;padding:4px 10px;text-align:right}}</style></head>
+<body>
+<h1>💼 Load test</h1>
+<p><b>Saturazione:</b> {saturation['users'] if saturation['users'] is not None else 'n/d'} utenti
+({saturation['reason']})</p>
+<pre>{json.dumps(report['config'], indent=2, ensure_ascii=False)}</pre>
+<table><tr><th>Utenti</th><th>Sessioni</th><th>Sessioni/s</th><th>p50 (s)</th><th>p95 (s)</th>
+<th>p99 (s)</th><th>Errori</th><th>Degradate</th><th>p95 degradate (s)</th><th>RSS max (MB)</th></tr>
+{rows}
+</table>
+{''.join(f'<div>{c}</div>' for c in charts)}
+</body></html>
+"""
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test con utenti concorrenti e modello fittizio")
+    parser.add_argument("--stages", default="1,2,4,8,16,32",
+                        help="Utenti concorrenti per gradino, separati da virgola")
+    parser.add_argument("--stage-seconds", type=float, default=20.0)
+    parser.add_argument("--mode", choices=["auto", "agent", "fast"], default="agent")
+    parser.add_argument("--model-median", type=float, default=1.0, help="Latenza mediana del modello (s)")
+    parser.add_argument("--model-sigma", type=float, default=0.4, help="Dispersione log-normale della latenza")
+    parser.add_argument("--min-amount", type=float, default=1000.0)
+    parser.add_argument("--max-amount", type=float, default=100000.0)
+    parser.add_argument("--profile-mix", default="conservative=1,moderate=2,aggressive=1",
+                        help="Pesi dei profili di rischio")
+    parser.add_argument("--provider-rpm", type=int, default=0,
+                        help="Limite di richieste/minuto del provider fittizio (0 = nessun limite)")
+    parser.add_argument("--provider-tpm", type=int, default=0,
+                        help="Limite di token/minuto del provider fittizio (0 = nessun limite)")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--out", default="load_report", help="Prefisso dei file .json e .html")
+    args = parser.parse_args(argv)
+
+    stages = [int(x) for x in args.stages.split(",") if x.strip()]
+    profile_mix = {k: float(v) for k, v in (item.split("=") for item in args.profile_mix.split(","))}
+
+    endpoint = None
+    if args.provider_rpm or args.provider_tpm:
+        from llm_scheduler import configure_scheduler
+
+        rpm = args.provider_rpm or 10 ** 9
+        tpm = args.provider_tpm or 10 ** 12
+        endpoint = FakeRateLimitedEndpoint(rpm, tpm)
+        # Lo scheduler conosce gli stessi limiti del provider
+        configure_scheduler(rpm=rpm, tpm=tpm)
+
+    report = run_load(
+        stages, args.stage_seconds,
+        amount_range=(args.min_amount, args.max_amount),
+        profile_mix=profile_mix,
+        mode=args.mode,
+        median_s=args.model_median,
+        sigma=args.model_sigma,
+        seed=args.seed,
+        endpoint=endpoint,
+    )
+
+    with open(f"{args.out}.json", "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    with open(f"{args.out}.html", "w", encoding="utf-8") as f:
+        f.write(render_html(report))
+
+    print("\n" + "=" * 70)
+    print("📊 RISULTATI LOAD TEST")
+    print("=" * 70)
+    for s in report["stages"]:
+        print(f"👥 {s['users']:>4} utenti: {s['throughput_per_s']:6.2f} sessioni/s, "
+              f"p50 {s.get('p50_s', 0):.2f}s, p95 {s.get('p95_s', 0):.2f}s, p99 {s.get('p99_s', 0):.2f}s, "
+              f"errori {s['error_rate']:.1%}, RSS {s['rss_mb_max']:.0f} MB")
+        if s["degraded_rate"]:
+            print(f"   ⚠️  degradate {s['degraded_rate']:.1%}, p50 {s['degraded_p50_s']:.2f}s, "
+                  f"p95 {s['degraded_p95_s']:.2f}s (escluse da throughput e latenze)")
+    if report["llm_scheduler"]:
+        from llm_scheduler import get_scheduler
+        print("\n🚦 Scheduler LLM:")
+        print(get_scheduler().format_report())
+    if report["provider"]:
+        p = report["provider"]
+        print(f"🌐 Provider fittizio: {p['accepted']} chiamate accettate, {p['rejected_429']} rifiutate (429)")
+    sat = report["saturation"]
+    print(f"\n🎯 Saturazione: {sat['users'] if sat['users'] is not None else 'n/d'} utenti ({sat['reason']})")
+    print(f"✅ Report salvato in: {args.out}.json, {args.out}.html")
+
+
+if __name__ == "__main__":
+    main()
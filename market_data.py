@@ -0,0 +1,285 @@
+"""
+Record tipizzati dei risultati dei tools e reducer di `market_data`
+I dati restituiti dai tools vengono accumulati nello stato man mano che
+sono prodotti, così finalize e dashboard non devono ri-analizzare il testo
+"""
+import re
+from collections.abc import Mapping
+from dataclasses import dataclass
+from typing import TypedDict, Optional
+
+
+class _Record(Mapping):
+    """Base dei record: attributi in `__slots__` (niente `__dict__` per istanza)
+    con accesso in sola lettura in stile dizionario (`record["price"]`, `.get`)."""
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def __iter__(self):
+        return iter(self.__slots__)
+
+    def __len__(self):
+        return len(self.__slots__)
+
+    def to_dict(self) -> dict:
+        return {key: getattr(self, key) for key in self.__slots__}
+
+
+@dataclass(slots=True)
+class QuoteRecord(_Record):
+    symbol: str
+    price: float
+    change_percent: float
+    volume: int
+
+
+@dataclass(slots=True)
+class OverviewRecord(_Record):
+    sp500_change: float
+    nasdaq_change: float
+    dow_change: float
+    vix: float
+    sentiment: str
+    sector_leaders: list
+
+
+@dataclass(slots=True)
+class SectorRecord(_Record):
+    sector: str
+    ytd_performance: float
+    trend: str
+    top_stocks: list
+    volatility: str
+
+
+@dataclass(slots=True)
+class AllocationRecord(_Record):
+    total_amount: float
+    risk_profile: str
+    allocation: dict
+    allocation_percentages: dict
+
+
+@dataclass(slots=True)
+class PositionRecord(_Record):
+    """Posizione raccomandata: prodotta sia dal fast path sia dalla risposta dell'agente."""
+    ticker: str
+    sector: str
+    amount: float
+    weight: float  # frazione del capitale totale
+    price: Optional[float] = None  # prezzo di riferimento visto dall'analisi
+    change_percent: Optional[float] = None
+    volume: Optional[int] = None
+    shares: Optional[float] = None
+
+
+# Tipi da autorizzare nel serializer dei checkpoint
+RECORD_TYPES = (QuoteRecord, OverviewRecord, SectorRecord, AllocationRecord, PositionRecord)
+
+
+class MarketData(TypedDict, total=False):
+    """Contenuto di `InvestmentAgentState.market_data`."""
+    overview: OverviewRecord
+    allocation: AllocationRecord
+    sectors: dict  # nome settore -> SectorRecord
+    quotes: dict  # simbolo -> QuoteRecord
+    snapshot_version: int
+
+
+def quote_record(output: dict) -> QuoteRecord:
+    return QuoteRecord(
+        symbol=output["symbol"],
+        price=output["price"],
+        change_percent=output["change_percent"],
+        volume=output["volume"],
+    )
+
+
+def overview_record(output: dict) -> OverviewRecord:
+    return OverviewRecord(
+        sp500_change=output["sp500_change"],
+        nasdaq_change=output["nasdaq_change"],
+        dow_change=output["dow_change"],
+        vix=output["vix"],
+        sentiment=output["sentiment"],
+        sector_leaders=list(output["sector_leaders"]),
+    )
+
+
+def sector_record(output: dict) -> SectorRecord:
+    return SectorRecord(
+        sector=output["sector"],
+        ytd_performance=output["ytd_performance"],
+        trend=output["trend"],
+        top_stocks=list(output["top_stocks"]),
+        volatility=output["volatility"],
+    )
+
+
+def allocation_record(output: dict) -> AllocationRecord:
+    return AllocationRecord(
+        total_amount=output["total_amount"],
+        risk_profile=output["risk_profile"],
+        allocation=dict(output["allocation"]),
+        allocation_percentages=dict(output["allocation_percentages"]),
+    )
+
+
+def position_record(output: dict) -> PositionRecord:
+    return PositionRecord(
+        ticker=output["ticker"],
+        sector=output["sector"],
+        amount=output["amount"],
+        weight=output["weight"],
+        price=output.get("price"),
+        change_percent=output.get("change_percent"),
+        volume=output.get("volume"),
+        shares=output.get("shares"),
+    )
+
+
+# Righe "TICKER: €importo" della risposta del modello. Il prompt chiede il formato inglese
+# (€12,345.67) ma si accettano anche i separatori italiani (€12.345,67) e il markdown
+# attorno al ticker (**MSFT**: €1.000, `AAPL:` €500)
+_TICKER_AMOUNT_PATTERN = re.compile(
+    r'(?<![A-Za-z0-9])[*_`]*([A-Z]{2,5})[*_`]*\s*:\s*[*_`]*\s*€\s*(\d[\d.,]*)'
+)
+
+# Parole maiuscole che precedono importi senza essere ticker
+NON_TICKER_WORDS = frozenset({"ETF", "USD", "EUR", "VIX", "YTD", "TOTAL", "CASH"})
+
+# Categoria dei ticker fuori dall'universo conosciuto
+UNKNOWN_SECTOR = "Other"
+
+
+def parse_euro_amount(text: str) -> float:
+    """Importo con separatori inglesi o italiani: "2,500.00", "2.500,00", "1.000", "2,5".
+
+    Se compaiono entrambi i separatori l'ultimo è quello decimale; un separatore
+    solo, ripetuto o seguito da esattamente tre cifre, è quello delle migliaia.
+    """
+    text = text.rstrip(".,")
+    if "." in text and "," in text:
+        decimal = "." if text.rfind(".") > text.rfind(",") else ","
+        thousands = "," if decimal == "." else "."
+        return float(text.replace(thousands, "").replace(decimal, "."))
+    for sep in (".", ","):
+        if sep in text:
+            head, _, tail = text.rpartition(sep)
+            if text.count(sep) > 1 or len(tail) == 3:
+                return float(text.replace(sep, ""))
+            return float(f"{head}.{tail}")
+    return float(text)
+
+
+def ticker_amounts(answer: str) -> dict:
+    """Ticker -> importo citati nel testo; ogni ticker conta una volta (vale il primo importo)."""
+    found = {}
+    for match in _TICKER_AMOUNT_PATTERN.finditer(answer or ""):
+        ticker = match.group(1)
+        if ticker in NON_TICKER_WORDS:
+            continue
+        try:
+            found.setdefault(ticker, parse_euro_amount(match.group(2)))
+        except ValueError:
+            continue
+    return found
+
+
+def positions_from_answer(answer: str, data: Optional[MarketData], total_amount: float,
+                          ticker_sectors: Mapping = None) -> list:
+    """Posizioni citate nella risposta dell'agente, completate con le quotazioni in `market_data`.
+
+    Il settore viene dai settori analizzati, poi da `ticker_sectors` (settori ed ETF
+    dell'universo), altrimenti è `UNKNOWN_SECTOR`.
+    """
+    data = data or {}
+    quotes = data.get("quotes") or {}
+    sectors = {
+        ticker: name
+        for name, sector in (data.get("sectors") or {}).items()
+        for ticker in sector["top_stocks"]
+    }
+
+    positions = []
+    for ticker, amount in ticker_amounts(answer).items():
+        quote = quotes.get(ticker)
+        price = quote["price"] if quote else None
+        positions.append(PositionRecord(
+            ticker=ticker,
+            sector=sectors.get(ticker) or (ticker_sectors or {}).get(ticker, UNKNOWN_SECTOR),
+            amount=amount,
+            weight=round(amount / total_amount, 4) if total_amount else 0.0,
+            price=price,
+            change_percent=quote["change_percent"] if quote else None,
+            volume=quote["volume"] if quote else None,
+            shares=round(amount / price, 4) if price else None,
+        ))
+    return positions
+
+
+def market_data_update(tool_name: str, output) -> Optional[MarketData]:
+    """Converte l'output di un tool nell'aggiornamento parziale di `market_data`."""
+    if not isinstance(output, dict):
+        return None
+    if tool_name == "get_stock_quote":
+        record = quote_record(output)
+        return {"quotes": {record["symbol"]: record}}
+    if tool_name == "get_market_overview":
+        return {"overview": overview_record(output)}
+    if tool_name == "analyze_sector_performance":
+        record = sector_record(output)
+        return {"sectors": {record["sector"]: record}}
+    if tool_name == "calculate_portfolio_allocation":
+        return {"allocation": allocation_record(output)}
+    if tool_name == "analyze_sectors":
+        sectors, quotes = {}, {}
+        for entry in output.get("ranking", []):
+            sectors[entry["sector"]] = sector_record(entry)
+            for quote in entry.get("quotes", []):
+                quotes[quote["symbol"]] = quote_record(quote)
+        return {"sectors": sectors, "quotes": quotes}
+    return None
+
+
+def merge_market_data(left: Optional[MarketData], right: Optional[MarketData]) -> MarketData:
+    """Reducer di LangGraph: unisce quotazioni e settori per chiave, sostituisce il resto."""
+    if not left:
+        return dict(right or {})
+    if not right:
+        return left
+    merged = {**left, **right}
+    for key in ("quotes", "sectors"):
+        if key in left and key in right:
+            merged[key] = {**left[key], **right[key]}
+    return merged
+
+
+def merge_market_data_batch(state: Optional[MarketData], writes: list) -> MarketData:
+    """Reducer a lotti per `DeltaChannel`: applica in ordine gli aggiornamenti del super-step."""
+    for update in writes:
+        state = merge_market_data(state, update)
+    return state if state is not None else {}
+
+
+def market_data_to_dict(data: Optional[MarketData]) -> dict:
+    """Copia di `market_data` con soli tipi JSON (record convertiti in dizionari)."""
+    plain = {}
+    for key, value in (data or {}).items():
+        if isinstance(value, _Record):
+            plain[key] = value.to_dict()
+        elif key in ("quotes", "sectors"):
+            plain[key] = {k: r.to_dict() if isinstance(r, _Record) else r for k, r in value.items()}
+        else:
+            plain[key] = value
+    return plain
+
+
+def positions_to_dicts(positions: Optional[list]) -> list:
+    """Posizioni raccomandate con soli tipi JSON."""
+    return [p.to_dict() for p in positions or []]
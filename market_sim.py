@@ -0,0 +1,432 @@
+"""
+Simulatore di mercato locale, riproducibile e vettorizzato
+Un unico stato NumPy (GBM con fattore di mercato e fattori settoriali) produce
+quotazioni coerenti per tutto l'universo, gli indici e il VIX; avanza a tick
+e alimenta tutti i tools come feed offline per test, benchmark e demo
+"""
+import os
+import sys
+import time
+import zlib
+import argparse
+import threading
+from functools import lru_cache
+
+import numpy as np
+
+
+_SEED_ENV = os.getenv("MARKET_SIM_SEED")
+_TICK_ENV = os.getenv("MARKET_SIM_TICK_SECONDS")
+MARKET_SIM_SEED = int(_SEED_ENV or "42")
+# Secondi reali per tick (0 = il mercato avanza solo con advance()).
+# Con un seed e senza valore esplicito il default è 0: lo stesso seed riproduce lo stesso mercato
+MARKET_SIM_TICK_SECONDS = float(_TICK_ENV or ("0" if _SEED_ENV else "1.0"))
+# Ticker fuori universo di cui si conservano i parametri (cache LRU, fuori dallo stato simulato)
+MARKET_SIM_ADHOC_SYMBOLS = int(os.getenv("MARKET_SIM_ADHOC_SYMBOLS", "256"))
+
+TICKS_PER_DAY = 390  # un tick per minuto di contrattazione
+TRADING_DAYS = 252
+HISTORY_DAYS = 60  # chiusure giornaliere conservate per trend e volatilità
+WARMUP_DAYS = 120  # giorni simulati all'avvio, così YTD e trend hanno senso
+
+# Universo: settore -> {ticker: (prezzo iniziale, capitalizzazione in miliardi)}
+SECTORS = {
+    "Technology": {"AAPL": (180.0, 2900), "MSFT": (380.0, 2800), "NVDA": (500.0, 1200), "GOOGL": (140.0, 1750)},
+    "Healthcare": {"JNJ": (155.0, 375), "UNH": (520.0, 480), "PFE": (28.0, 160), "ABBV": (170.0, 300)},
+    "Energy": {"XOM": (110.0, 440), "CVX": (150.0, 280), "COP": (115.0, 135), "SLB": (50.0, 70)},
+    "Financials": {"JPM": (190.0, 550), "BAC": (35.0, 275), "WFC": (55.0, 200), "GS": (450.0, 150)},
+    "Consumer": {"AMZN": (150.0, 1550), "TSLA": (250.0, 800), "NKE": (95.0, 145), "MCD": (290.0, 210)},
+}
+
+# Parametri annualizzati per settore: drift, volatilità del fattore settoriale, beta di mercato
+SECTOR_PARAMS = {
+    "Technology": (0.12, 0.18, 1.25),
+    "Healthcare": (0.07, 0.10, 0.75),
+    "Energy": (0.06, 0.22, 0.95),
+    "Financials": (0.08, 0.14, 1.10),
+    "Consumer": (0.09, 0.16, 1.05),
+}
+IDIOSYNCRATIC_VOL = 0.20
+
+# ETF: ticker -> (prezzo iniziale, beta di mercato, settore o None, volatilità propria)
+ETFS = {
+    "SPY": (450.0, 1.0, None, 0.01),
+    "QQQ": (380.0, 1.2, "Technology", 0.02),
+    "VTI": (240.0, 1.0, None, 0.01),
+    "BND": (75.0, -0.05, None, 0.05),
+}
+# Categoria delle posizioni in ETF: azionari a indice o obbligazionari
+ETF_SECTORS = {"SPY": "ETF", "QQQ": "ETF", "VTI": "ETF", "BND": "Bonds"}
+
+# Settore o categoria di ogni ticker dell'universo
+TICKER_SECTORS = {
+    **{ticker: sector for sector, members in SECTORS.items() for ticker in members},
+    **ETF_SECTORS,
+}
+
+# Composizione degli indici
+DOW_MEMBERS = ("AAPL", "MSFT", "JPM", "GS", "JNJ", "UNH", "CVX", "MCD", "NKE", "AMZN")
+NASDAQ_SECTORS = ("Technology", "Consumer")
+
+# VIX: processo mean-reverting con shock correlati negativamente al fattore di mercato
+VIX_MEAN, VIX_KAPPA, VIX_VOL, VIX_MARKET_CORR = 17.0, 5.0, 0.9, -0.7
+VIX_FLOOR = 9.0
+
+
+def _vix_path(vix: float, shocks: np.ndarray, dt: float) -> np.ndarray:
+    """VIX a inizio di ogni passo più il valore finale (n + 1 valori).
+
+    Il passo di Eulero v[k+1] = v[k] * (1 - kappa*dt + shock[k]) + kappa*mean*dt è lineare:
+    con i prodotti cumulati p dei fattori vale v[k] = p[k] * (v[0] + kappa*mean*dt * sum_j 1/p[j+1]).
+    Il minimo a VIX_FLOOR interrompe la formula: si riparte dal minimo dal primo passo che lo tocca.
+    """
+    n = len(shocks)
+    growth = 1.0 - VIX_KAPPA * dt + shocks
+    pull = VIX_KAPPA * VIX_MEAN * dt
+    path = np.empty(n + 1)
+    start = 0
+    while True:
+        p = np.exp(np.concatenate(([0.0], np.cumsum(np.log(growth[start:])))))
+        segment = p * (vix + pull * np.concatenate(([0.0], np.cumsum(1.0 / p[1:]))))
+        floored = np.flatnonzero(segment[1:] < VIX_FLOOR)
+        if not len(floored):
+            path[start:] = segment
+            return path
+        stop = start + floored[0] + 1
+        path[start:stop] = segment[:stop - start]
+        start, vix = stop, VIX_FLOOR
+
+
+class MarketSimulator:
+    """Stato di mercato vettorizzato; tutte le letture sono coerenti con lo stesso tick."""
+
+    def __init__(self, seed: int = None, tick_seconds: float = None, warmup_days: int = WARMUP_DAYS):
+        """Con un `seed` esplicito, senza `tick_seconds` né MARKET_SIM_TICK_SECONDS, il mercato avanza solo con advance()."""
+        if tick_seconds is None:
+            tick_seconds = MARKET_SIM_TICK_SECONDS if seed is None or _TICK_ENV else 0.0
+        self.seed = MARKET_SIM_SEED if seed is None else seed
+        self.tick_seconds = tick_seconds
+        self._rng = np.random.default_rng(self.seed)
+        self._lock = threading.RLock()
+
+        symbols, sector_of, prices, caps = [], [], [], []
+        for sector, members in SECTORS.items():
+            for symbol, (price, cap) in members.items():
+                symbols.append(symbol)
+                sector_of.append(sector)
+                prices.append(price)
+                caps.append(cap)
+        self.sector_names = list(SECTORS)
+        sector_idx = [self.sector_names.index(s) for s in sector_of]
+        n_stocks = len(symbols)
+
+        drift = [SECTOR_PARAMS[s][0] for s in sector_of]
+        beta = [SECTOR_PARAMS[s][2] for s in sector_of]
+        sector_vol = [SECTOR_PARAMS[s][1] for s in sector_of]
+        idio = [IDIOSYNCRATIC_VOL] * n_stocks
+        for symbol, (price, etf_beta, sector, own_vol) in ETFS.items():
+            symbols.append(symbol)
+            sector_idx.append(self.sector_names.index(sector) if sector else -1)
+            prices.append(price)
+            caps.append(0)
+            drift.append(0.03 if symbol == "BND" else 0.08)
+            beta.append(etf_beta)
+            sector_vol.append(SECTOR_PARAMS[sector][1] * 0.5 if sector else 0.0)
+            idio.append(own_vol)
+
+        self.symbols = symbols
+        self.index_of = {s: i for i, s in enumerate(symbols)}
+        self.n_stocks = n_stocks
+        self._sector_idx = np.array(sector_idx)
+        self._drift = np.array(drift)
+        self._beta = np.array(beta)
+        self._sector_vol = np.array(sector_vol)
+        self._idio = np.array(idio)
+        self._shares = np.array([c * 1e9 / p if c else 0.0 for c, p in zip(caps, prices)])
+        self._avg_daily_volume = np.where(self._shares > 0, self._shares * 0.006, 4e7)
+
+        self.prices = np.array(prices, dtype=np.float64)
+        self.day_open = self.prices.copy()
+        self.year_open = self.prices.copy()
+        self.day_volume = np.zeros(len(symbols), dtype=np.int64)
+        self.closes = np.tile(self.prices, (HISTORY_DAYS, 1))
+        self.vix = VIX_MEAN
+        self.tick = 0
+        self.day = 0
+        self.version = 0
+
+        self._members = {
+            name: np.flatnonzero(self._sector_idx[:n_stocks] == k) for k, name in enumerate(self.sector_names)
+        }
+        self._dow = np.array([self.index_of[s] for s in DOW_MEMBERS])
+        self._nasdaq = np.concatenate([self._members[s] for s in NASDAQ_SECTORS])
+        self.index_open = self._index_levels(self.prices)
+        self.index_origin = self.index_open.copy()
+
+        # I prezzi iniziali fanno da apertura d'anno; il warmup genera la storia fino a
+        # metà della seduta corrente, così anche le variazioni giornaliere hanno senso
+        if warmup_days:
+            self._advance_days(warmup_days)
+            self.advance(TICKS_PER_DAY // 2)
+        self._clock_origin = time.monotonic()
+        self._clock_tick0 = self.tick
+
+    # ------------ Dinamica ------------
+
+    def _step(self, n: int, dt: float) -> np.ndarray:
+        """Simula n passi di durata dt (anni); restituisce i prezzi a ogni passo (n, N)."""
+        rng = self._rng
+        z_market = rng.standard_normal(n)
+        z_sector = rng.standard_normal((n, len(self.sector_names)))
+        z_idio = rng.standard_normal((n, len(self.symbols)))
+
+        # VIX lungo il percorso: sale quando il fattore di mercato scende.
+        # Ogni passo usa la volatilità di inizio passo (schema di Eulero non anticipativo)
+        rho = VIX_MARKET_CORR
+        shocks = VIX_VOL * np.sqrt(dt) * (rho * z_market + np.sqrt(1 - rho ** 2) * rng.standard_normal(n))
+        vix_path = _vix_path(self.vix, shocks, dt)
+        self.vix = vix_path[-1]
+
+        market_vol = vix_path[:-1, None] / 100.0
+        sector_shock = np.where(self._sector_idx >= 0, z_sector[:, self._sector_idx], 0.0)
+        sigma2 = (self._beta * market_vol) ** 2 + self._sector_vol ** 2 + self._idio ** 2
+        log_ret = (
+            (self._drift - 0.5 * sigma2) * dt
+            + np.sqrt(dt) * (
+                self._beta * market_vol * z_market[:, None]
+                + self._sector_vol * sector_shock
+                + self._idio * z_idio
+            )
+        )
+        return self.prices * np.exp(np.cumsum(log_ret, axis=0))
+
+    def _advance_days(self, days: int):
+        path = self._step(days, 1.0 / TRADING_DAYS)
+        self.prices = path[-1]
+        self.closes = np.vstack([self.closes, path])[-HISTORY_DAYS:]
+        self.day += days
+        self.day_open = self.prices.copy()
+        self.index_open = self._index_levels(self.prices)
+        self.day_volume[:] = 0
+
+    def advance(self, ticks: int = 1) -> int:
+        """Avanza di `ticks` minuti di contrattazione; restituisce la nuova versione dello stato."""
+        with self._lock:
+            remaining = ticks
+            while remaining > 0:
+                left_today = TICKS_PER_DAY - self.tick % TICKS_PER_DAY
+                n = min(remaining, left_today)
+                path = self._step(n, 1.0 / (TRADING_DAYS * TICKS_PER_DAY))
+                returns = np.abs(path[-1] / self.prices - 1.0)
+                tick_volume = self._avg_daily_volume / TICKS_PER_DAY * n
+                noise = self._rng.lognormal(0.0, 0.3, len(self.symbols))
+                self.day_volume += (tick_volume * noise * (1.0 + 50.0 * returns)).astype(np.int64)
+                self.prices = path[-1]
+                self.tick += n
+                remaining -= n
+                if self.tick % TICKS_PER_DAY == 0:
+                    # Chiusura: la storia giornaliera scorre e si apre una nuova sessione
+                    self.closes = np.vstack([self.closes[1:], self.prices])
+                    self.day += 1
+                    self.day_open = self.prices.copy()
+                    self.index_open = self._index_levels(self.prices)
+                    self.day_volume[:] = 0
+            self.version += 1
+            return self.version
+
+    def sync(self):
+        """Porta il mercato al tick corrispondente al tempo reale trascorso."""
+        if self.tick_seconds <= 0:
+            return
+        with self._lock:
+            elapsed_ticks = int((time.monotonic() - self._clock_origin) / self.tick_seconds)
+            due = elapsed_ticks - (self.tick - self._clock_tick0)
+            if due > 0:
+                self.advance(due)
+
+    # ------------ Letture ------------
+
+    def _index_levels(self, prices: np.ndarray) -> np.ndarray:
+        stocks = prices[:self.n_stocks]
+        return np.array([stocks.mean(), stocks[self._nasdaq].mean(), stocks[self._dow].mean()])
+
+    def _adhoc_quote(self, symbol: str) -> dict:
+        """Quotazione di un ticker fuori universo, senza toccare lo stato simulato.
+
+        Il prezzo segue il fattore di mercato (S&P 500 dall'avvio) con il beta del ticker
+        e uno scarto giornaliero deterministico: stesso seed e stesso tick, stessa quotazione.
+        """
+        base, beta, shares = _adhoc_params(self.seed, symbol)
+        market_now = float(self._index_levels(self.prices)[0])
+        market_open, origin = float(self.index_open[0]), float(self.index_origin[0])
+        noise = _adhoc_daily_noise(self.seed, symbol, self.day)
+        price = base * (market_now / origin) ** beta * noise
+        day_open = base * (market_open / origin) ** beta * noise
+        elapsed = (self.tick % TICKS_PER_DAY) / TICKS_PER_DAY
+        cap = shares * price / 1e9
+        return {
+            "symbol": symbol,
+            "price": round(price, 2),
+            "change_percent": round((price / day_open - 1.0) * 100, 2),
+            "volume": int(shares * 0.006 * elapsed),
+            "market_cap": f"${cap:,.0f}B",
+        }
+
+    def _quote(self, symbol: str) -> dict:
+        i = self.index_of.get(symbol.upper())
+        if i is None:
+            return self._adhoc_quote(symbol.upper())
+        price = float(self.prices[i])
+        change = float(price / self.day_open[i] - 1.0) * 100
+        cap = self._shares[i] * price / 1e9
+        return {
+            "symbol": self.symbols[i],
+            "price": round(price, 2),
+            "change_percent": round(change, 2),
+            "volume": int(self.day_volume[i]),
+            "market_cap": f"${cap:,.0f}B" if cap else "N/A",
+        }
+
+    def quote(self, symbol: str) -> dict:
+        """Quotazione nel formato di `get_stock_quote`."""
+        self.sync()
+        with self._lock:
+            return self._quote(symbol)
+
+    def quotes(self, symbols) -> dict:
+        """Quotazioni di più simboli lette dallo stesso tick."""
+        self.sync()
+        with self._lock:
+            return {s.upper(): self._quote(s) for s in symbols}
+
+    def _sector_momentum(self) -> dict:
+        momentum = self.prices / self.closes[-20] - 1.0
+        return {name: float(momentum[idx].mean()) for name, idx in self._members.items()}
+
+    def overview(self) -> dict:
+        """Panoramica nel formato di `get_market_overview`."""
+        self.sync()
+        with self._lock:
+            change = (self._index_levels(self.prices) / self.index_open - 1.0) * 100
+            sp500, nasdaq, dow = (round(float(c), 2) for c in change)
+            if sp500 > 0.3 and self.vix < 20:
+                sentiment = "bullish"
+            elif sp500 < -0.3 or self.vix > 28:
+                sentiment = "bearish"
+            else:
+                sentiment = "neutral"
+            momentum = self._sector_momentum()
+            leaders = sorted(momentum, key=momentum.get, reverse=True)[:3]
+            return {
+                "sp500_change": sp500,
+                "nasdaq_change": nasdaq,
+                "dow_change": dow,
+                "vix": round(float(self.vix), 2),
+                "sentiment": sentiment,
+                "sector_leaders": leaders,
+            }
+
+    def sector(self, name: str) -> dict:
+        """Analisi di settore nel formato di `analyze_sector_performance`."""
+        self.sync()
+        with self._lock:
+            idx = self._members.get(name)
+            if idx is None:
+                return {"sector": name, "ytd_performance": 0.0, "trend": "stable",
+                        "top_stocks": ["N/A"], "volatility": "medium"}
+            ytd = self.prices[idx] / self.year_open[idx] - 1.0
+            momentum = self._sector_momentum()[name]
+            daily = np.diff(np.log(self.closes[:, idx]), axis=0).mean(axis=1)
+            realized_vol = float(daily.std() * np.sqrt(TRADING_DAYS))
+            trend = "upward" if momentum > 0.02 else "downward" if momentum < -0.02 else "stable"
+            volatility = "low" if realized_vol < 0.15 else "medium" if realized_vol < 0.25 else "high"
+            order = np.argsort(-ytd)
+            return {
+                "sector": name,
+                "ytd_performance": round(float(ytd.mean()) * 100, 2),
+                "trend": trend,
+                "top_stocks": [self.symbols[idx[k]] for k in order],
+                "volatility": volatility,
+            }
+
+    def price_vector(self) -> tuple:
+        """(versione, simboli, prezzi, variazioni % giornaliere) come copie coerenti."""
+        with self._lock:
+            prices = self.prices.copy()
+            return self.version, list(self.symbols), prices, (prices / self.day_open - 1.0) * 100
+
+    def latest_prices(self) -> dict:
+        """Tabella simbolo -> (prezzo, variazione % giornaliera) per l'intero universo."""
+        self.sync()
+        with self._lock:
+            change = (self.prices / self.day_open - 1.0) * 100
+            return {s: (float(self.prices[i]), float(change[i])) for i, s in enumerate(self.symbols)}
+
+
+@lru_cache(maxsize=MARKET_SIM_ADHOC_SYMBOLS)
+def _adhoc_params(seed: int, symbol: str) -> tuple:
+    """(prezzo iniziale, beta, azioni in circolazione) deterministici per un ticker fuori universo."""
+    rng = np.random.default_rng(zlib.crc32(f"{seed}:{symbol}".encode()))
+    price = float(rng.uniform(20.0, 300.0))
+    return price, float(rng.uniform(0.6, 1.4)), float(rng.uniform(50, 500)) * 1e9 / price
+
+
+def _adhoc_daily_noise(seed: int, symbol: str, day: int) -> float:
+    rng = np.random.default_rng(zlib.crc32(f"{seed}:{symbol}:{day}".encode()))
+    return float(np.exp(rng.normal(0.0, IDIOSYNCRATIC_VOL * np.sqrt(1.0 / TRADING_DAYS))))
+
+
+_market = None
+_market_lock = threading.Lock()
+
+
+def get_market() -> MarketSimulator:
+    """Simulatore condiviso dal processo, creato al primo utilizzo."""
+    global _market
+    with _market_lock:
+        if _market is None:
+            _market = MarketSimulator()
+        return _market
+
+
+def reset_market(seed: int = None, tick_seconds: float = None) -> MarketSimulator:
+    """Ricrea il simulatore condiviso (es. per benchmark riproducibili)."""
+    global _market
+    with _market_lock:
+        _market = MarketSimulator(seed, tick_seconds)
+        return _market
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Simulatore di mercato locale")
+    parser.add_argument("--seed", type=int, default=MARKET_SIM_SEED)
+    parser.add_argument("--days", type=int, default=1, help="Giorni di contrattazione da simulare")
+    parser.add_argument("--benchmark", action="store_true", help="Misura tick/s e letture/s")
+    args = parser.parse_args(argv)
+
+    sim = MarketSimulator(args.seed, tick_seconds=0)
+    t0 = time.perf_counter()
+    sim.advance(args.days * TICKS_PER_DAY)
+    elapsed = time.perf_counter() - t0
+
+    overview = sim.overview()
+    print(f"📈 S&P 500 {overview['sp500_change']:+.2f}%  NASDAQ {overview['nasdaq_change']:+.2f}%  "
+          f"DOW {overview['dow_change']:+.2f}%  VIX {overview['vix']:.2f} ({overview['sentiment']})")
+    for name in sim.sector_names:
+        s = sim.sector(name)
+        print(f"   {name:<11} YTD {s['ytd_performance']:+6.2f}%  {s['trend']:<8} {s['volatility']:<6} "
+              f"top: {', '.join(s['top_stocks'][:2])}")
+
+    if args.benchmark:
+        ticks = args.days * TICKS_PER_DAY
+        print(f"\n⏱️  {ticks} tick x {len(sim.symbols)} simboli in {elapsed * 1000:.1f} ms "
+              f"({ticks / elapsed:,.0f} tick/s)")
+        n = 20000
+        t0 = time.perf_counter()
+        for k in range(n):
+            sim.quote(sim.symbols[k % len(sim.symbols)])
+        print(f"⏱️  {n / (time.perf_counter() - t0):,.0f} quotazioni/s")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,69 @@
+"""
+Metriche delle chiamate al modello per tier (router, writer, escalation)
+Latenza e token (inclusi quelli serviti dalla prompt cache) per confrontare
+il costo dei diversi modelli
+"""
+import threading
+
+
+class ModelCallMetrics:
+    """Accumulatore thread-safe di latenza e token per tier di modello."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tiers = {}
+
+    def record(self, tier: str, model_name: str, latency_s: float, response=None):
+        """Registra una chiamata; i token sono letti da `usage_metadata` se presente."""
+        usage = getattr(response, "usage_metadata", None) or {}
+        cached = (usage.get("input_token_details") or {}).get("cache_read", 0)
+        with self._lock:
+            stats = self._tiers.setdefault(tier, {
+                "model": model_name,
+                "calls": 0,
+                "latency_s": 0.0,
+                "max_latency_s": 0.0,
+                "input_tokens": 0,
+                "cached_input_tokens": 0,
+                "output_tokens": 0,
+            })
+            stats["calls"] += 1
+            stats["latency_s"] += latency_s
+            stats["max_latency_s"] = max(stats["max_latency_s"], latency_s)
+            stats["input_tokens"] += usage.get("input_tokens", 0)
+            stats["cached_input_tokens"] += cached
+            stats["output_tokens"] += usage.get("output_tokens", 0)
+
+    def snapshot(self) -> dict:
+        """Restituisce totali e medie per tier."""
+        with self._lock:
+            result = {}
+            for tier, stats in self._tiers.items():
+                calls = stats["calls"] or 1
+                result[tier] = {
+                    **stats,
+                    "avg_latency_s": stats["latency_s"] / calls,
+                    "avg_input_tokens": stats["input_tokens"] / calls,
+                    "avg_output_tokens": stats["output_tokens"] / calls,
+                    "cache_hit_ratio": stats["cached_input_tokens"] / stats["input_tokens"]
+                    if stats["input_tokens"] else 0.0,
+                }
+            return result
+
+    def reset(self):
+        with self._lock:
+            self._tiers.clear()
+
+    def format_report(self) -> str:
+        """Tabella testuale per la stampa da CLI."""
+        lines = [f"{'Tier':<20}{'Modello':<18}{'Chiamate':>9}{'Lat. media':>12}{'Tok. in':>10}"
+                 f"{'Cached':>10}{'Tok. out':>10}"]
+        for tier, s in sorted(self.snapshot().items()):
+            lines.append(
+                f"{tier:<20}{s['model']:<18}{s['calls']:>9}{s['avg_latency_s']:>11.2f}s"
+                f"{s['input_tokens']:>10}{s['cached_input_tokens']:>10}{s['output_tokens']:>10}"
+            )
+        return "\n".join(lines)
+
+
+model_metrics = ModelCallMetrics()
@@ -0,0 +1,53 @@
+"""
+Prompt dell'agente di investimento
+Il prefisso (system prompt + schema dei tools) è identico byte per byte tra
+le richieste, così il provider può servirlo dalla prompt cache; i dati
+variabili dell'utente stanno in fondo
+"""
+import hashlib
+import json
+
+from langchain_core.messages import SystemMessage, HumanMessage
+from langchain_core.utils.function_calling import convert_to_openai_tool
+
+
+# Non interpolare valori per-richiesta qui: ogni variazione invalida la cache del prefisso
+SYSTEM_PROMPT = """Sei un consulente di investimento AI. L'utente indica nel suo messaggio l'importo da investire e il proprio profilo di rischio (conservative, moderate, aggressive).
+
+Per ogni richiesta:
+1. Analizza la situazione attuale del mercato usando get_market_overview
+2. Calcola l'allocazione ottimale del portafoglio con calculate_portfolio_allocation
+3. Confronta i settori con una sola chiamata ad analyze_sectors, passando il profilo di rischio: restituisce la classifica dei settori con le quotazioni dei titoli principali
+4. Usa get_stock_quote o analyze_sector_performance solo per titoli o settori non coperti dalla classifica
+5. Fornisci raccomandazioni dettagliate con razionale
+
+Sii specifico e fornisci ticker, percentuali di allocazione, e giustificazioni.
+
+Nella sezione "### Raccomandazioni" scrivi una riga per posizione, senza grassetto, nel formato:
+- TICKER: €12,345.67
+con la virgola per le migliaia e il punto per i decimali. Chiudi con la sezione "### Conclusione"."""
+
+
+def build_user_message(amount: float, risk_profile: str) -> HumanMessage:
+    """Messaggio con i soli dati variabili della richiesta."""
+    return HumanMessage(
+        content=f"""Sono un investitore con €{amount:,.2f} da investire.
+
+Il mio profilo di rischio è: {risk_profile}"""
+    )
+
+
+def build_messages(amount: float, risk_profile: str) -> list:
+    """Messaggi iniziali: prefisso stabile prima, dati dell'utente per ultimi."""
+    return [SystemMessage(content=SYSTEM_PROMPT), build_user_message(amount, risk_profile)]
+
+
+def prompt_prefix_fingerprint(tools: list) -> str:
+    """Hash del prefisso cacheabile (schema dei tools + system prompt).
+
+    Deve restare identico tra richieste diverse: utile per verificare che
+    una modifica non abbia introdotto dati variabili nel prefisso.
+    """
+    schemas = [convert_to_openai_tool(t) for t in tools]
+    payload = json.dumps(schemas, sort_keys=True, ensure_ascii=False) + SYSTEM_PROMPT
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
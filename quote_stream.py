@@ -0,0 +1,276 @@
+"""
+Streaming delle quotazioni con rivalutazione incrementale dei portafogli
+Un pub/sub locale distribuisce i tick (dal simulatore o da un provider) ai soli
+sottoscrittori interessati, mantiene la tabella degli ultimi prezzi e aggiorna
+il valore delle posizioni raccomandate in O(simboli cambiati)
+"""
+import os
+import time
+import weakref
+import threading
+from dataclasses import dataclass
+
+import numpy as np
+
+from market_sim import get_market
+
+
+# Intervallo di pubblicazione del feed del simulatore (secondi)
+QUOTE_FEED_INTERVAL = float(os.getenv("QUOTE_FEED_INTERVAL", "1.0"))
+
+
+@dataclass(slots=True)
+class QuoteTick:
+    symbol: str
+    price: float
+    change_percent: float
+    seq: int  # numero progressivo del tick sul bus
+    ts: float
+
+
+class LatestPriceTable:
+    """Ultimo prezzo noto per simbolo, condiviso da tutti i lettori del processo."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ticks = {}
+
+    def update(self, ticks: list):
+        with self._lock:
+            for tick in ticks:
+                self._ticks[tick.symbol] = tick
+
+    def get(self, symbol: str):
+        with self._lock:
+            return self._ticks.get(symbol)
+
+    def get_many(self, symbols) -> dict:
+        with self._lock:
+            return {s: self._ticks[s] for s in symbols if s in self._ticks}
+
+    def __len__(self):
+        with self._lock:
+            return len(self._ticks)
+
+
+class Subscription:
+    """Sottoscrizione a un insieme di simboli; `callback(ticks)` riceve solo i tick pertinenti."""
+
+    __slots__ = ("bus", "symbols", "callback")
+
+    def __init__(self, bus: "QuoteBus", symbols: frozenset, callback):
+        self.bus = bus
+        self.symbols = symbols
+        self.callback = callback
+
+    def close(self):
+        self.bus.unsubscribe(self)
+
+
+class QuoteBus:
+    """Pub/sub dei tick: indice simbolo -> sottoscrizioni, nessuna scansione globale."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._by_symbol = {}
+        self._seq = 0
+        self.latest = LatestPriceTable()
+
+    def subscribe(self, symbols, callback) -> Subscription:
+        subscription = Subscription(self, frozenset(s.upper() for s in symbols), callback)
+        with self._lock:
+            for symbol in subscription.symbols:
+                self._by_symbol.setdefault(symbol, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self._lock:
+            for symbol in subscription.symbols:
+                subscribers = self._by_symbol.get(symbol)
+                if subscribers:
+                    subscribers.discard(subscription)
+                    if not subscribers:
+                        del self._by_symbol[symbol]
+
+    def watched(self) -> set:
+        with self._lock:
+            return set(self._by_symbol)
+
+    def publish(self, updates: list) -> int:
+        """Pubblica [(simbolo, prezzo, variazione %), ...]; restituisce il numero di tick consegnati."""
+        now = time.time()
+        with self._lock:
+            ticks = []
+            for symbol, price, change_percent in updates:
+                self._seq += 1
+                ticks.append(QuoteTick(symbol, price, change_percent, self._seq, now))
+            batches = {}
+            for tick in ticks:
+                for subscription in self._by_symbol.get(tick.symbol, ()):
+                    batches.setdefault(subscription, []).append(tick)
+        self.latest.update(ticks)
+        for subscription, batch in batches.items():
+            subscription.callback(batch)
+        return sum(len(batch) for batch in batches.values())
+
+
+class SimulatorFeed:
+    """Pubblica sul bus i simboli del simulatore il cui prezzo (in centesimi) è cambiato."""
+
+    def __init__(self, bus: QuoteBus, sim=None, interval: float = QUOTE_FEED_INTERVAL):
+        self.bus = bus
+        self.sim = sim or get_market()
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+        self._last_version = None
+        self._last_cents = None
+
+    def poll(self) -> int:
+        """Un giro del feed: porta avanti il mercato e pubblica solo le variazioni."""
+        sim = self.sim
+        if sim.tick_seconds > 0:
+            sim.sync()
+        else:
+            sim.advance(1)
+        version, symbols, prices, change = sim.price_vector()
+        if version == self._last_version:
+            return 0
+        self._last_version = version
+
+        cents = np.round(prices * 100).astype(np.int64)
+        if self._last_cents is None or len(self._last_cents) != len(cents):
+            changed = np.arange(len(cents))
+        else:
+            changed = np.flatnonzero(cents != self._last_cents)
+        self._last_cents = cents
+        return self.bus.publish([
+            (symbols[i], round(float(prices[i]), 2), round(float(change[i]), 2)) for i in changed
+        ])
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self.poll()
+
+        def run():
+            while not self._stop.wait(self.interval):
+                try:
+                    self.poll()
+                except Exception as e:
+                    print(f"⚠️  Feed quotazioni: {e}")
+
+        self._thread = threading.Thread(target=run, daemon=True, name="quote-feed")
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+
+def _weak_callback(method):
+    """Callback che non tiene in vita il proprietario del metodo (il bus vive quanto il processo)."""
+    ref = weakref.WeakMethod(method)
+
+    def callback(ticks):
+        target = ref()
+        if target is not None:
+            target(ticks)
+    return callback
+
+
+class PortfolioRevaluator:
+    """Valore delle posizioni raccomandate aggiornato a ogni tick dei soli titoli cambiati.
+
+    La sottoscrizione al bus viene chiusa da `close()` o, se la sessione che lo
+    possedeva sparisce senza chiamarlo, quando il rivalutatore viene raccolto.
+    """
+
+    def __init__(self, bus: QuoteBus, positions: list):
+        """positions: [(ticker, importo investito, prezzo di riferimento), ...]
+
+        Più posizioni sullo stesso ticker si sommano in una sola, con prezzo di carico medio.
+        """
+        self._lock = threading.Lock()
+        self._positions = {}
+        self.invested = 0.0
+        self.value = 0.0
+        self.updates = 0
+        self.last_seq = 0
+        for ticker, amount, price in positions:
+            ticker = ticker.upper()
+            if not amount or not price:
+                continue
+            position = self._positions.get(ticker)
+            if position is None:
+                self._positions[ticker] = {
+                    "ticker": ticker,
+                    "amount": amount,
+                    "shares": amount / price,
+                    "entry_price": price,
+                    "price": price,
+                    "change_percent": 0.0,
+                    "value": amount,
+                    "seq": 0,
+                }
+            else:
+                position["amount"] += amount
+                position["shares"] += amount / price
+                position["entry_price"] = position["price"] = position["amount"] / position["shares"]
+                position["value"] = position["amount"]
+            self.invested += amount
+            self.value += amount
+        self._subscription = bus.subscribe(self._positions, _weak_callback(self._on_ticks))
+        self._finalizer = weakref.finalize(self, self._subscription.close)
+        # Allinea subito ai prezzi già noti
+        latest = bus.latest.get_many(self._positions)
+        if latest:
+            self._on_ticks(list(latest.values()))
+
+    def _on_ticks(self, ticks: list):
+        with self._lock:
+            for tick in ticks:
+                position = self._positions.get(tick.symbol)
+                if position is None or tick.seq <= position["seq"]:
+                    continue
+                value = position["shares"] * tick.price
+                self.value += value - position["value"]
+                position.update(price=tick.price, change_percent=tick.change_percent, value=value, seq=tick.seq)
+                self.last_seq = max(self.last_seq, tick.seq)
+                self.updates += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            positions = [dict(p) for p in self._positions.values()]
+            value, invested = self.value, self.invested
+            updates, last_seq = self.updates, self.last_seq
+        for p in positions:
+            p["pnl"] = p["value"] - p["amount"]
+            p["pnl_percent"] = (p["price"] / p["entry_price"] - 1.0) * 100
+        return {
+            "positions": positions,
+            "invested": invested,
+            "value": value,
+            "pnl": value - invested,
+            "pnl_percent": (value / invested - 1.0) * 100 if invested else 0.0,
+            "updates": updates,
+            "last_seq": last_seq,
+        }
+
+    def close(self):
+        self._finalizer()
+
+
+_bus = None
+_feed = None
+_stream_lock = threading.Lock()
+
+
+def get_quote_bus() -> QuoteBus:
+    """Bus condiviso dal processo, alimentato dal simulatore di mercato al primo utilizzo."""
+    global _bus, _feed
+    with _stream_lock:
+        if _bus is None:
+            _bus = QuoteBus()
+            _feed = SimulatorFeed(_bus)
+            _feed.start()
+        return _bus
@@ -0,0 +1,182 @@
+"""
+Riuso dei risultati quando cambia solo l'importo
+L'allocazione è lineare nell'importo e l'analisi di mercato e dei settori non ne dipende:
+a parità di profilo di rischio e di dati di mercato un risultato già calcolato viene
+riscalato invece di rieseguire agente e tools
+"""
+import os
+import copy
+import time
+import threading
+from dataclasses import dataclass, replace
+
+from langchain_core.messages import AIMessage
+
+from market_data import allocation_record
+from fast_path import market_snapshot, is_standard_request
+
+
+# Abilita il riuso dei risultati per le variazioni del solo importo
+REANALYSIS_REUSE = os.getenv("REANALYSIS_REUSE", "true").lower() == "true"
+# Validità dei risultati dell'agente: i suoi tools leggono il mercato live, non lo
+# snapshot del fast path, quindi la versione dello snapshot non dice se sono superati
+REANALYSIS_AGENT_TTL_SECONDS = float(os.getenv("REANALYSIS_AGENT_TTL_SECONDS", "300"))
+
+
+@dataclass(slots=True)
+class ReusableResult:
+    risk_profile: str
+    snapshot_version: int
+    amount: float
+    engine: str
+    state: dict  # stato finale con le posizioni strutturate (PositionRecord)
+    created_at: float
+
+
+# ------------ Riscalatura ------------
+
+def rescale_positions(positions: list, amount: float, base_amount: float) -> list:
+    """Riscala gli importi (e le quote, se presenti) in proporzione al nuovo capitale.
+
+    Il residuo degli arrotondamenti va sull'ultima posizione, come nel fast path,
+    così il totale investito resta proporzionale all'originale al centesimo.
+    """
+    if not positions or not base_amount:
+        return list(positions)
+    factor = amount / base_amount
+    amounts = [round(p["amount"] * factor, 2) for p in positions]
+    target = round(sum(p["amount"] for p in positions) * factor, 2)
+    amounts[-1] = round(amounts[-1] + round(target - sum(amounts), 2), 2)
+    return [
+        replace(p, amount=a, shares=round(a / p["price"], 4) if p["price"] else p["shares"])
+        for p, a in zip(positions, amounts)
+    ]
+
+
+def rescale_allocation(record, amount: float):
+    """Ricalcola gli importi per asset class dalle percentuali, come `calculate_portfolio_allocation`."""
+    percentages = dict(record["allocation_percentages"])
+    return allocation_record({
+        "total_amount": amount,
+        "risk_profile": record["risk_profile"],
+        "allocation": {asset: round(amount * pct, 2) for asset, pct in percentages.items()},
+        "allocation_percentages": percentages,
+    })
+
+
+def mark_reused_answer(messages: list, base_amount: float, amount: float) -> list:
+    """Antepone al report originale un avviso: i suoi importi sono quelli di `base_amount`."""
+    note = (
+        f"> ♻️ Report dell'analisi originale da €{base_amount:,.2f}: gli importi citati nel testo "
+        f"si riferiscono a quell'importo. Posizioni e allocazione riscalate a €{amount:,.2f} "
+        "sono nei dati strutturati del risultato.\n\n"
+    )
+    messages = list(messages)
+    for i in range(len(messages) - 1, -1, -1):
+        msg = messages[i]
+        if isinstance(msg, AIMessage) and not msg.tool_calls:
+            messages[i] = msg.model_copy(update={"content": note + msg.content})
+            break
+    return messages
+
+
+def rescale_result(result: ReusableResult, amount: float) -> dict:
+    """Stato finale equivalente a una nuova analisi per `amount`, senza modello né tools."""
+    state = copy.copy(result.state)
+    state["investment_amount"] = amount
+    state["recommendations"] = rescale_positions(state["recommendations"], amount, result.amount)
+
+    market_data = dict(state.get("market_data") or {})
+    if market_data.get("allocation"):
+        market_data["allocation"] = rescale_allocation(market_data["allocation"], amount)
+    state["market_data"] = market_data
+    # Il testo non viene rigenerato (servirebbe il modello): resta quello originale, segnalato
+    state["messages"] = mark_reused_answer(state.get("messages") or [], result.amount, amount)
+
+    state["reused_from"] = {
+        "amount": result.amount,
+        "risk_profile": result.risk_profile,
+        "snapshot_version": result.snapshot_version,
+        "engine": result.engine,
+        "age_s": time.time() - result.created_at,
+    }
+    # Trace e metriche della sessione originale non descrivono questa risposta
+    state["trace"] = []
+    state.pop("checkpoint_stats", None)
+    state.pop("archive_id", None)
+    return state
+
+
+# ------------ Archivio dei Risultati Riusabili ------------
+
+class ResultStore:
+    """Ultimo risultato riusabile per profilo di rischio.
+
+    I risultati del fast path valgono finché la versione dello snapshot di mercato da cui
+    sono calcolati resta quella corrente. Quelli dell'agente non dipendono dallo snapshot
+    e valgono per REANALYSIS_AGENT_TTL_SECONDS: un refresh dello snapshot non li scarta.
+
+    Un archivio per sessione utente (la dashboard lo tiene in `st.session_state`):
+    un risultato non deve essere servito a un'altra sessione.
+    """
+
+    def __init__(self, agent_ttl: float = REANALYSIS_AGENT_TTL_SECONDS):
+        self._lock = threading.Lock()
+        self._fast = {}  # (profilo, versione dello snapshot) -> ReusableResult
+        self._agent = {}  # profilo -> ReusableResult
+        self.agent_ttl = agent_ttl
+        self.hits = 0
+        self.misses = 0
+
+    def remember(self, state: dict, snapshot_version: int):
+        """Registra un risultato; `snapshot_version` è lo snapshot corrente all'avvio dell'analisi."""
+        if not state.get("recommendations") or state.get("degraded"):
+            return
+        result = ReusableResult(
+            risk_profile=state["risk_profile"],
+            snapshot_version=snapshot_version,
+            amount=state["investment_amount"],
+            engine=state.get("engine", "agent"),
+            state=state,
+            created_at=time.time(),
+        )
+        with self._lock:
+            if result.engine == "agent":
+                self._agent[result.risk_profile] = result
+                return
+            # Gli snapshot superati non saranno più richiesti
+            for key in [k for k in self._fast if k[1] < snapshot_version]:
+                del self._fast[key]
+            self._fast[(result.risk_profile, snapshot_version)] = result
+
+    def _fresh_agent_result(self, risk_profile: str):
+        result = self._agent.get(risk_profile)
+        if result is not None and time.time() - result.created_at > self.agent_ttl:
+            del self._agent[risk_profile]
+            return None
+        return result
+
+    def reuse(self, amount: float, risk_profile: str, mode: str = "auto"):
+        """Stato riscalato per `amount`, oppure None se serve una nuova analisi.
+
+        Una richiesta esplicita dell'agente non riusa un risultato del fast path, e in
+        modalità auto un risultato del fast path vale solo se anche il nuovo importo
+        sarebbe servito dal fast path. Tra i risultati validi si usa il più recente.
+        """
+        version = market_snapshot.current_version()
+        with self._lock:
+            candidates = [self._fresh_agent_result(risk_profile)]
+            if mode == "fast" or (mode == "auto" and is_standard_request(amount, risk_profile)):
+                candidates.append(self._fast.get((risk_profile, version)))
+            candidates = [c for c in candidates if c is not None]
+            if not candidates:
+                self.misses += 1
+                return None
+            self.hits += 1
+            result = max(candidates, key=lambda c: c.created_at)
+        return rescale_result(result, amount)
+
+    def clear(self):
+        with self._lock:
+            self._fast.clear()
+            self._agent.clear()
@@ -0,0 +1,132 @@
+"""
+Sottografo map-reduce per l'analisi dei settori
+Un worker per settore candidato (fan-out con Send, tutti nello stesso passo):
+ciascuno legge statistiche del settore e quotazioni dei titoli principali;
+il passo di reduce restituisce una classifica compatta in un solo risultato
+"""
+import operator
+from typing import TypedDict, Annotated
+
+from langgraph.graph import StateGraph, START, END
+from langgraph.types import Send
+
+from market_sim import get_market, SECTORS
+
+
+# Titoli quotati per settore nel riepilogo
+QUOTES_PER_SECTOR = 3
+
+# Punteggio dei settori: performance YTD, bonus di trend e penalità di volatilità per profilo
+TREND_BONUS = {"upward": 5.0, "stable": 0.0, "downward": -5.0}
+VOLATILITY_LEVEL = {"low": 0.0, "medium": 0.5, "high": 1.0}
+VOLATILITY_PENALTY = {"conservative": 8.0, "moderate": 4.0, "aggressive": 0.0}
+
+
+def sector_score(analysis: dict, volatility_penalty: float) -> float:
+    return (
+        analysis["ytd_performance"]
+        + TREND_BONUS.get(analysis["trend"], 0.0)
+        - volatility_penalty * VOLATILITY_LEVEL.get(analysis["volatility"], 0.5)
+    )
+
+
+# ------------ Stato del Sottografo ------------
+
+class SectorTask(TypedDict):
+    """Input di un worker: un solo settore."""
+    sector: str
+    volatility_penalty: float
+    quotes_per_sector: int
+
+
+class SectorAnalysisState(TypedDict):
+    sectors: list
+    risk_profile: str
+    quotes_per_sector: int
+    results: Annotated[list, operator.add]  # un elemento per worker, in ordine di completamento
+    summary: dict
+
+
+# ------------ Nodi ------------
+
+def fan_out(state: SectorAnalysisState) -> list:
+    """Un Send per settore: i worker girano in parallelo nello stesso superstep."""
+    penalty = VOLATILITY_PENALTY.get(state["risk_profile"].lower(), VOLATILITY_PENALTY["moderate"])
+    return [
+        Send("sector_worker", {
+            "sector": sector,
+            "volatility_penalty": penalty,
+            "quotes_per_sector": state["quotes_per_sector"],
+        })
+        for sector in state["sectors"]
+    ]
+
+
+def sector_worker(task: SectorTask) -> dict:
+    """Statistiche del settore e quotazioni in blocco dei suoi titoli principali."""
+    market = get_market()
+    try:
+        analysis = market.sector(task["sector"])
+        top_stocks = [s for s in analysis["top_stocks"] if s != "N/A"][:task["quotes_per_sector"]]
+        quotes = market.quotes(top_stocks)
+    except Exception as e:
+        return {"results": [{"sector": task["sector"], "error": f"{type(e).__name__}: {e}"}]}
+    return {"results": [{
+        "sector": analysis["sector"],
+        "score": round(sector_score(analysis, task["volatility_penalty"]), 2),
+        "ytd_performance": analysis["ytd_performance"],
+        "trend": analysis["trend"],
+        "volatility": analysis["volatility"],
+        "top_stocks": top_stocks or ["N/A"],
+        "quotes": [
+            {k: q[k] for k in ("symbol", "price", "change_percent", "volume")}
+            for q in quotes.values()
+        ],
+    }]}
+
+
+def rank_sectors(state: SectorAnalysisState) -> dict:
+    """Reduce: classifica per punteggio; i settori senza titoli finiscono in fondo."""
+    analyzed = [r for r in state["results"] if "error" not in r]
+    ranking = sorted(analyzed, key=lambda r: (r["top_stocks"] != ["N/A"], r["score"]), reverse=True)
+    for rank, entry in enumerate(ranking, 1):
+        entry["rank"] = rank
+    summary = {
+        "risk_profile": state["risk_profile"],
+        "sectors_considered": len(state["sectors"]),
+        "ranking": ranking,
+    }
+    errors = [r for r in state["results"] if "error" in r]
+    if errors:
+        summary["errors"] = errors
+    return {"summary": summary}
+
+
+def create_sector_subgraph():
+    """Compila il sottografo: START -> (Send x N) sector_worker -> rank_sectors -> END."""
+    workflow = StateGraph(SectorAnalysisState)
+    workflow.add_node("sector_worker", sector_worker)
+    workflow.add_node("rank_sectors", rank_sectors)
+    workflow.add_conditional_edges(START, fan_out, ["sector_worker"])
+    workflow.add_edge("sector_worker", "rank_sectors")
+    workflow.add_edge("rank_sectors", END)
+    return workflow.compile()
+
+
+_subgraph = None
+
+
+def run_sector_analysis(sectors: list = None, risk_profile: str = "moderate",
+                        quotes_per_sector: int = QUOTES_PER_SECTOR) -> dict:
+    """Analizza i settori indicati (default: tutti quelli del mercato) e restituisce la classifica."""
+    global _subgraph
+    if _subgraph is None:
+        _subgraph = create_sector_subgraph()
+    sectors = list(dict.fromkeys(sectors or SECTORS))
+    final = _subgraph.invoke({
+        "sectors": sectors,
+        "risk_profile": risk_profile,
+        "quotes_per_sector": quotes_per_sector,
+        "results": [],
+    })
+    return final["summary"]
@@ -0,0 +1,169 @@
+"""
+Esecuzione speculativa dei tools mentre il modello sta ragionando
+Il prompt iniziale rende prevedibili le prossime tool calls: le avviamo
+in background e le consegniamo subito se il modello le richiede davvero
+"""
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+
+SPECULATIVE_TOOLS = os.getenv("SPECULATIVE_TOOLS", "true").lower() == "true"
+
+# Numero massimo di quotazioni speculative per turno
+MAX_SPECULATIVE_QUOTES = 8
+
+
+def _normalize(value):
+    """Rende confrontabili argomenti equivalenti (10000 vs 10000.0, aapl vs AAPL)."""
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, dict):
+        return {k: _normalize(v) for k, v in value.items()}
+    return value
+
+
+def call_key(name: str, args: dict) -> str:
+    args = _normalize(args)
+    if name == "get_stock_quote" and isinstance(args.get("symbol"), str):
+        args = {**args, "symbol": args["symbol"].upper()}
+    if name in ("calculate_portfolio_allocation", "analyze_sectors") and isinstance(args.get("risk_profile"), str):
+        args = {**args, "risk_profile": args["risk_profile"].lower()}
+    return f"{name}:{json.dumps(args, sort_keys=True)}"
+
+
+def predict_next_calls(state: dict) -> list:
+    """Prevede le prossime tool calls seguendo lo script del messaggio iniziale.
+
+    Si basa sui risultati già accumulati in `market_data`.
+    """
+    data = state.get("market_data") or {}
+    allocation_call = ("calculate_portfolio_allocation", {
+        "amount": state["investment_amount"],
+        "risk_profile": state["risk_profile"],
+    })
+
+    overview = data.get("overview")
+    if not overview:
+        return [("get_market_overview", {}), allocation_call]
+
+    predictions = []
+    if not data.get("allocation"):
+        predictions.append(allocation_call)
+
+    # La classifica dei settori arriva da una sola chiamata map-reduce
+    analyzed = data.get("sectors") or {}
+    if not analyzed:
+        predictions.append(("analyze_sectors", {"risk_profile": state["risk_profile"]}))
+
+    quoted = data.get("quotes") or {}
+    candidates = [
+        symbol
+        for sector in analyzed.values()
+        for symbol in sector.get("top_stocks", [])
+        if symbol != "N/A" and symbol not in quoted
+    ]
+    for symbol in candidates[:MAX_SPECULATIVE_QUOTES]:
+        predictions.append(("get_stock_quote", {"symbol": symbol}))
+
+    return predictions
+
+
+class SpeculativeExecutor:
+    """Avvia in background le tool calls previste, per sessione (thread_id)."""
+
+    def __init__(self, run_tool, max_workers: int = 4):
+        self._run_tool = run_tool
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="speculative")
+        self._lock = threading.Lock()
+        self._inflight = {}  # session_id -> {call_key: (future, launched_at)}
+        self._stats = {"launched": 0, "hits": 0, "misses": 0, "unpredicted": 0,
+                       "preempted": 0, "saved_s": 0.0}
+
+    def _timed_run(self, name: str, args: dict):
+        t0 = time.perf_counter()
+        result = self._run_tool(name, args)
+        return result, time.perf_counter() - t0
+
+    def launch(self, session_id: str, state: dict):
+        """Avvia le chiamate previste che non sono già in volo per la sessione."""
+        predictions = predict_next_calls(state)
+        with self._lock:
+            inflight = self._inflight.setdefault(session_id, {})
+            for name, args in predictions:
+                key = call_key(name, args)
+                if key in inflight:
+                    continue
+                inflight[key] = (self._pool.submit(self._timed_run, name, args), time.perf_counter())
+                self._stats["launched"] += 1
+
+    def take(self, session_id: str, name: str, args: dict):
+        """Restituisce (True, risultato) se la chiamata era stata anticipata.
+
+        Se la speculazione è ancora in coda nel pool viene annullata e restituisce
+        (False, None): il chiamante esegue subito il tool invece di attendere un worker.
+        """
+        with self._lock:
+            entry = self._inflight.get(session_id, {}).pop(call_key(name, args), None)
+        if entry is None:
+            with self._lock:
+                self._stats["unpredicted"] += 1
+            return False, None
+
+        future, launched_at = entry
+        if future.cancel():
+            with self._lock:
+                self._stats["preempted"] += 1
+            return False, None
+        waited_from = time.perf_counter()
+        try:
+            result, duration = future.result()
+        except Exception:
+            # Una speculazione fallita non deve far fallire la chiamata reale
+            return False, None
+
+        # Tempo risparmiato: la parte di esecuzione avvenuta prima della richiesta reale
+        saved = max(0.0, min(duration, waited_from - launched_at))
+        with self._lock:
+            self._stats["hits"] += 1
+            self._stats["saved_s"] += saved
+        return True, result
+
+    def discard(self, session_id: str):
+        """Scarta le speculazioni non usate (cancellandole se non ancora partite)."""
+        with self._lock:
+            inflight = self._inflight.pop(session_id, {})
+            self._stats["misses"] += len(inflight)
+        for future, _ in inflight.values():
+            future.cancel()
+
+    @contextmanager
+    def session(self, session_id: str):
+        """Delimita una sessione: all'uscita, anche per un'eccezione, le speculazioni rimaste si scartano."""
+        try:
+            yield
+        finally:
+            self.discard(session_id)
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+        decided = stats["hits"] + stats["misses"]
+        requested = stats["hits"] + stats["unpredicted"]
+        stats["hit_rate"] = stats["hits"] / decided if decided else 0.0
+        stats["coverage"] = stats["hits"] / requested if requested else 0.0
+        return stats
+
+    def format_report(self) -> str:
+        s = self.stats()
+        return (
+            f"Speculazioni avviate: {s['launched']}, hit: {s['hits']}, scartate: {s['misses']}, "
+            f"non previste: {s['unpredicted']}, ancora in coda: {s['preempted']}\n"
+            f"Hit rate: {s['hit_rate']:.0%}, copertura: {s['coverage']:.0%}, "
+            f"latenza risparmiata: {s['saved_s'] * 1000:.1f} ms"
+        )
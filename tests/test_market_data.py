@@ -0,0 +1,69 @@
+"""
+Estrazione delle posizioni strutturate dalla risposta dell'agente
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+from market_data import (
+    parse_euro_amount, ticker_amounts, positions_from_answer, quote_record, sector_record, UNKNOWN_SECTOR,
+)
+from market_sim import TICKER_SECTORS
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("2,500.00", 2500.0),
+    ("2.500,00", 2500.0),
+    ("1.000", 1000.0),
+    ("1,000", 1000.0),
+    ("1.234.567", 1234567.0),
+    ("2,5", 2.5),
+    ("185.20", 185.2),
+    ("3000", 3000.0),
+    ("3000.", 3000.0),
+])
+def test_parse_euro_amount(text, expected):
+    assert parse_euro_amount(text) == expected
+
+
+def test_ticker_amounts_accepts_markdown_and_both_locales():
+    answer = """### Raccomandazioni
+- AAPL: €2.500,00
+- **MSFT**: €1.000
+- `NVDA:` €1,250.50
+- **GOOGL:** €750
+- ETF: €5.000
+- Il VIX: €12 non è una posizione
+- AAPL: €9,999.00
+"""
+    assert ticker_amounts(answer) == {
+        "AAPL": 2500.0,
+        "MSFT": 1000.0,
+        "NVDA": 1250.5,
+        "GOOGL": 750.0,
+    }
+
+
+def test_positions_from_answer_sectors_and_quotes():
+    data = {
+        "quotes": {"AAPL": quote_record({"symbol": "AAPL", "price": 200.0, "change_percent": 1.0, "volume": 10})},
+        "sectors": {"Technology": sector_record({
+            "sector": "Technology", "ytd_performance": 5.0, "trend": "upward",
+            "top_stocks": ["AAPL", "MSFT"], "volatility": "medium",
+        })},
+    }
+    answer = "- AAPL: €2,000.00\n- SPY: €1,000.00\n- QQQ: €500.00\n- BND: €1.000,00\n- ZZZZ: €500"
+    positions = {p.ticker: p for p in positions_from_answer(answer, data, 5000.0, TICKER_SECTORS)}
+
+    assert positions["AAPL"].sector == "Technology"
+    assert positions["AAPL"].shares == 10.0
+    assert positions["AAPL"].weight == 0.4
+    assert positions["SPY"].sector == "ETF"
+    assert positions["QQQ"].sector == "ETF"
+    assert positions["BND"].sector == "Bonds"
+    assert positions["BND"].amount == 1000.0
+    assert positions["ZZZZ"].sector == UNKNOWN_SECTOR
+    assert positions["ZZZZ"].price is None and positions["ZZZZ"].shares is None
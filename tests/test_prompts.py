@@ -0,0 +1,145 @@
+"""
+Il prefisso cacheabile (system prompt + schema dei tools) deve restare identico
+byte per byte tra richieste, ruoli e turni, altrimenti la prompt cache del provider non lo serve
+"""
+import os
+import sys
+import json
+
+os.environ.setdefault("ARCHIVE_ENABLED", "false")
+os.environ.setdefault("LLM_SCHEDULER_ENABLED", "false")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+from langchain_core.messages import AIMessage, SystemMessage
+from langchain_core.utils.function_calling import convert_to_openai_tool
+
+import investment_agent
+from prompts import build_messages, prompt_prefix_fingerprint
+from investment_agent import run_advisory, FINISH_TOOL
+from model_metrics import model_metrics
+from load_test import FakeAdvisorModel
+
+
+REQUESTS = [
+    (10000.0, "moderate"),
+    (250000.0, "aggressive"),
+]
+
+
+class CapturingChatModel:
+    """Sostituto di ChatOpenAI: registra i tools collegati e il prefisso di ogni richiesta.
+
+    Il router passa la mano con `ready_to_answer` quando il copione arriverebbe alla
+    risposta finale; il provider fittizio serve dalla cache il system prompt.
+    """
+
+    def __init__(self, role: str, sent: list):
+        self.role = role
+        self.sent = sent
+        self.bound = None
+        self.bind_kwargs = None
+        self.script = None
+
+    def bind_tools(self, bound, **kwargs):
+        self.bound = list(bound)
+        self.bind_kwargs = kwargs
+        return self
+
+    def _tool_schemas(self) -> bytes:
+        # Stesso ordine con cui i tools finiscono nella richiesta
+        return json.dumps([convert_to_openai_tool(t) for t in self.bound], ensure_ascii=False).encode("utf-8")
+
+    def invoke(self, messages):
+        system = "".join(m.content for m in messages if isinstance(m, SystemMessage))
+        assert isinstance(messages[0], SystemMessage)
+        self.sent.append({"role": self.role, "prefix": system.encode("utf-8") + self._tool_schemas()})
+
+        response = self.script.invoke(messages)
+        if self.role == "router" and not response.tool_calls:
+            response = AIMessage(content="", tool_calls=[
+                {"name": FINISH_TOOL, "args": {}, "id": f"finish_{len(messages)}", "type": "tool_call"}
+            ])
+        input_tokens = sum(len(str(m.content)) for m in messages) // 4
+        cached = len(system) // 4
+        output_tokens = 20 if response.tool_calls else 400
+        response.usage_metadata = {
+            "input_tokens": input_tokens,
+            "output_tokens": output_tokens,
+            "total_tokens": input_tokens + output_tokens,
+            "input_token_details": {"cache_read": cached},
+        }
+        self.sent[-1].update(input_tokens=input_tokens, cached=cached, output_tokens=output_tokens)
+        return response
+
+
+@pytest.fixture
+def tiered_models(monkeypatch):
+    """Router e writer distinti, con i modelli costruiti da `get_model` sostituiti."""
+    sent = []
+    models = {role: CapturingChatModel(role, sent) for role in ("router", "writer")}
+    monkeypatch.setattr(investment_agent, "ROUTER_TIERING", True)
+    monkeypatch.setattr(investment_agent, "_bound_models", {})
+    monkeypatch.setattr(investment_agent, "get_model", lambda role="writer": models[role])
+    model_metrics.reset()
+    yield models, sent
+    model_metrics.reset()
+
+
+def test_build_messages_prefix_is_stable():
+    first, second = (build_messages(amount, profile) for amount, profile in REQUESTS)
+    assert isinstance(first[0], SystemMessage)
+    assert first[0].content.encode("utf-8") == second[0].content.encode("utf-8")
+    assert first[1].content != second[1].content
+
+
+def test_prefix_sent_to_model_is_byte_identical(tiered_models):
+    models, sent = tiered_models
+    for i, (amount, profile) in enumerate(REQUESTS):
+        for model in models.values():
+            model.script = FakeAdvisorModel(amount, profile, median_s=0.0)
+        run_advisory(amount, profile, mode="agent", thread_id=f"prefix_{i}", archive=False)
+
+    # Più turni del router e almeno una risposta del writer per ogni richiesta
+    assert sum(call["role"] == "router" for call in sent) >= 2 * len(REQUESTS)
+    assert sum(call["role"] == "writer" for call in sent) == len(REQUESTS)
+    assert len({call["prefix"] for call in sent}) == 1
+
+    # Schema dei tools effettivamente collegati: identico tra i ruoli, solo tool_choice cambia
+    router, writer = models["router"], models["writer"]
+    assert [t.name for t in router.bound] == [t.name for t in writer.bound]
+    assert FINISH_TOOL in [t.name for t in router.bound]
+    assert prompt_prefix_fingerprint(router.bound) == prompt_prefix_fingerprint(writer.bound)
+    assert prompt_prefix_fingerprint(router.bound) != prompt_prefix_fingerprint(investment_agent.tools)
+    assert router.bind_kwargs.get("tool_choice") == "required"
+    assert "tool_choice" not in writer.bind_kwargs
+
+
+def test_cached_token_accounting(tiered_models):
+    models, sent = tiered_models
+    amount, profile = REQUESTS[0]
+    for model in models.values():
+        model.script = FakeAdvisorModel(amount, profile, median_s=0.0)
+    state = run_advisory(amount, profile, mode="agent", thread_id="tokens", archive=False)
+
+    snapshot = model_metrics.snapshot()
+    for role in ("router", "writer"):
+        calls = [call for call in sent if call["role"] == role]
+        tier = snapshot[role]
+        assert tier["calls"] == len(calls)
+        assert tier["input_tokens"] == sum(call["input_tokens"] for call in calls)
+        assert tier["cached_input_tokens"] == sum(call["cached"] for call in calls)
+        assert tier["output_tokens"] == sum(call["output_tokens"] for call in calls)
+        assert tier["cache_hit_ratio"] == pytest.approx(tier["cached_input_tokens"] / tier["input_tokens"])
+
+    usage = state["token_usage"]
+    assert usage["calls"] == len(sent)
+    assert usage["input_tokens"] == sum(call["input_tokens"] for call in sent)
+    assert usage["cached_input_tokens"] == sum(call["cached"] for call in sent)
+    assert usage["uncached_input_tokens"] == usage["input_tokens"] - usage["cached_input_tokens"]
+    assert usage["output_tokens"] == sum(call["output_tokens"] for call in sent)
+    # La risposta del router che passa la mano non entra nei messaggi
+    assert not any(
+        call["name"] == FINISH_TOOL
+        for m in state["messages"] if isinstance(m, AIMessage) for call in m.tool_calls
+    )
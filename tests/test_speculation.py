@@ -0,0 +1,49 @@
+"""
+Le speculazioni di una sessione devono essere rilasciate anche quando la sessione
+fallisce, non solo quando il grafo arriva ai tools o alla finalizzazione
+"""
+import os
+import sys
+import threading
+
+os.environ.setdefault("ARCHIVE_ENABLED", "false")
+os.environ.setdefault("LLM_SCHEDULER_ENABLED", "false")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+import investment_agent
+from investment_agent import run_advisory, speculator
+from speculation import SpeculativeExecutor
+
+
+STATE = {"investment_amount": 10000.0, "risk_profile": "moderate", "market_data": {}}
+
+
+class FailingModel:
+    """Modello che fallisce alla prima chiamata, dopo che le speculazioni sono partite."""
+
+    def invoke(self, messages):
+        raise RuntimeError("provider non disponibile")
+
+
+def test_session_releases_inflight_on_exception():
+    release = threading.Event()
+    executor = SpeculativeExecutor(lambda name, args: release.wait(5), max_workers=1)
+    with pytest.raises(RuntimeError):
+        with executor.session("s1"):
+            executor.launch("s1", STATE)
+            assert executor._inflight["s1"]
+            raise RuntimeError("sessione interrotta")
+    release.set()
+
+    assert "s1" not in executor._inflight
+    assert executor.stats()["misses"] == executor.stats()["launched"] == 2
+
+
+def test_failed_agent_run_leaves_no_speculations(monkeypatch):
+    monkeypatch.setattr(investment_agent, "SPECULATIVE_TOOLS", True)
+    with pytest.raises(RuntimeError, match="provider non disponibile"):
+        run_advisory(10000, "moderate", mode="agent", thread_id="spec_fail", archive=False,
+                     model_override=FailingModel())
+    assert "spec_fail" not in speculator._inflight
@@ -1,134 +1,250 @@
 """
 Visualizza il DAG dell'agente di investimento
+L'SVG è generato da `agent_app.get_graph()` e tenuto in cache per hash della
+struttura del grafo; sopra si può sovrapporre la traccia di esecuzione di una
+sessione (visite per nodo, latenza cumulativa come heatmap, loop dei tools)
 """
 import os
+import json
+import hashlib
+import threading
+from html import escape
 from dotenv import load_dotenv
-import matplotlib.pyplot as plt
-from matplotlib.patches import FancyBboxPatch, FancyArrowPatch
-import matplotlib.patches as mpatches
 
 from investment_agent import create_investment_agent
 
 env_path = os.path.join(os.path.dirname(__file__), '.env')
 load_dotenv(dotenv_path=env_path)
 
+DAG_SVG_PATH = os.path.join(os.path.dirname(__file__), 'investment_agent_dag.svg')
 
-def create_investment_dag_visual():
-    """Crea visualizzazione grafica del DAG."""
-    fig, ax = plt.subplots(figsize=(14, 10))
-    ax.set_xlim(0, 10)
-    ax.set_ylim(0, 10)
-    ax.axis('off')
-    
-    # Posizioni dei nodi
-    positions = {
-        'START': (5, 9),
-        'agent': (5, 7),
-        'tools': (2.5, 5),
-        'finalize': (5, 3),
-        'END': (5, 1)
+START = "__start__"
+END_NODE = "__end__"
+
+# Geometria del disegno
+NODE_W, NODE_H = 150, 54
+LAYER_GAP, NODE_GAP, MARGIN = 120, 60, 70
+
+# Colori dei nodi senza traccia
+NODE_COLORS = {
+    START: '#90EE90',
+    'agent': '#87CEEB',
+    'tools': '#FFD700',
+    'finalize': '#FFA07A',
+    END_NODE: '#FF6B6B',
+}
+
+
+# ------------ Struttura e Layout ------------
+
+def graph_structure(graph) -> dict:
+    """Nodi e archi del grafo in forma canonica (base dell'hash)."""
+    return {
+        "nodes": sorted(graph.nodes),
+        "edges": sorted([e.source, e.target, bool(e.conditional)] for e in graph.edges),
     }
-    
-    # Colori
-    colors = {
-        'START': '#90EE90',
-        'agent': '#87CEEB',
-        'tools': '#FFD700',
-        'finalize': '#FFA07A',
-        'END': '#FF6B6B'
+
+
+def graph_hash(graph) -> str:
+    payload = json.dumps(graph_structure(graph), sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
+
+
+def _layout(structure: dict) -> dict:
+    """Layout a livelli: gli archi all'indietro (loop) sono esclusi dal calcolo dei livelli."""
+    nodes = structure["nodes"]
+    successors = {n: [] for n in nodes}
+    for source, target, _ in structure["edges"]:
+        successors[source].append(target)
+
+    # Archi all'indietro: puntano a un nodo ancora sullo stack della DFS da START
+    back_edges, state = set(), {}
+
+    def visit(node):
+        state[node] = "open"
+        for nxt in successors[node]:
+            if state.get(nxt) == "open":
+                back_edges.add((node, nxt))
+            elif nxt not in state:
+                visit(nxt)
+        state[node] = "done"
+
+    visit(START)
+    for node in nodes:
+        if node not in state:
+            visit(node)
+
+    # Livello = cammino più lungo da START sul grafo aciclico
+    level = {n: 0 for n in nodes}
+    for _ in nodes:
+        for source, target, _ in structure["edges"]:
+            if (source, target) not in back_edges:
+                level[target] = max(level[target], level[source] + 1)
+
+    layers = {}
+    for node in nodes:
+        layers.setdefault(level[node], []).append(node)
+    width = max(len(layer) for layer in layers.values()) * (NODE_W + NODE_GAP) + 2 * MARGIN + 120
+    positions = {}
+    for lvl, layer in layers.items():
+        span = len(layer) * NODE_W + (len(layer) - 1) * NODE_GAP
+        x0 = (width - span) / 2
+        for i, node in enumerate(sorted(layer)):
+            positions[node] = (x0 + i * (NODE_W + NODE_GAP) + NODE_W / 2, MARGIN + lvl * LAYER_GAP + NODE_H / 2)
+
+    return {
+        "positions": positions,
+        "edges": [(s, t, c, (s, t) in back_edges) for s, t, c in structure["edges"]],
+        "width": width,
+        "height": 2 * MARGIN + max(layers) * LAYER_GAP + NODE_H + 40,
     }
-    
-    # Disegna nodi
-    for node, (x, y) in positions.items():
-        if node in ['START', 'END']:
-            circle = plt.Circle((x, y), 0.4, color=colors[node], ec='black', linewidth=2, zorder=3)
-            ax.add_patch(circle)
-        else:
-            box = FancyBboxPatch((x-0.8, y-0.35), 1.6, 0.7,
-                                boxstyle="round,pad=0.1",
-                                facecolor=colors[node],
-                                edgecolor='black',
-                                linewidth=2, zorder=3)
-            ax.add_patch(box)
-        
-        ax.text(x, y, node, ha='center', va='center',
-               fontsize=13, fontweight='bold', zorder=4)
-    
-    # Arrows
-    arrows = [
-        ('START', 'agent', 'solid', 'black'),
-        ('agent', 'tools', 'dashed', 'blue'),
-        ('tools', 'agent', 'solid', 'green'),
-        ('agent', 'finalize', 'dashed', 'purple'),
-        ('finalize', 'END', 'solid', 'black'),
+
+
+_layout_cache = {}
+_cache_lock = threading.Lock()
+
+
+def graph_layout(graph) -> tuple:
+    """(hash, layout) del grafo; il layout è ricalcolato solo se la struttura cambia."""
+    key = graph_hash(graph)
+    with _cache_lock:
+        if key not in _layout_cache:
+            _layout_cache[key] = _layout(graph_structure(graph))
+        return key, _layout_cache[key]
+
+
+# ------------ Traccia di Esecuzione ------------
+
+def summarize_trace(trace: list, graph=None) -> dict:
+    """Visite, latenza cumulativa per nodo e archi percorsi in una sessione."""
+    nodes, edges = {}, {}
+    path = [START] + [visit["node"] for visit in trace or []]
+    for visit in trace or []:
+        entry = nodes.setdefault(visit["node"], {"visits": 0, "latency_s": 0.0})
+        entry["visits"] += 1
+        entry["latency_s"] += visit["latency_s"]
+    if graph is not None and trace:
+        if any(e.source == path[-1] and e.target == END_NODE for e in graph.edges):
+            path.append(END_NODE)
+    for source, target in zip(path, path[1:]):
+        edges[(source, target)] = edges.get((source, target), 0) + 1
+    return {
+        "nodes": nodes,
+        "edges": edges,
+        "tool_loops": nodes.get("tools", {}).get("visits", 0),
+        "total_s": sum(entry["latency_s"] for entry in nodes.values()),
+    }
+
+
+def _heat(share: float) -> str:
+    """Colore da giallo chiaro (poca latenza) a rosso (quota maggiore)."""
+    low, high = (255, 245, 200), (215, 48, 31)
+    r, g, b = (round(lo + (hi - lo) * share) for lo, hi in zip(low, high))
+    return f"#{r:02x}{g:02x}{b:02x}"
+
+
+# ------------ Rendering SVG ------------
+
+def render_svg(layout: dict, summary: dict = None) -> str:
+    """SVG del grafo; con `summary` aggiunge visite, heatmap di latenza e archi percorsi."""
+    pos = layout["positions"]
+    width, height = layout["width"], layout["height"]
+    parts = [
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{width:.0f}" height="{height:.0f}" '
+        f'viewBox="0 0 {width:.0f} {height:.0f}" font-family="sans-serif">',
+        '<defs><marker id="arrow" viewBox="0 0 10 10" refX="10" refY="5" markerWidth="8" markerHeight="8" '
+        'orient="auto-start-reverse"><path d="M 0 0 L 10 5 L 0 10 z" fill="#444"/></marker></defs>',
+        f'<text x="{width / 2:.0f}" y="30" text-anchor="middle" font-size="18" font-weight="bold">'
+        f'DAG Agente di Investimento</text>',
     ]
-    
-    for start, end, style, color in arrows:
-        x1, y1 = positions[start]
-        x2, y2 = positions[end]
-        
-        if start == 'tools' and end == 'agent':
-            arrow = FancyArrowPatch((x1+0.6, y1+0.2), (x2-0.6, y2-0.3),
-                                   connectionstyle="arc3,rad=.5",
-                                   arrowstyle='->',
-                                   mutation_scale=25,
-                                   linewidth=2.5,
-                                   linestyle=style,
-                                   color=color,
-                                   zorder=2)
+
+    for source, target, conditional, back in layout["edges"]:
+        (x1, y1), (x2, y2) = pos[source], pos[target]
+        count = summary["edges"].get((source, target), 0) if summary else 0
+        stroke = 2 + min(count, 10) * 0.6 if count else 2
+        color = "#d7301f" if count else "#444"
+        dash = ' stroke-dasharray="6,4"' if conditional else ''
+        if back:
+            # Loop: curva sul lato esterno, dal fianco della sorgente al fianco della destinazione
+            side = 1 if x1 >= x2 else -1
+            sx, tx = x1 + side * NODE_W / 2, x2 + side * NODE_W / 2
+            bend = (max(sx, tx) + 90) if side > 0 else (min(sx, tx) - 90)
+            d = f"M {sx:.0f} {y1:.0f} C {bend:.0f} {y1:.0f}, {bend:.0f} {y2:.0f}, {tx:.0f} {y2:.0f}"
+            label_x, label_y = bend - side * 25, (y1 + y2) / 2
         else:
-            arrow = FancyArrowPatch((x1, y1-0.4), (x2, y2+0.4 if end != 'tools' else y2+0.35),
-                                   arrowstyle='->',
-                                   mutation_scale=25,
-                                   linewidth=2.5,
-                                   linestyle=style,
-                                   color=color,
-                                   zorder=2)
-        ax.add_patch(arrow)
-    
-    # Etichette
-    ax.text(7, 6.5, 'Richiede\nanalisi\nmercato', fontsize=10, style='italic', color='blue',
-           bbox=dict(boxstyle='round', facecolor='lightblue', alpha=0.7))
-    ax.text(7.5, 4.5, 'Ritorna\ndati\nfinanziari', fontsize=10, style='italic', color='green',
-           bbox=dict(boxstyle='round', facecolor='lightgreen', alpha=0.7))
-    ax.text(2.5, 4.5, 'Decide di\nfinalizzare', fontsize=10, style='italic', color='purple',
-           bbox=dict(boxstyle='round', facecolor='plum', alpha=0.7))
-    
-    # Titolo
-    plt.title('DAG Agente di Investimento\nArchitettura Agentica con Alpha Vantage MCP',
-             fontsize=18, fontweight='bold', pad=20)
-    
-    # Legenda
-    legend_elements = [
-        mpatches.Patch(color='#87CEEB', label='Nodo Decisionale'),
-        mpatches.Patch(color='#FFD700', label='Nodo Tools (MCP)'),
-        mpatches.Patch(color='#FFA07A', label='Nodo Finalizzazione'),
-        mpatches.Rectangle((0,0),1,1, linestyle='dashed', fill=False, label='Edge Condizionale'),
-        mpatches.Rectangle((0,0),1,1, linestyle='solid', fill=False, label='Edge Diretto'),
-    ]
-    ax.legend(handles=legend_elements, loc='upper right', fontsize=11)
-    
-    # Descrizione tools
-    tools_desc = (
-        "🛠️ Tools Disponibili:\n"
-        "• get_stock_quote\n"
-        "• get_market_overview\n"
-        "• analyze_sector_performance\n"
-        "• calculate_portfolio_allocation"
-    )
-    ax.text(0.3, 7.5, tools_desc, fontsize=10,
-           bbox=dict(boxstyle='round', facecolor='lightyellow', alpha=0.8),
-           verticalalignment='top')
-    
-    plt.tight_layout()
-    
-    output_path = os.path.join(os.path.dirname(__file__), 'investment_agent_dag.png')
-    plt.savefig(output_path, dpi=300, bbox_inches='tight')
-    print(f"\n✅ DAG salvato in: {output_path}")
-    
-    plt.show()
-    
-    return output_path
+            sy, ty = y1 + NODE_H / 2, y2 - NODE_H / 2
+            d = f"M {x1:.0f} {sy:.0f} L {x2:.0f} {ty:.0f}"
+            label_x, label_y = (x1 + x2) / 2 + 8, (sy + ty) / 2
+        parts.append(f'<path d="{d}" fill="none" stroke="{color}" stroke-width="{stroke:.1f}"{dash} '
+                     f'marker-end="url(#arrow)"/>')
+        if count:
+            parts.append(f'<text x="{label_x:.0f}" y="{label_y:.0f}" font-size="12" fill="{color}" '
+                         f'font-weight="bold">×{count}</text>')
+
+    total = summary["total_s"] if summary else 0.0
+    for node, (x, y) in pos.items():
+        stats = summary["nodes"].get(node) if summary else None
+        if summary and node not in (START, END_NODE):
+            share = stats["latency_s"] / total if stats and total else 0.0
+            fill = _heat(share) if stats else "#eeeeee"
+        else:
+            share, fill = 0.0, NODE_COLORS.get(node, "#f2f0ff")
+        if node in (START, END_NODE):
+            parts.append(f'<ellipse cx="{x:.0f}" cy="{y:.0f}" rx="{NODE_W / 3:.0f}" ry="{NODE_H / 2.4:.0f}" '
+                         f'fill="{fill}" stroke="black" stroke-width="2"/>')
+            label = "START" if node == START else "END"
+        else:
+            parts.append(f'<rect x="{x - NODE_W / 2:.0f}" y="{y - NODE_H / 2:.0f}" width="{NODE_W}" '
+                         f'height="{NODE_H}" rx="10" fill="{fill}" stroke="black" stroke-width="2"/>')
+            label = node
+        text_y = y - 4 if stats else y + 5
+        ink = "white" if share > 0.6 else "black"
+        parts.append(f'<text x="{x:.0f}" y="{text_y:.0f}" text-anchor="middle" font-size="15" '
+                     f'font-weight="bold" fill="{ink}">{escape(label)}</text>')
+        if stats:
+            parts.append(f'<text x="{x:.0f}" y="{y + 14:.0f}" text-anchor="middle" font-size="11" fill="{ink}">'
+                         f'×{stats["visits"]} · {stats["latency_s"]:.2f}s ({share:.0%})</text>')
+
+    if summary:
+        parts.append(f'<text x="{width / 2:.0f}" y="{height - 15:.0f}" text-anchor="middle" font-size="13">'
+                     f'Loop tools: {summary["tool_loops"]} · Tempo nei nodi: {total:.2f}s</text>')
+    parts.append("</svg>")
+    return "\n".join(parts)
+
+
+_agent_graph = None
+
+
+def _default_graph():
+    global _agent_graph
+    with _cache_lock:
+        if _agent_graph is None:
+            _agent_graph = create_investment_agent().get_graph()
+        return _agent_graph
+
+
+def dag_svg(trace: list = None, graph=None) -> str:
+    """SVG del DAG, con la traccia di esecuzione sovrapposta se fornita."""
+    graph = graph or _default_graph()
+    _, layout = graph_layout(graph)
+    summary = summarize_trace(trace, graph) if trace else None
+    return render_svg(layout, summary)
+
+
+def write_dag_svg(path: str = DAG_SVG_PATH, graph=None) -> str:
+    """Salva l'SVG del DAG; il file viene riscritto solo se la struttura del grafo è cambiata."""
+    graph = graph or _default_graph()
+    key, layout = graph_layout(graph)
+    marker = f"<!-- graph-hash: {key} -->"
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            if f.readline().strip() == marker:
+                print(f"\n✅ DAG invariato, SVG in cache: {path}")
+                return path
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(marker + "\n" + render_svg(layout))
+    print(f"\n✅ DAG salvato in: {path}")
+    return path
 
 
 def print_dag_info():
@@ -194,5 +310,5 @@ def print_dag_info():
 
 if __name__ == "__main__":
     print("🎨 Creazione visualizzazione DAG Agente di Investimento...\n")
-    create_investment_dag_visual()
+    write_dag_svg()
     print_dag_info()